@@ -0,0 +1,469 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import time
+from io import BytesIO
+from urllib.parse import parse_qsl
+
+from aiohttp import web
+
+import pricing
+from pricing import MODEL_DISPLAY, TARIFFS, PACKAGES
+from uploads import UploadError
+
+
+class InitDataError(ValueError):
+    pass
+
+
+class ApiError(Exception):
+    """Отказ, который API отдает клиенту как есть: HTTP-статус, текст и машинный код."""
+
+    def __init__(self, status: int, message: str, reason: str = "error"):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.reason = reason
+
+
+# Конечные статусы генерации: после них поток событий закрывается
+FINAL_STATUSES = {"completed", "failed"}
+
+
+def verify_init_data(init_data: str, bot_token: str, max_age: float, now: float | None = None) -> dict:
+    """
+    Проверяет подпись initData мини-приложения Telegram и возвращает его поля,
+    `user` — уже разобранным словарем.
+
+    Ключ — HMAC-SHA256(key="WebAppData", msg=bot_token), подписывается строка
+    из отсортированных пар `key=value` всех полей, кроме `hash`, через перевод строки.
+    Данные старше `max_age` сек. (по `auth_date`) не принимаются. Raises: InitDataError.
+    """
+    try:
+        fields = dict(parse_qsl(init_data, keep_blank_values=True, strict_parsing=True))
+    except ValueError:
+        raise InitDataError("malformed initData")
+    received = fields.pop("hash", "")
+    check_string = "\n".join(f"{k}={v}" for k, v in sorted(fields.items()))
+    secret = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+    expected = hmac.new(secret, check_string.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected, received):
+        raise InitDataError("bad signature")
+
+    try:
+        auth_date = int(fields["auth_date"])
+        fields["user"] = json.loads(fields["user"])
+        int(fields["user"]["id"])
+    except (KeyError, ValueError, TypeError):
+        raise InitDataError("missing auth_date or user")
+    if max_age and (now or time.time()) - auth_date > max_age:
+        raise InitDataError("initData expired")
+    return fields
+
+
+def _etag(body: bytes) -> str:
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def _json_body(data) -> bytes:
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=str).encode()
+
+
+def _is_image(data: bytes) -> bool:
+    """Данные — изображение JPEG/PNG/WEBP (проверка структуры файла без полного декодирования)."""
+    from PIL import Image  # тяжелый импорт нужен только при загрузке референсов
+    try:
+        with Image.open(BytesIO(data)) as img:
+            img.verify()
+            return img.format in ("JPEG", "PNG", "WEBP")
+    except Exception:
+        return False
+
+
+def _error(status: int, message: str, reason: str = "error") -> web.Response:
+    return web.json_response({"error": message, "reason": reason}, status=status)
+
+
+class WebApi:
+    """
+    HTTP API для мини-приложения (web-app/): профиль, цены, возможности моделей и генерации.
+
+    Запросы от пользователя подписаны initData Telegram (`Authorization: tma <initData>`),
+    пользователь берется из него, а не из параметров запроса. Работает в процессе бота
+    и читает БД через тот же `store` (модуль database с общим движком).
+
+    Цены и модели одинаковы для всех, поэтому отдаются с ETag и `Cache-Control: public`:
+    тело и ETag собираются один раз на снимок таблиц pricing (новый после перезагрузки
+    цен), на If-None-Match отвечаем 304 без тела. Профиль — `private, no-cache`: клиент
+    показывает сохраненную копию и перепроверяет ее по ETag.
+
+    Генерации ставятся в ту же очередь, что и из чата: `submit(user_id, params)` (из main)
+    выполняет проверки и списание и возвращает id генерации, результат бот присылает в чат.
+    Статус отдается опросом (`GET /api/jobs/{id}`) или потоком SSE (`/api/jobs/{id}/events`).
+    Поток перечитывает статус по `job_changed` (NOTIFY из БД при завершении генерации)
+    и раз в `status_poll_interval` сек. — так замечается, что воркер взял задание.
+
+    Референсы мини-приложение загружает частями (`uploads` — ChunkedUploads, можно
+    продолжить после обрыва). Размер ограничен `max_ref_bytes` тарифа, число открытых
+    загрузок пользователя — `max_refs`; брошенную загрузку клиент удаляет. Готовый файл
+    проверяется и кладется в `ref_store` (хранилище результатов, адрес — SHA-256),
+    откуда его берет воркер. В задание передаются хеши, а не сами изображения.
+
+    На том же порту — `/healthz` и `/readyz` из `health` (HealthChecks), если он задан.
+    """
+
+    def __init__(self, store, bot_token: str, model_aliases: dict, origin: str = "*",
+                 init_data_ttl: float = 86400, cache_max_age: int = 300, submit=None,
+                 status_poll_interval: float = 2.0, stream_timeout: float = 600.0, keepalive: float = 15.0,
+                 uploads=None, ref_store=None, upload_chunk_size: int = 256 * 1024, health=None):
+        self.store = store
+        self.health = health
+        self.submit = submit
+        self.uploads = uploads
+        self.ref_store = ref_store
+        self.upload_chunk_size = upload_chunk_size
+        self.bot_token = bot_token
+        self.model_aliases = model_aliases
+        self.origins = {o.strip().rstrip("/") for o in origin.split(",") if o.strip()}
+        self.init_data_ttl = init_data_ttl
+        self.cache_max_age = cache_max_age
+        self.status_poll_interval = status_poll_interval
+        self.stream_timeout = stream_timeout
+        self.keepalive = keepalive
+        self._catalog = {}  # name -> (снимок таблиц, тело, etag)
+        self._watchers: dict[int, set[asyncio.Event]] = {}  # id генерации -> ждущие потоки SSE
+        self._runner: web.AppRunner | None = None
+
+    def app(self) -> web.Application:
+        app = web.Application(middlewares=[self._cors], client_max_size=max(self.upload_chunk_size, 1024 ** 2))
+        app.router.add_get("/api/profile", self.profile)
+        app.router.add_get("/api/prices", self.prices)
+        app.router.add_get("/api/models", self.models)
+        app.router.add_post("/api/jobs", self.submit_job)
+        app.router.add_get(r"/api/jobs/{id:\d+}", self.job_status)
+        app.router.add_get(r"/api/jobs/{id:\d+}/events", self.job_events)
+        app.router.add_post("/api/uploads", self.create_upload)
+        app.router.add_get("/api/uploads/{id}", self.upload_status)
+        app.router.add_patch("/api/uploads/{id}", self.upload_chunk)
+        app.router.add_delete("/api/uploads/{id}", self.cancel_upload)
+        if self.health is not None:
+            self.health.add_routes(app)
+        return app
+
+    async def start(self, host: str, port: int):
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logging.info(f"Web API listening on {host}:{port}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    # --- Общие части ---
+
+    @web.middleware
+    async def _cors(self, request: web.Request, handler):
+        # Мини-приложение живет на другом домене (GitHub Pages), поэтому нужен CORS
+        if request.method == "OPTIONS":
+            response = web.Response(status=204)
+            response.headers["Access-Control-Allow-Methods"] = "GET, POST, PATCH, DELETE, OPTIONS"
+            response.headers["Access-Control-Allow-Headers"] = "Authorization, Content-Type, If-None-Match, Upload-Offset"
+            # Браузер кеширует preflight и не повторяет его перед каждым запросом
+            response.headers["Access-Control-Max-Age"] = "86400"
+        else:
+            response = await handler(request)
+        origin = request.headers.get("Origin", "").rstrip("/")
+        if origin and ("*" in self.origins or origin in self.origins):
+            response.headers["Access-Control-Allow-Origin"] = origin
+            response.headers["Access-Control-Expose-Headers"] = "ETag, Upload-Offset"
+            response.headers["Vary"] = "Origin"
+        return response
+
+    def authenticate(self, request: web.Request) -> dict:
+        """Поля initData из заголовка Authorization. Raises: InitDataError."""
+        scheme, _, init_data = request.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() != "tma" or not init_data:
+            raise InitDataError("initData required")
+        return verify_init_data(init_data, self.bot_token, self.init_data_ttl)
+
+    def job_changed(self, payload: str | None):
+        """Статус генерации `payload` изменился; None — неизвестно какой (переподключение слушателя)."""
+        if payload is None:
+            watchers = [event for events in self._watchers.values() for event in events]
+        else:
+            try:
+                watchers = self._watchers.get(int(payload), ())
+            except ValueError:
+                return
+        for event in watchers:
+            event.set()
+
+    @staticmethod
+    def _conditional(request: web.Request, body: bytes, etag: str, cache_control: str) -> web.Response:
+        headers = {"ETag": etag, "Cache-Control": cache_control}
+        if etag in request.headers.get("If-None-Match", ""):
+            return web.Response(status=304, headers=headers)
+        return web.Response(body=body, content_type="application/json", headers=headers)
+
+    def _cached(self, request: web.Request, name: str, build) -> web.Response:
+        tables = pricing.current_tables()
+        cached = self._catalog.get(name)
+        if cached is None or cached[0] is not tables:
+            body = _json_body(build())
+            cached = self._catalog[name] = (tables, body, _etag(body))
+        return self._conditional(request, cached[1], cached[2], f"public, max-age={self.cache_max_age}")
+
+    # --- Обработчики ---
+
+    async def profile(self, request: web.Request) -> web.Response:
+        try:
+            user_id = int(self.authenticate(request)["user"]["id"])
+        except InitDataError as e:
+            return _error(401, str(e))
+        user = await self.store.get_user(user_id)
+        if user is None:
+            return _error(404, "user not found, send /start to the bot")
+        if user.access_level == "banned":
+            return _error(403, "banned")
+
+        level = "admin" if user.access_level == "admin" else (user.tariff or "demo")
+        rules = TARIFFS.get(level, {})
+        body = _json_body({
+            "id": user.id,
+            "username": user.username,
+            "full_name": user.full_name,
+            "access_level": user.access_level,
+            "tariff": level,
+            "tariff_expires_at": user.tariff_expires_at.isoformat() if user.tariff_expires_at else None,
+            "balance": user.balance,
+            "limits": {
+                "allowed_models": rules.get("allowed_models", ["*"]),
+                "allowed_ar": rules.get("allowed_ar", ["*"]),
+                "max_refs": rules.get("max_refs", 0),
+                "max_ref_bytes": rules.get("max_ref_bytes", 0),
+                "can_use_2k_4k": rules.get("can_use_2k_4k", False),
+            },
+        })
+        return self._conditional(request, body, _etag(body), "private, no-cache")
+
+    async def prices(self, request: web.Request) -> web.Response:
+        return self._cached(request, "prices", lambda: {
+            "rub_to_nc": pricing.RUB_TO_NC,
+            "models": pricing.price_table(),
+            "tariffs": {name: rules for name, rules in TARIFFS.items() if name != "admin"},
+            "packages": PACKAGES,
+            "max_variants": pricing.MAX_VARIANTS,
+        })
+
+    async def models(self, request: web.Request) -> web.Response:
+        def build():
+            prices = pricing.price_table()
+            return {
+                "models": [{"id": model, **display, "prices": prices.get(model, {"": pricing.DEFAULT_PRICE})}
+                           for model, display in MODEL_DISPLAY.items()],
+                # Короткие имена, которые мини-приложение передает в action=generate
+                "aliases": self.model_aliases,
+                "aspect_ratios": pricing.ASPECT_RATIOS,
+            }
+        return self._cached(request, "models", build)
+
+    async def submit_job(self, request: web.Request) -> web.Response:
+        try:
+            user_id = int(self.authenticate(request)["user"]["id"])
+        except InitDataError as e:
+            return _error(401, str(e))
+        if self.submit is None:
+            return _error(503, "generation is not available", "unavailable")
+        try:
+            params = await request.json()
+        except ValueError:
+            return _error(400, "JSON body required", "invalid")
+        if not isinstance(params, dict):
+            return _error(400, "JSON object required", "invalid")
+        try:
+            gen_id = await self.submit(user_id, params)
+        except ApiError as e:
+            return _error(e.status, e.message, e.reason)
+        return web.json_response({
+            "id": gen_id,
+            "status": "queued",
+            "status_url": f"/api/jobs/{gen_id}",
+            "events_url": f"/api/jobs/{gen_id}/events",
+        }, status=202)
+
+    async def _job(self, request: web.Request) -> tuple[int, dict | None] | web.Response:
+        try:
+            user_id = int(self.authenticate(request)["user"]["id"])
+        except InitDataError as e:
+            return _error(401, str(e))
+        gen_id = int(request.match_info["id"])
+        status = await self.store.get_generation_job_status(gen_id, user_id)
+        if status is None:
+            return _error(404, "job not found")
+        return user_id, status
+
+    async def job_status(self, request: web.Request) -> web.Response:
+        found = await self._job(request)
+        if isinstance(found, web.Response):
+            return found
+        _, status = found
+        return web.json_response(status, headers={"Cache-Control": "no-store"})
+
+    async def job_events(self, request: web.Request) -> web.StreamResponse:
+        """
+        Поток SSE со статусом генерации: событие `status` на каждое изменение, комментарий-ping
+        раз в `keepalive` сек. (чтобы прокси не закрыли соединение). Закрывается на конечном статусе.
+        """
+        found = await self._job(request)
+        if isinstance(found, web.Response):
+            return found
+        user_id, status = found
+        gen_id = status["id"]
+
+        response = web.StreamResponse(headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-store",
+            # nginx не буферизует поток
+            "X-Accel-Buffering": "no",
+        })
+        await response.prepare(request)
+
+        event = asyncio.Event()
+        self._watchers.setdefault(gen_id, set()).add(event)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.stream_timeout
+        last_write = loop.time()
+        sent = None
+        try:
+            while True:
+                if status != sent:
+                    await response.write(f"event: status\ndata: {json.dumps(status)}\n\n".encode())
+                    sent = status
+                    last_write = loop.time()
+                    if status["status"] in FINAL_STATUSES:
+                        break
+                elif loop.time() - last_write >= self.keepalive:
+                    await response.write(b": ping\n\n")
+                    last_write = loop.time()
+                if loop.time() >= deadline:
+                    break
+                event.clear()
+                try:
+                    await asyncio.wait_for(event.wait(), self.status_poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                status = await self.store.get_generation_job_status(gen_id, user_id) or status
+        except ConnectionResetError:
+            pass  # клиент закрыл мини-приложение
+        finally:
+            watchers = self._watchers.get(gen_id)
+            if watchers is not None:
+                watchers.discard(event)
+                if not watchers:
+                    del self._watchers[gen_id]
+        return response
+
+    async def create_upload(self, request: web.Request) -> web.Response:
+        """Начать загрузку референса: {"size": байт} -> id загрузки и размер части."""
+        try:
+            user_id = int(self.authenticate(request)["user"]["id"])
+        except InitDataError as e:
+            return _error(401, str(e))
+        if self.uploads is None or self.ref_store is None:
+            return _error(503, "uploads are not available", "unavailable")
+        try:
+            size = int((await request.json())["size"])
+        except (ValueError, KeyError, TypeError):
+            return _error(400, "JSON body with size required", "invalid")
+
+        user = await self.store.get_user(user_id)
+        if user is None:
+            return _error(404, "user not found, send /start to the bot")
+        if user.access_level == "banned":
+            return _error(403, "banned", "forbidden")
+        level = "admin" if user.access_level == "admin" else (user.tariff or "demo")
+        rules = TARIFFS.get(level, {})
+        max_refs = rules.get("max_refs", 0)
+        if not max_refs:
+            return _error(403, "references are not available on your tariff", "forbidden")
+        max_bytes = rules.get("max_ref_bytes", 0)
+        if size <= 0 or size > max_bytes:
+            return _error(413, f"reference size must be 1..{max_bytes} bytes", "too_large")
+
+        # Больше референсов, чем разрешено в задании, загружать одновременно незачем
+        try:
+            upload_id = await self.uploads.create(user_id, size, limit=max_refs)
+        except UploadError as e:
+            return _error(e.status, e.message, "rate_limited")
+        return web.json_response(
+            {"id": upload_id, "offset": 0, "size": size, "chunk_size": self.upload_chunk_size},
+            status=201, headers={"Location": f"/api/uploads/{upload_id}"},
+        )
+
+    async def upload_status(self, request: web.Request) -> web.Response:
+        """Сколько байт уже принято — отсюда клиент продолжает после обрыва."""
+        try:
+            user_id = int(self.authenticate(request)["user"]["id"])
+        except InitDataError as e:
+            return _error(401, str(e))
+        if self.uploads is None:
+            return _error(503, "uploads are not available", "unavailable")
+        try:
+            offset, size = await self.uploads.status(request.match_info["id"], user_id)
+        except UploadError as e:
+            return _error(e.status, e.message)
+        return web.json_response({"offset": offset, "size": size},
+                                 headers={"Upload-Offset": str(offset), "Cache-Control": "no-store"})
+
+    async def cancel_upload(self, request: web.Request) -> web.Response:
+        """Удалить незавершенную загрузку: она больше не занимает лимит открытых загрузок."""
+        try:
+            user_id = int(self.authenticate(request)["user"]["id"])
+        except InitDataError as e:
+            return _error(401, str(e))
+        if self.uploads is None:
+            return _error(503, "uploads are not available", "unavailable")
+        try:
+            await self.uploads.cancel(request.match_info["id"], user_id)
+        except UploadError as e:
+            return _error(e.status, e.message)
+        return web.Response(status=204)
+
+    async def upload_chunk(self, request: web.Request) -> web.Response:
+        """
+        Часть загрузки с заголовком Upload-Offset. На последней части файл проверяется
+        и сохраняется, в ответе — `ref` (SHA-256) для поля refs в POST /api/jobs.
+        """
+        try:
+            user_id = int(self.authenticate(request)["user"]["id"])
+        except InitDataError as e:
+            return _error(401, str(e))
+        if self.uploads is None or self.ref_store is None:
+            return _error(503, "uploads are not available", "unavailable")
+        try:
+            offset = int(request.headers["Upload-Offset"])
+        except (KeyError, ValueError):
+            return _error(400, "Upload-Offset header required", "invalid")
+        data = await request.read()
+        if len(data) > self.upload_chunk_size:
+            return _error(413, f"chunk must be at most {self.upload_chunk_size} bytes", "too_large")
+
+        upload_id = request.match_info["id"]
+        try:
+            offset, size = await self.uploads.append(upload_id, user_id, offset, data)
+            if offset < size:
+                return web.json_response({"offset": offset, "size": size}, headers={"Upload-Offset": str(offset)})
+            image = await self.uploads.take(upload_id, user_id)
+        except UploadError as e:
+            body = {"error": e.message, "reason": "error"}
+            if e.offset is not None:
+                body["offset"] = e.offset
+            return web.json_response(body, status=e.status)
+
+        if not await asyncio.to_thread(_is_image, image):
+            return _error(415, "only JPEG, PNG and WEBP images are accepted", "invalid")
+        digest = await self.ref_store.put(image)
+        return web.json_response({"offset": offset, "size": size, "ref": digest}, headers={"Upload-Offset": str(offset)})
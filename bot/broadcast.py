@@ -0,0 +1,93 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+
+from aiogram.exceptions import TelegramAPIError, TelegramForbiddenError, TelegramRetryAfter
+
+from rate_limit import TokenBucket
+
+# Сколько раз повторять отправку одному получателю после RetryAfter
+MAX_RETRIES = 3
+
+
+@dataclass
+class BroadcastProgress:
+    last_user_id: int
+    delivered: int = 0
+    blocked: int = 0
+    failed: int = 0
+    status: str = 'running'
+
+
+class Broadcaster:
+    """
+    Рассылка одного сообщения всем пользователям.
+
+    Получатели читаются страницами по users.id (keyset), отправка идет не быстрее
+    `rate` сообщений в секунду — ниже общего лимита Telegram (~30/с на бота), чтобы
+    оставить запас живому трафику генераций. Каждому чату уходит одно сообщение,
+    так что лимит «1 сообщение в секунду на чат» не нарушается.
+    RetryAfter выдерживается полностью и отправка повторяется тому же получателю.
+    После каждой страницы курсор и счетчики сохраняются в `store`, поэтому после
+    рестарта рассылка продолжается с места остановки (повторно может уйти не больше
+    одной страницы).
+
+    `store` — объект с `fetch_broadcast_recipients` и `save_broadcast_progress`
+    (модуль database или подделка в тестах).
+    """
+
+    def __init__(self, bot, store, rate: float, batch_size: int = 100, clock=time.monotonic, sleep=asyncio.sleep):
+        self.bot = bot
+        self.store = store
+        self.batch_size = batch_size
+        self._bucket = TokenBucket(rate, capacity=1, clock=clock)
+        self._sleep = sleep
+
+    async def _pace(self):
+        wait = self._bucket.wait_time()
+        if wait > 0:
+            await self._sleep(wait)
+        self._bucket.consume()
+
+    async def _send(self, user_id: int, text: str, progress: BroadcastProgress):
+        for _ in range(MAX_RETRIES + 1):
+            await self._pace()
+            try:
+                await self.bot.send_message(user_id, text, parse_mode="HTML")
+                progress.delivered += 1
+                return
+            except TelegramRetryAfter as e:
+                logging.warning(f"Broadcast flood control: retry after {e.retry_after}s")
+                await self._sleep(e.retry_after)
+            except TelegramForbiddenError:
+                progress.blocked += 1
+                return
+            except TelegramAPIError as e:
+                logging.info(f"Broadcast to {user_id} failed: {e}")
+                progress.failed += 1
+                return
+        progress.failed += 1
+
+    async def _save(self, broadcast_id: int, progress: BroadcastProgress, status: str = 'running') -> bool:
+        return await self.store.save_broadcast_progress(
+            broadcast_id, progress.last_user_id, progress.delivered, progress.blocked, progress.failed, status
+        )
+
+    async def run(self, broadcast) -> BroadcastProgress:
+        """
+        Продолжает рассылку `broadcast` (строка broadcasts) с сохраненного курсора.
+        Возвращает итог со статусом completed или cancelled (рассылку отменили).
+        """
+        progress = BroadcastProgress(broadcast.last_user_id, broadcast.delivered, broadcast.blocked, broadcast.failed)
+        while True:
+            user_ids = await self.store.fetch_broadcast_recipients(progress.last_user_id, self.batch_size)
+            if not user_ids:
+                progress.status = 'completed' if await self._save(broadcast.id, progress, 'completed') else 'cancelled'
+                return progress
+            for user_id in user_ids:
+                await self._send(user_id, broadcast.text, progress)
+                progress.last_user_id = user_id
+            if not await self._save(broadcast.id, progress):
+                progress.status = 'cancelled'
+                return progress
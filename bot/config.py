@@ -1,5 +1,6 @@
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pydantic import SecretStr
+from typing import Literal
 
 class Settings(BaseSettings):
     BOT_TOKEN: SecretStr
@@ -9,9 +10,125 @@ class Settings(BaseSettings):
     POSTGRES_DB: str
     POSTGRES_HOST: str
     
+    # Режим процесса: all — все в одном процессе; bot — только апдейты и постановка заданий в очередь;
+    # worker — только выполнение генераций из очереди (точка входа worker.py). В режимах bot/worker
+    # состояние FSM и история диалогов хранятся в Postgres и общие для всех процессов
+    RUN_MODE: Literal["all", "bot", "worker"] = "all"
+
+    # Сколько секунд ждать готовности Postgres при запуске (проверка с нарастающей паузой)
+    DB_STARTUP_TIMEOUT: float = 60.0
+
     # Comma separated list of admin IDs (e.g. "12345,67890")
     ADMIN_IDS: str = "220567" 
 
+    # Чат-сессии диалога: время жизни без активности (сек) и максимум одновременно хранимых
+    CHAT_SESSION_TTL: int = 3600
+    CHAT_SESSION_MAX: int = 1000
+
+    # Повторы запросов к Gemini (экспоненциальная задержка с джиттером)
+    GEN_RETRY_ATTEMPTS: int = 3
+    GEN_RETRY_BASE_DELAY: float = 1.0
+    GEN_RETRY_MAX_DELAY: float = 8.0
+    GEN_RETRY_DEADLINE: float = 120.0
+
+    # Circuit breaker на каждую модель: доля ошибок в окне, минимум вызовов, окно и пауза (сек)
+    BREAKER_ERROR_RATE: float = 0.5
+    BREAKER_MIN_CALLS: int = 5
+    BREAKER_WINDOW: float = 60.0
+    BREAKER_COOLDOWN: float = 30.0
+
+    # Хеджирование быстрых моделей: второй запрос после задержки ~p90, доля доп. запросов ограничена
+    HEDGING_ENABLED: bool = False
+    HEDGE_MODELS: str = "gemini-2.5-flash-image,imagen-4.0-fast-generate-001"
+    HEDGE_PERCENTILE: float = 0.9
+    HEDGE_DEFAULT_DELAY: float = 10.0
+    HEDGE_MIN_DELAY: float = 2.0
+    HEDGE_MAX_DELAY: float = 30.0
+    HEDGE_BUDGET_RATIO: float = 0.1
+
+    # Сколько секунд запрос может ждать свободный слот лимита, прежде чем получить отказ с ETA
+    RATE_LIMIT_MAX_WAIT: float = 10.0
+
+    # Сколько генераций одновременно отправляется провайдеру; остальные ждут в очереди по весам тарифов
+    GEN_MAX_CONCURRENCY: int = 8
+
+    # Очередь генераций в БД (generation_jobs): воркеров в процессе (могут ждать слот очереди выше),
+    # аренда задания (сек, продлевается heartbeat-ом), сколько раз задание можно забрать
+    # после падения воркера и как часто свободные воркеры опрашивают очередь (сек)
+    GEN_WORKERS: int = 16
+    GEN_JOB_LEASE: float = 60.0
+    GEN_JOB_MAX_ATTEMPTS: int = 3
+    GEN_JOB_POLL_INTERVAL: float = 1.0
+
+    # Сверка зависших генераций: pending без задания в очереди старше GEN_STALE_AFTER сек.
+    # получают возврат NC; проверка при старте и раз в GEN_RECONCILE_INTERVAL сек.
+    GEN_STALE_AFTER: float = 900.0
+    GEN_RECONCILE_INTERVAL: float = 300.0
+
+    # Потоковая генерация Gemini: ход мыслей и готовность изображения показываются в статусе.
+    # Статус редактируется не чаще раза в STATUS_EDIT_INTERVAL сек. (лимиты Telegram на правки)
+    GEN_STREAMING: bool = True
+    STATUS_EDIT_INTERVAL: float = 2.0
+
+    # JSON с ценами и тарифами (формат — bot/pricing.example.json). Пусто — встроенные таблицы pricing.py.
+    # Файл перечитывается при изменении раз в PRICING_RELOAD_INTERVAL сек. без перезапуска бота
+    PRICING_FILE: str = ""
+    PRICING_RELOAD_INTERVAL: float = 5.0
+
+    # Как часто (сек) фоновая задача переводит истекшие подписки на DEMO
+    TARIFF_SWEEP_INTERVAL: float = 60.0
+
+    # Ежемесячные NC по подписке: как часто проверять неначисленных (сек) и размер батча
+    NC_GRANT_INTERVAL: float = 3600.0
+    NC_GRANT_BATCH: int = 5000
+
+    # Сбор альбома (media group): пауза без новых фото, после которой альбом считается
+    # полным, — адаптивная, в пределах этих границ (сек)
+    ALBUM_MIN_WAIT: float = 0.3
+    ALBUM_MAX_WAIT: float = 1.5
+    # Промпт и фото, отправленные отдельными сообщениями (текст, затем фото по одному), собираются
+    # в одну генерацию: запуск после такой паузы без новых сообщений или сразу, когда фото хватает
+    PROMPT_COLLECT_WAIT: float = 1.5
+
+    # Рассылки: сообщений в секунду (ниже ~30/с общего лимита Telegram — остается запас
+    # для живого трафика) и сколько получателей читать из БД за раз
+    BROADCAST_RATE: float = 15.0
+    BROADCAST_BATCH: int = 100
+
+    # Хранилище результатов генераций (ключ — SHA-256 изображения, см. result_store.py):
+    # local — каталог RESULT_STORE_DIR, s3 — S3-совместимое хранилище (MinIO), none — не сохранять.
+    # Срок хранения (дней) и предел общего объема (байт), 0 — без ограничения; очистка раз в RESULT_PRUNE_INTERVAL сек.
+    RESULT_STORE: Literal["none", "local", "s3"] = "local"
+    RESULT_STORE_DIR: str = "results"
+    RESULT_MAX_AGE_DAYS: float = 30.0
+    RESULT_MAX_BYTES: int = 10 * 1024 ** 3
+    RESULT_PRUNE_INTERVAL: float = 3600.0
+    S3_ENDPOINT: str = "http://minio:9000"
+    S3_BUCKET: str = "results"
+    S3_ACCESS_KEY: str = ""
+    S3_SECRET_KEY: SecretStr = SecretStr("")
+    S3_REGION: str = "us-east-1"
+
+    # HTTP API мини-приложения (api.py): адрес и порт (0 — выключен), домены мини-приложения для CORS
+    # (через запятую, * — любой), срок годности initData (сек) и max-age кеша цен и моделей (сек)
+    API_HOST: str = "0.0.0.0"
+    API_PORT: int = 8080
+    WEBAPP_ORIGIN: str = "https://dnstrokin.github.io"
+    INIT_DATA_TTL: float = 86400.0
+    API_CACHE_MAX_AGE: int = 300
+
+    # Загрузка референсов из мини-приложения частями: каталог незавершенных загрузок, сколько (сек)
+    # хранить брошенную загрузку и размер части (байт). Готовые файлы кладутся в хранилище результатов
+    UPLOAD_DIR: str = "uploads"
+    UPLOAD_TTL: float = 3600.0
+    UPLOAD_CHUNK_SIZE: int = 256 * 1024
+
+    # Проверки /healthz и /readyz (на порту API_PORT, у воркеров — отдельный сервер): допустимая
+    # задержка event loop (сек), таймаут одной проверки (сек) и кеш проверки Bot API (сек)
+    HEALTH_MAX_LOOP_LAG: float = 1.0
+    HEALTH_CHECK_TIMEOUT: float = 2.0
+    HEALTH_BOT_API_TTL: float = 30.0
+
     model_config = SettingsConfigDict(env_file='.env', env_file_encoding='utf-8', extra='ignore')
 
 config = Settings()
@@ -1,9 +1,15 @@
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncAttrs
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import BigInteger, Integer, Text, DateTime, func, select, update
+from sqlalchemy import BigInteger, Integer, Float, Text, DateTime, Index, func, select, update, delete, text, tuple_, literal, case, and_, or_
+from sqlalchemy.dialects.postgresql import insert, ARRAY, JSONB
+from datetime import datetime
 from config import config
-from pricing import START_BONUS
+from pricing import START_BONUS, TARIFF_WEIGHTS
+import asyncio
+import json
 import logging
+import asyncpg
+from job_queue import Job
 
 DATABASE_URL = f"postgresql+asyncpg://{config.POSTGRES_USER}:{config.POSTGRES_PASSWORD}@{config.POSTGRES_HOST}/{config.POSTGRES_DB}"
 
@@ -25,9 +31,16 @@ class User(Base):
     balance: Mapped[int] = mapped_column(BigInteger, default=START_BONUS) # Default Demo bonus
     tariff: Mapped[str] = mapped_column(Text, default='demo') # demo, basic, full
     tariff_expires_at: Mapped[DateTime | None] = mapped_column(DateTime, nullable=True)
+    # Начало подписки на текущий тариф: от него считаются циклы начисления monthly_nc
+    tariff_started_at: Mapped[DateTime | None] = mapped_column(DateTime, nullable=True, default=func.now())
     
     created_at: Mapped[DateTime] = mapped_column(DateTime, default=func.now())
 
+    __table_args__ = (
+        # Для фоновой проверки истекших тарифов: в индекс попадают только платные подписки со сроком
+        Index("ix_users_tariff_expires_at", "tariff_expires_at", postgresql_where=text("tariff_expires_at IS NOT NULL")),
+    )
+
 class Generation(Base):
     __tablename__ = 'generations'
 
@@ -39,8 +52,96 @@ class Generation(Base):
     resolution: Mapped[str | None] = mapped_column(Text, nullable=True)
     status: Mapped[str] = mapped_column(Text, default='completed') # completed, failed, pending
     tokens_used: Mapped[int] = mapped_column(Integer, default=0)
+    cost: Mapped[int | None] = mapped_column(BigInteger, nullable=True)  # списано NC; NULL — записи до очереди заданий
+    result_hashes: Mapped[list[str] | None] = mapped_column(ARRAY(Text), nullable=True)  # SHA-256 изображений в result_store
+    tg_file_id: Mapped[str | None] = mapped_column(Text, nullable=True)  # file_id отправленного фото — показ в истории без загрузки
+    created_at: Mapped[DateTime] = mapped_column(DateTime, default=func.now())
+
+    __table_args__ = (
+        # Для сверки зависших генераций: в индекс попадают только pending
+        Index("ix_generations_pending_created_at", "created_at", postgresql_where=text("status = 'pending'")),
+        # История пользователя (/history): keyset по (created_at, id) в пределах user_id
+        Index("ix_generations_user_history", "user_id", "created_at", "id", postgresql_where=text("status = 'completed'")),
+    )
+
+class GenerationJob(Base):
+    """
+    Оплаченная генерация в очереди воркеров. Статус и результат — в generations,
+    здесь только то, что нужно для выполнения, и аренда воркера. Строка удаляется,
+    когда генерация доставлена или деньги возвращены.
+
+    Порядок выдачи — `virtual_finish` (взвешенная справедливая очередь): задание
+    пользователя завершается в виртуальном времени на 1/вес тарифа позже предыдущего
+    его задания, но не раньше головы очереди. Поток заданий одного пользователя
+    не отодвигает остальных, а тарифы получают воркеров пропорционально весам.
+    """
+    __tablename__ = 'generation_jobs'
+
+    generation_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    user_id: Mapped[int | None] = mapped_column(BigInteger, nullable=True)
+    virtual_finish: Mapped[float] = mapped_column(Float, default=0.0)
+    payload: Mapped[dict] = mapped_column(JSONB)
+    status: Mapped[str] = mapped_column(Text, default='queued')  # queued, running
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    lease_owner: Mapped[str | None] = mapped_column(Text, nullable=True)
+    lease_expires_at: Mapped[DateTime | None] = mapped_column(DateTime, nullable=True)
+    created_at: Mapped[DateTime] = mapped_column(DateTime, default=func.now())
+
+class NcGrant(Base):
+    """Ежемесячное начисление NC по подписке. PK (user_id, period) не дает начислить дважды за цикл подписки."""
+    __tablename__ = 'nc_grants'
+
+    user_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    period: Mapped[str] = mapped_column(Text, primary_key=True)  # начало цикла подписки, YYYY-MM-DD
+    amount: Mapped[int] = mapped_column(BigInteger)
     created_at: Mapped[DateTime] = mapped_column(DateTime, default=func.now())
 
+class Broadcast(Base):
+    """Рассылка от администратора. last_user_id — курсор по users.id, с него продолжаем после рестарта."""
+    __tablename__ = 'broadcasts'
+
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True, autoincrement=True)
+    created_by: Mapped[int] = mapped_column(BigInteger)
+    text: Mapped[str] = mapped_column(Text)  # HTML
+    status: Mapped[str] = mapped_column(Text, default='running')  # running, completed, cancelled
+    last_user_id: Mapped[int] = mapped_column(BigInteger, default=0)
+    delivered: Mapped[int] = mapped_column(Integer, default=0)
+    blocked: Mapped[int] = mapped_column(Integer, default=0)
+    failed: Mapped[int] = mapped_column(Integer, default=0)
+    created_at: Mapped[DateTime] = mapped_column(DateTime, default=func.now())
+    finished_at: Mapped[DateTime | None] = mapped_column(DateTime, nullable=True)
+
+class ScheduledAction(Base):
+    """Отложенное действие Telegram (удаление сообщения), переживает рестарт бота."""
+    __tablename__ = 'scheduled_actions'
+
+    action: Mapped[str] = mapped_column(Text, primary_key=True)  # delete_message
+    chat_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    message_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    due_at: Mapped[DateTime] = mapped_column(DateTime)
+
+class FsmRecord(Base):
+    """Состояние FSM aiogram в режиме раздельных процессов (RUN_MODE bot/worker): бот и воркеры видят одно и то же."""
+    __tablename__ = 'fsm_states'
+
+    key: Mapped[str] = mapped_column(Text, primary_key=True)  # ключ DefaultKeyBuilder: fsm:bot:chat:user:destiny
+    state: Mapped[str | None] = mapped_column(Text, nullable=True)
+    data: Mapped[dict] = mapped_column(JSONB, default=dict)
+    updated_at: Mapped[DateTime] = mapped_column(DateTime, default=func.now(), onupdate=func.now())
+
+class ChatHistory(Base):
+    """История чат-сессии Gemini для продолжения диалога на любом воркере (режим раздельных процессов)."""
+    __tablename__ = 'chat_histories'
+
+    chat_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    data: Mapped[str] = mapped_column(Text)  # JSON: модель и история (картинки в base64)
+    updated_at: Mapped[DateTime] = mapped_column(DateTime, default=func.now(), onupdate=func.now())
+
+async def ping():
+    """Проверка соединения с Postgres (SELECT 1 через пул сессий)."""
+    async with async_session() as session:
+        await session.execute(text("SELECT 1"))
+
 async def init_db():
     async with engine.begin() as conn:
         # Create tables if they don't exist
@@ -48,8 +149,6 @@ async def init_db():
         
         # Simple Migration: Check for new columns and add them if missing
         # This is valid for Postgres
-        from sqlalchemy import text
-        
         try:
             # Check for balance
             await conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS balance BIGINT DEFAULT 500"))
@@ -57,6 +156,43 @@ async def init_db():
             await conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS tariff TEXT DEFAULT 'demo'"))
             # Check for tariff_expires_at
             await conn.execute(text("ALTER TABLE users ADD COLUMN IF NOT EXISTS tariff_expires_at TIMESTAMP"))
+            # Index for expiry sweeper (existing databases)
+            await conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_users_tariff_expires_at ON users (tariff_expires_at) "
+                "WHERE tariff_expires_at IS NOT NULL"
+            ))
+            # Fair claim order of the job queue
+            await conn.execute(text("ALTER TABLE generation_jobs ADD COLUMN IF NOT EXISTS user_id BIGINT"))
+            await conn.execute(text(
+                "ALTER TABLE generation_jobs ADD COLUMN IF NOT EXISTS virtual_finish DOUBLE PRECISION DEFAULT 0"
+            ))
+            # Subscription anchor for NC grant cycles. Existing users start from the current month,
+            # and grants keyed by calendar month (YYYY-MM) become the first cycle (YYYY-MM-01).
+            # One-time backfill: only when the column is being added, so restarts don't scan the tables
+            has_anchor = await conn.scalar(text(
+                "SELECT EXISTS (SELECT 1 FROM information_schema.columns "
+                "WHERE table_schema = current_schema() AND table_name = 'users' AND column_name = 'tariff_started_at')"
+            ))
+            if not has_anchor:
+                await conn.execute(text("ALTER TABLE users ADD COLUMN tariff_started_at TIMESTAMP"))
+                await conn.execute(text("UPDATE users SET tariff_started_at = date_trunc('month', now())"))
+                await conn.execute(text(
+                    "UPDATE nc_grants SET period = period || '-01' WHERE period ~ '^[0-9]{4}-[0-9]{2}$'"
+                ))
+            # Cost of generation and index for stale pending reconciler
+            await conn.execute(text("ALTER TABLE generations ADD COLUMN IF NOT EXISTS cost BIGINT"))
+            await conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_generations_pending_created_at ON generations (created_at) "
+                "WHERE status = 'pending'"
+            ))
+            # References to stored results (result_store)
+            await conn.execute(text("ALTER TABLE generations ADD COLUMN IF NOT EXISTS result_hashes TEXT[]"))
+            # History browser: cached Telegram file id and keyset index
+            await conn.execute(text("ALTER TABLE generations ADD COLUMN IF NOT EXISTS tg_file_id TEXT"))
+            await conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_generations_user_history ON generations (user_id, created_at, id) "
+                "WHERE status = 'completed'"
+            ))
         except Exception as e:
             logging.error(f"Migration error (ignored if columns exist): {e}")
 
@@ -93,6 +229,15 @@ async def get_user(user_id: int):
         result = await session.execute(select(User).where(User.id == user_id))
         return result.scalar_one_or_none()
 
+def _tariff_anchor(tariff: str, now: datetime):
+    """
+    Новое значение tariff_started_at: продление действующей подписки на тот же тариф
+    сохраняет начало (циклы начисления идут дальше), смена тарифа или покупка после
+    истечения начинает отсчет заново.
+    """
+    renewal = and_(User.tariff == tariff, or_(User.tariff_expires_at.is_(None), User.tariff_expires_at > now))
+    return case((renewal, func.coalesce(User.tariff_started_at, now)), else_=now)
+
 async def update_user_access(user_id: int, new_level: str):
     async with async_session() as session:
         # Sync access_level and tariff. 
@@ -103,7 +248,8 @@ async def update_user_access(user_id: int, new_level: str):
             update(User).where(User.id == user_id).values(
                 access_level=new_level,
                 tariff=new_level,
-                tariff_expires_at=None
+                tariff_expires_at=None,
+                tariff_started_at=_tariff_anchor(new_level, datetime.now())
             )
         )
         await session.commit()
@@ -130,17 +276,323 @@ async def set_user_tariff(user_id: int, tariff: str, days: int | None = 30):
         if days is None:
             expires_at = None
         else:
-            from datetime import datetime, timedelta
+            from datetime import timedelta
             expires_at = datetime.now() + timedelta(days=days)
         
         await session.execute(
             update(User).where(User.id == user_id).values(
                 tariff=tariff,
-                tariff_expires_at=expires_at
+                tariff_expires_at=expires_at,
+                tariff_started_at=_tariff_anchor(tariff, datetime.now())
+            )
+        )
+        await session.commit()
+
+async def downgrade_expired_tariffs(now: datetime | None = None) -> list[int]:
+    """
+    Переводит всех пользователей с истекшей подпиской на DEMO одним UPDATE.
+    demo/admin не трогаем. Возвращает ID переведенных (для уведомлений).
+    Время наивное локальное — так же, как его пишет set_user_tariff.
+    """
+    now = now or datetime.now()
+    async with async_session() as session:
+        result = await session.execute(
+            update(User)
+            .where(
+                User.tariff_expires_at.is_not(None),
+                User.tariff_expires_at <= now,
+                User.tariff.not_in(["demo", "admin"])
+            )
+            .values(tariff='demo', access_level='demo', tariff_expires_at=None)
+            .returning(User.id)
+        )
+        user_ids = list(result.scalars().all())
+        await session.commit()
+        return user_ids
+
+# Один батч начислений: выбрать следующих подписчиков по id (keyset), записать гранты
+# за текущий цикл каждого (уже начисленные пропускаются ON CONFLICT) и пополнить баланс
+# только тем, для кого грант реально вставлен. Один оператор = одна короткая транзакция.
+# Цикл — :cycle_days дней от tariff_started_at, ключ гранта — дата начала цикла.
+GRANT_BATCH_SQL = text("""
+WITH batch AS (
+    SELECT id, tariff,
+           CAST(tariff_started_at AS date)
+             + (:today - CAST(tariff_started_at AS date)) / :cycle_days * :cycle_days AS cycle_start
+    FROM users
+    WHERE id > :last_id
+      AND tariff = ANY(:tariffs)
+      AND (tariff_expires_at IS NULL OR tariff_expires_at > :now)
+      AND tariff_started_at <= :now
+    ORDER BY id
+    LIMIT :batch_size
+),
+granted AS (
+    INSERT INTO nc_grants (user_id, period, amount, created_at)
+    SELECT id, to_char(cycle_start, 'YYYY-MM-DD'), (CAST(:amounts AS jsonb) ->> tariff)::bigint, :now FROM batch
+    ON CONFLICT (user_id, period) DO NOTHING
+    RETURNING user_id, amount
+),
+credited AS (
+    UPDATE users SET balance = users.balance + granted.amount
+    FROM granted WHERE users.id = granted.user_id
+    RETURNING users.id
+)
+SELECT (SELECT max(id) FROM batch) AS last_id, (SELECT count(*) FROM credited) AS credited
+""")
+
+async def grant_monthly_nc(amounts: dict[str, int], batch_size: int = 5000, now: datetime | None = None,
+                           cycle_days: int = 30) -> int:
+    """
+    Начисляет месячные NC всем активным подписчикам за их текущий цикл подписки:
+    `cycle_days` дней от начала подписки (tariff_started_at), как и срок, на который
+    продается месяц. Календарный месяц не подходит: подписка с 31-го получила бы
+    два начисления за 30 оплаченных дней.
+    amounts — тариф -> сумма (тарифы с 0 не участвуют).
+    Идемпотентно: повторный запуск (в т.ч. после падения посреди прохода) начисляет
+    только тем, кому за текущий цикл еще не начисляли. Возвращает число начислений.
+    """
+    amounts = {tariff: amount for tariff, amount in amounts.items() if amount}
+    if not amounts:
+        return 0
+    now = now or datetime.now()
+    params = {
+        "tariffs": list(amounts),
+        "amounts": json.dumps(amounts),
+        "now": now,
+        "today": now.date(),
+        "cycle_days": cycle_days,
+        "batch_size": batch_size,
+    }
+    last_id, total = 0, 0
+    while True:
+        async with async_session() as session:
+            row = (await session.execute(GRANT_BATCH_SQL, {**params, "last_id": last_id})).one()
+            await session.commit()
+        if row.last_id is None:
+            return total
+        last_id, total = row.last_id, total + row.credited
+
+async def create_broadcast(created_by: int, text_html: str) -> Broadcast:
+    async with async_session() as session:
+        broadcast = Broadcast(created_by=created_by, text=text_html, status='running', last_user_id=0,
+                              delivered=0, blocked=0, failed=0)
+        session.add(broadcast)
+        await session.commit()
+        return broadcast
+
+async def get_broadcast(broadcast_id: int) -> Broadcast | None:
+    async with async_session() as session:
+        return await session.get(Broadcast, broadcast_id)
+
+async def get_recent_broadcasts(limit: int = 5) -> list[Broadcast]:
+    async with async_session() as session:
+        result = await session.execute(select(Broadcast).order_by(Broadcast.id.desc()).limit(limit))
+        return list(result.scalars().all())
+
+async def get_running_broadcasts() -> list[Broadcast]:
+    """Незавершенные рассылки — их продолжаем после рестарта."""
+    async with async_session() as session:
+        result = await session.execute(select(Broadcast).where(Broadcast.status == 'running').order_by(Broadcast.id))
+        return list(result.scalars().all())
+
+async def fetch_broadcast_recipients(after_user_id: int, limit: int) -> list[int]:
+    """Следующая страница получателей по первичному ключу (keyset): без OFFSET и без выборки всей таблицы."""
+    async with async_session() as session:
+        result = await session.execute(
+            select(User.id)
+            .where(User.id > after_user_id, User.access_level != 'banned')
+            .order_by(User.id)
+            .limit(limit)
+        )
+        return list(result.scalars().all())
+
+async def save_broadcast_progress(broadcast_id: int, last_user_id: int, delivered: int, blocked: int, failed: int,
+                                  status: str = 'running') -> bool:
+    """
+    Сохраняет курсор и счетчики рассылки. Обновляется только рассылка в статусе running,
+    поэтому отмена администратором не перетирается. Возвращает False, если рассылка уже не активна.
+    """
+    values = dict(last_user_id=last_user_id, delivered=delivered, blocked=blocked, failed=failed, status=status)
+    if status != 'running':
+        values["finished_at"] = datetime.now()
+    async with async_session() as session:
+        result = await session.execute(
+            update(Broadcast)
+            .where(Broadcast.id == broadcast_id, Broadcast.status == 'running')
+            .values(**values)
+        )
+        await session.commit()
+        return result.rowcount > 0
+
+async def cancel_broadcast(broadcast_id: int) -> bool:
+    async with async_session() as session:
+        result = await session.execute(
+            update(Broadcast)
+            .where(Broadcast.id == broadcast_id, Broadcast.status == 'running')
+            .values(status='cancelled', finished_at=datetime.now())
+        )
+        await session.commit()
+        return result.rowcount > 0
+
+async def save_scheduled_actions(rows: list[tuple[str, int, int, datetime]]):
+    """Сохраняет пачку отложенных действий одним INSERT (повтор того же действия обновляет срок)."""
+    if not rows:
+        return
+    stmt = insert(ScheduledAction).values([
+        dict(action=action, chat_id=chat_id, message_id=message_id, due_at=due_at)
+        for action, chat_id, message_id, due_at in rows
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ScheduledAction.action, ScheduledAction.chat_id, ScheduledAction.message_id],
+        set_={"due_at": stmt.excluded.due_at}
+    )
+    async with async_session() as session:
+        await session.execute(stmt)
+        await session.commit()
+
+async def load_scheduled_actions() -> list[tuple[str, int, int, datetime]]:
+    async with async_session() as session:
+        result = await session.execute(
+            select(ScheduledAction.action, ScheduledAction.chat_id, ScheduledAction.message_id, ScheduledAction.due_at)
+        )
+        return [tuple(row) for row in result.all()]
+
+async def delete_scheduled_actions(keys: list[tuple[str, int, int]]):
+    """Удаляет выполненные действия по ключу (action, chat_id, message_id)."""
+    if not keys:
+        return
+    async with async_session() as session:
+        await session.execute(
+            delete(ScheduledAction).where(
+                tuple_(ScheduledAction.action, ScheduledAction.chat_id, ScheduledAction.message_id).in_(keys)
             )
         )
         await session.commit()
 
+# Канал LISTEN/NOTIFY: новое задание в generation_jobs
+JOBS_CHANNEL = "generation_jobs"
+# Смена статуса генерации (payload — id): ждущие статуса клиенты HTTP API просыпаются без опроса
+STATUS_CHANNEL = "generation_status"
+
+# Виртуальное время начала нового задания: не раньше головы очереди (новый пользователь
+# встает сразу за ней, а не за чужим хвостом) и не раньше прошлого задания этого же пользователя
+FAIR_START_SQL = text("""
+SELECT GREATEST(
+    COALESCE((SELECT max(virtual_finish) FROM generation_jobs WHERE user_id = :user_id), 0),
+    COALESCE((SELECT min(virtual_finish) FROM generation_jobs WHERE status = 'queued'), 0)
+)
+""")
+
+async def submit_generation_job(user_id: int, cost: int, model: str, prompt: str, ar: str, res: str,
+                                payload: dict) -> tuple[int, int]:
+    """
+    Списывает `cost`, пишет генерацию в статусе pending и ставит задание в очередь —
+    одной транзакцией: либо оплаченное задание есть в очереди, либо ничего не списано.
+    Возвращает (id генерации, новый баланс).
+    """
+    async with async_session() as session:
+        balance = (await session.execute(
+            update(User).where(User.id == user_id).values(balance=User.balance - cost).returning(User.balance)
+        )).scalar_one()
+        gen = Generation(user_id=user_id, model=model, prompt=prompt, aspect_ratio=ar, resolution=res,
+                         status='pending', cost=cost)
+        session.add(gen)
+        await session.flush()
+        weight = TARIFF_WEIGHTS.get(payload.get("tariff"), TARIFF_WEIGHTS.get("demo", 1))
+        start = (await session.execute(FAIR_START_SQL, {"user_id": user_id})).scalar_one()
+        session.add(GenerationJob(generation_id=gen.id, user_id=user_id, virtual_finish=start + 1.0 / weight,
+                                  payload=payload, status='queued', attempts=0))
+        # Уведомление уходит при COMMIT — воркеры других процессов просыпаются без ожидания опроса
+        await session.execute(text(f"NOTIFY {JOBS_CHANNEL}"))
+        await session.commit()
+        return gen.id, balance
+
+async def listen_notifications(handlers: dict, retry_delay: float = 5.0, ping_interval: float = 30.0):
+    """
+    Держит отдельное соединение с LISTEN на каналах `handlers` {канал: callback(payload)}.
+    Обрыв замечается по ping и соединение пересоздается. После (пере)подключения каждый
+    callback вызывается с None: уведомления, пропущенные без слушателя, надо проверить самим.
+    """
+    dsn = DATABASE_URL.replace("postgresql+asyncpg://", "postgresql://", 1)
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(dsn)
+            for channel, callback in handlers.items():
+                await conn.add_listener(channel, lambda _conn, _pid, _channel, payload, cb=callback: cb(payload))
+            for callback in handlers.values():
+                callback(None)
+            while True:
+                await asyncio.sleep(ping_interval)
+                await conn.execute("SELECT 1")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Notification listener failed: {e}")
+        finally:
+            if conn is not None and not conn.is_closed():
+                await conn.close()
+        await asyncio.sleep(retry_delay)
+
+async def listen_generation_jobs(on_notify, retry_delay: float = 5.0, ping_interval: float = 30.0):
+    """
+    Вызывает `on_notify()` на каждое новое задание (LISTEN на канале заданий); пока
+    соединения нет, воркеры находят задания опросом.
+    """
+    await listen_notifications({JOBS_CHANNEL: lambda _payload: on_notify()}, retry_delay, ping_interval)
+
+# Забрать одно задание: новое или брошенное упавшим воркером (аренда истекла), в порядке
+# справедливой очереди (virtual_finish). SKIP LOCKED — конкурирующие воркеры не ждут друг друга
+# и не берут одну строку
+CLAIM_JOB_SQL = text("""
+UPDATE generation_jobs
+SET status = 'running', lease_owner = :owner, attempts = attempts + 1,
+    lease_expires_at = now() + make_interval(secs => :lease)
+WHERE generation_id = (
+    SELECT generation_id FROM generation_jobs
+    WHERE status = 'queued' OR lease_expires_at < now()
+    ORDER BY virtual_finish, generation_id
+    LIMIT 1
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING generation_id, attempts, payload
+""")
+
+async def get_generation_queue_depth() -> dict[str, int]:
+    """Число заданий в общей очереди по статусам: {"queued": ..., "running": ...}."""
+    async with async_session() as session:
+        rows = (await session.execute(
+            select(GenerationJob.status, func.count()).group_by(GenerationJob.status)
+        )).all()
+    return {"queued": 0, "running": 0, **{status: count for status, count in rows}}
+
+async def claim_generation_job(owner: str, lease: float) -> Job | None:
+    async with async_session() as session:
+        row = (await session.execute(CLAIM_JOB_SQL, {"owner": owner, "lease": lease})).one_or_none()
+        await session.commit()
+    if row is None:
+        return None
+    return Job(id=row.generation_id, attempts=row.attempts, payload=row.payload)
+
+async def extend_generation_job_lease(generation_id: int, owner: str, lease: float) -> bool:
+    """Heartbeat: продлевает аренду, пока задание у этого воркера. False — аренду забрали."""
+    async with async_session() as session:
+        result = await session.execute(
+            text("UPDATE generation_jobs SET lease_expires_at = now() + make_interval(secs => :lease) "
+                 "WHERE generation_id = :id AND lease_owner = :owner"),
+            {"id": generation_id, "owner": owner, "lease": lease}
+        )
+        await session.commit()
+        return result.rowcount > 0
+
+async def finish_generation_job(generation_id: int, owner: str):
+    async with async_session() as session:
+        await session.execute(
+            delete(GenerationJob).where(GenerationJob.generation_id == generation_id, GenerationJob.lease_owner == owner)
+        )
+        await session.commit()
+
 async def log_generation(user_id: int, model: str, prompt: str, ar: str, res: str, status: str = 'completed'):
     async with async_session() as session:
         gen = Generation(
@@ -155,13 +607,252 @@ async def log_generation(user_id: int, model: str, prompt: str, ar: str, res: st
         await session.commit()
         return gen.id
 
+async def get_generation(gen_id: int) -> Generation | None:
+    async with async_session() as session:
+        return await session.get(Generation, gen_id)
+
+# Статус генерации для HTTP API: строка задания (если еще в очереди) и место в очереди.
+# Место — число еще не взятых воркерами заданий, которые справедливая очередь выдаст раньше
+GENERATION_STATUS_SQL = text("""
+SELECT g.status, g.cost, g.model, g.result_hashes, j.status AS job_status,
+       CASE WHEN j.status = 'queued' THEN (
+           SELECT count(*) FROM generation_jobs q
+           WHERE q.status = 'queued' AND (q.virtual_finish, q.generation_id) < (j.virtual_finish, j.generation_id)
+       ) END AS position
+FROM generations g
+LEFT JOIN generation_jobs j ON j.generation_id = g.id
+WHERE g.id = :id AND g.user_id = :user_id
+""")
+
+async def get_generation_job_status(gen_id: int, user_id: int) -> dict | None:
+    """
+    Статус генерации пользователя: queued (в очереди, с местом), running, completed или failed.
+    None — такой генерации у пользователя нет.
+    """
+    async with async_session() as session:
+        row = (await session.execute(GENERATION_STATUS_SQL, {"id": gen_id, "user_id": user_id})).one_or_none()
+    if row is None:
+        return None
+    status = row.status
+    if status == 'pending':
+        # pending без строки задания — воркер уже завершает генерацию
+        status = 'queued' if row.job_status == 'queued' else 'running'
+    return {
+        "id": gen_id,
+        "status": status,
+        "position": row.position,
+        "model": row.model,
+        "cost": row.cost,
+        "results": len(row.result_hashes or []),
+    }
+
+async def set_generation_results(gen_id: int, hashes: list[str] | None = None, file_id: str | None = None):
+    """Ссылки на результат: хеши в result_store и/или file_id фото в Telegram (заданные значения)."""
+    values = {}
+    if hashes is not None:
+        values["result_hashes"] = hashes
+    if file_id is not None:
+        values["tg_file_id"] = file_id
+    if not values:
+        return
+    async with async_session() as session:
+        await session.execute(update(Generation).where(Generation.id == gen_id).values(**values))
+        await session.commit()
+
+async def get_generation_history(user_id: int, cursor: tuple[datetime, int] | None = None, older: bool = True,
+                                 limit: int = 1) -> list[Generation]:
+    """
+    Выполненные генерации пользователя по ключу (created_at, id), без OFFSET: страница
+    читается из индекса ix_generations_user_history за одинаковое время на любой глубине.
+    older=True — от новых к старым после `cursor`, False — к более новым (в порядке возрастания).
+    """
+    key = tuple_(Generation.created_at, Generation.id)
+    q = select(Generation).where(Generation.user_id == user_id, Generation.status == 'completed')
+    if cursor is not None:
+        bound = tuple_(literal(cursor[0]), literal(cursor[1]))
+        q = q.where(key < bound if older else key > bound)
+    if older:
+        q = q.order_by(Generation.created_at.desc(), Generation.id.desc())
+    else:
+        q = q.order_by(Generation.created_at, Generation.id)
+    async with async_session() as session:
+        return list((await session.execute(q.limit(limit))).scalars().all())
+
 async def update_generation_status(gen_id: int, status: str, tokens: int = 0):
     async with async_session() as session:
         gen = await session.get(Generation, gen_id)
         if gen:
             gen.status = status
             gen.tokens_used = tokens
+            await session.execute(select(func.pg_notify(STATUS_CHANNEL, str(gen_id))))
+            await session.commit()
+
+async def finish_generation(gen_id: int, status: str, tokens: int = 0, refund: int = 0) -> int | None:
+    """
+    Завершает pending-генерацию и возвращает `refund` NC одной транзакцией.
+    Уже завершенную (например, сверкой зависших) не трогает — двойного возврата не будет.
+    Возвращает баланс пользователя или None, если генерация уже не pending.
+    """
+    async with async_session() as session:
+        user_id = (await session.execute(
+            update(Generation)
+            .where(Generation.id == gen_id, Generation.status == 'pending')
+            .values(status=status, tokens_used=tokens, cost=Generation.cost - refund)
+            .returning(Generation.user_id)
+        )).scalar_one_or_none()
+        if user_id is None:
+            return None
+        balance = (await session.execute(
+            update(User).where(User.id == user_id).values(balance=User.balance + refund).returning(User.balance)
+        )).scalar_one()
+        await session.execute(select(func.pg_notify(STATUS_CHANNEL, str(gen_id))))
+        await session.commit()
+        return balance
+
+async def fail_completed_generation(gen_id: int, refund: int) -> int | None:
+    """
+    Генерация отмечена выполненной, но результат не доставлен: completed -> failed
+    и возврат `refund` NC одной транзакцией. Переход условный, поэтому повторный вызов
+    или генерация, уже возвращенная сверкой, второго возврата не дают.
+    Возвращает баланс пользователя или None, если генерация не в статусе completed.
+    """
+    async with async_session() as session:
+        user_id = (await session.execute(
+            update(Generation)
+            .where(Generation.id == gen_id, Generation.status == 'completed')
+            .values(status='failed', cost=Generation.cost - refund)
+            .returning(Generation.user_id)
+        )).scalar_one_or_none()
+        if user_id is None:
+            return None
+        balance = (await session.execute(
+            update(User).where(User.id == user_id).values(balance=User.balance + refund).returning(User.balance)
+        )).scalar_one()
+        await session.execute(select(func.pg_notify(STATUS_CHANNEL, str(gen_id))))
+        await session.commit()
+        return balance
+
+# Один батч сверки: зависшие pending-генерации без задания в очереди (процесс умер
+# до появления очереди или между возвратом и записью статуса). Помечаем failed и
+# возвращаем стоимость суммарно по пользователю. Стоимость старых записей без cost
+# оценивается по текущим ценам. SKIP LOCKED — не ждем строки, которые сейчас завершаются.
+RECONCILE_BATCH_SQL = text("""
+WITH stale AS (
+    SELECT g.id, g.user_id,
+           COALESCE(
+               g.cost,
+               (CAST(:prices AS jsonb) -> g.model ->> COALESCE(g.resolution, ''))::bigint,
+               (CAST(:prices AS jsonb) -> g.model ->> '')::bigint,
+               :default_price
+           ) AS refund
+    FROM generations g
+    WHERE g.status = 'pending'
+      AND g.created_at < :cutoff
+      AND NOT EXISTS (SELECT 1 FROM generation_jobs j WHERE j.generation_id = g.id)
+    ORDER BY g.created_at
+    LIMIT :batch_size
+    FOR UPDATE OF g SKIP LOCKED
+),
+failed AS (
+    UPDATE generations SET status = 'failed'
+    FROM stale WHERE generations.id = stale.id
+),
+refunds AS (
+    SELECT user_id, sum(refund) AS amount, count(*) AS generations FROM stale GROUP BY user_id
+),
+credited AS (
+    UPDATE users SET balance = users.balance + refunds.amount
+    FROM refunds WHERE users.id = refunds.user_id
+    RETURNING users.id, refunds.amount, refunds.generations, users.balance
+)
+SELECT (SELECT count(*) FROM stale) AS batch, credited.* FROM (SELECT 1) one LEFT JOIN credited ON true
+""")
+
+async def reconcile_stale_generations(cutoff: datetime, prices: dict, default_price: int,
+                                      batch_size: int = 1000) -> list[tuple[int, int, int, int]]:
+    """
+    Возвращает деньги за все зависшие pending-генерации старше `cutoff` батчами.
+    Возвращает [(user_id, сумма возврата, число генераций, новый баланс)].
+    """
+    params = {"cutoff": cutoff, "prices": json.dumps(prices), "default_price": default_price,
+              "batch_size": batch_size}
+    refunds = []
+    while True:
+        async with async_session() as session:
+            rows = (await session.execute(RECONCILE_BATCH_SQL, params)).all()
             await session.commit()
+        refunds += [(row.id, int(row.amount), row.generations, row.balance) for row in rows if row.id is not None]
+        if rows[0].batch < batch_size:
+            return refunds
+
+# --- Shared State (RUN_MODE bot/worker) ---
+
+async def get_fsm_record(key: str) -> tuple[str | None, dict]:
+    async with async_session() as session:
+        row = (await session.execute(select(FsmRecord.state, FsmRecord.data).where(FsmRecord.key == key))).one_or_none()
+        return (row.state, row.data) if row else (None, {})
+
+async def set_fsm_state(key: str, state: str | None):
+    async with async_session() as session:
+        await session.execute(
+            insert(FsmRecord).values(key=key, state=state, data={})
+            .on_conflict_do_update(index_elements=[FsmRecord.key], set_={"state": state, "updated_at": func.now()})
+        )
+        await session.commit()
+
+async def set_fsm_data(key: str, data: dict):
+    async with async_session() as session:
+        await session.execute(
+            insert(FsmRecord).values(key=key, data=data)
+            .on_conflict_do_update(index_elements=[FsmRecord.key], set_={"data": data, "updated_at": func.now()})
+        )
+        await session.commit()
+
+async def update_fsm_data(key: str, patch: dict) -> dict:
+    """Слияние данных одним оператором (jsonb ||): правки бота и воркера не затирают друг друга."""
+    stmt = insert(FsmRecord).values(key=key, data=patch)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[FsmRecord.key],
+        set_={"data": FsmRecord.data.op("||", return_type=JSONB)(stmt.excluded.data), "updated_at": func.now()}
+    ).returning(FsmRecord.data)
+    async with async_session() as session:
+        data = (await session.execute(stmt)).scalar_one()
+        await session.commit()
+        return data
+
+async def save_chat_history(chat_id: int, data: str):
+    async with async_session() as session:
+        await session.execute(
+            insert(ChatHistory).values(chat_id=chat_id, data=data)
+            .on_conflict_do_update(index_elements=[ChatHistory.chat_id], set_={"data": data, "updated_at": func.now()})
+        )
+        await session.commit()
+
+async def load_chat_history(chat_id: int, max_age: float) -> str | None:
+    """История чата, если к ней обращались не раньше `max_age` секунд назад (как TTL SessionStore)."""
+    async with async_session() as session:
+        data = await session.scalar(
+            update(ChatHistory)
+            .where(ChatHistory.chat_id == chat_id,
+                   ChatHistory.updated_at > func.now() - func.make_interval(0, 0, 0, 0, 0, 0, max_age))
+            .values(updated_at=func.now())
+            .returning(ChatHistory.data)
+        )
+        await session.commit()
+        return data
+
+async def delete_chat_history(chat_id: int):
+    async with async_session() as session:
+        await session.execute(delete(ChatHistory).where(ChatHistory.chat_id == chat_id))
+        await session.commit()
+
+async def delete_expired_chat_histories(max_age: float) -> int:
+    async with async_session() as session:
+        result = await session.execute(
+            delete(ChatHistory).where(ChatHistory.updated_at <= func.now() - func.make_interval(0, 0, 0, 0, 0, 0, max_age))
+        )
+        await session.commit()
+        return result.rowcount
 
 async def get_stats():
     async with async_session() as session:
@@ -0,0 +1,116 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime
+
+DELETE_MESSAGE = "delete_message"
+
+# Bot API deleteMessages принимает до 100 ID за вызов
+MAX_DELETE_BATCH = 100
+
+
+class DelayedActions:
+    """
+    Единый планировщик отложенных действий Telegram (сейчас — удаление сообщений).
+
+    Действия лежат в куче по времени срабатывания, их обслуживает одна задача,
+    которая живет, пока есть запланированное, и просыпается только к ближайшему
+    сроку. Все, что созрело в пределах `coalesce` секунд, выполняется пачкой:
+    удаления группируются по чату в один вызов `delete_messages`.
+
+    Если задан `store` (модуль database), действия сохраняются в таблицу
+    scheduled_actions и после рестарта подхватываются через `restore()`, так что
+    временные сообщения не остаются в чате после деплоя. Ошибки хранилища только
+    логируются: планировщик продолжает работать в памяти.
+    """
+
+    def __init__(self, bot, store=None, coalesce: float = 0.5, clock=time.time):
+        self.bot = bot
+        self.store = store
+        self.coalesce = coalesce
+        self._clock = clock
+        # (due_at, seq, action, chat_id, message_id)
+        self._heap: list[tuple] = []
+        self._seq = itertools.count()
+        self._unsaved: set[tuple] = set()
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._heap)
+
+    def delete_message(self, chat_id: int, message_id: int, delay: float):
+        """Удалить сообщение через `delay` секунд."""
+        self._schedule(DELETE_MESSAGE, chat_id, message_id, self._clock() + delay, persist=True)
+
+    def _schedule(self, action: str, chat_id: int, message_id: int, due_at: float, persist: bool):
+        item = (due_at, next(self._seq), action, chat_id, message_id)
+        heapq.heappush(self._heap, item)
+        if persist and self.store is not None:
+            self._unsaved.add(item)
+        self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def restore(self) -> int:
+        """Подхватывает сохраненные действия; просроченные выполняются сразу. Возвращает их число."""
+        rows = await self.store.load_scheduled_actions()
+        for action, chat_id, message_id, due_at in rows:
+            self._schedule(action, chat_id, message_id, due_at.timestamp(), persist=False)
+        return len(rows)
+
+    async def _run(self):
+        while self._heap:
+            if self._unsaved:
+                await self._persist()
+            delay = self._heap[0][0] - self._clock()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._flush()
+
+    async def _persist(self):
+        items = list(self._unsaved)
+        self._unsaved.clear()
+        rows = [(action, chat_id, message_id, datetime.fromtimestamp(due_at))
+                for due_at, _, action, chat_id, message_id in items]
+        try:
+            await self.store.save_scheduled_actions(rows)
+        except Exception as e:
+            logging.error(f"Failed to persist {len(rows)} delayed actions: {e}")
+
+    async def _flush(self):
+        horizon = self._clock() + self.coalesce
+        due = []
+        while self._heap and self._heap[0][0] <= horizon:
+            due.append(heapq.heappop(self._heap))
+
+        by_chat = defaultdict(list)
+        for _, _, action, chat_id, message_id in due:
+            by_chat[(action, chat_id)].append(message_id)
+        for (action, chat_id), message_ids in by_chat.items():
+            for start in range(0, len(message_ids), MAX_DELETE_BATCH):
+                try:
+                    await self.bot.delete_messages(chat_id=chat_id, message_ids=message_ids[start:start + MAX_DELETE_BATCH])
+                except Exception as e:
+                    # Сообщение уже удалено пользователем или слишком старое
+                    logging.debug(f"Delayed {action} in chat {chat_id} failed: {e}")
+
+        if self.store is None:
+            return
+        # Еще не сохраненные выполнены до записи — сохранять и удалять их не нужно
+        persisted = [item for item in due if item not in self._unsaved]
+        self._unsaved.difference_update(due)
+        if persisted:
+            try:
+                await self.store.delete_scheduled_actions([(action, chat_id, message_id) for _, _, action, chat_id, message_id in persisted])
+            except Exception as e:
+                logging.error(f"Failed to drop {len(persisted)} delayed actions: {e}")
@@ -0,0 +1,108 @@
+import asyncio
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+
+
+class FairQueue:
+    """
+    Взвешенная справедливая очередь к провайдеру генерации.
+
+    Одновременно выполняется не больше `concurrency` генераций. Когда мест нет,
+    следующий слот получает класс тарифа с наименьшим «проходом» (stride scheduling):
+    класс с весом w продвигается на 1/w за каждую выданную генерацию, поэтому
+    при постоянной нагрузке доли классов пропорциональны весам. Внутри класса
+    пользователи обслуживаются по кругу, так что один активный пользователь
+    не вытесняет остальных.
+    """
+
+    def __init__(self, weights: dict[str, float], concurrency: int, default_class: str = "demo"):
+        self.weights = weights
+        self.concurrency = concurrency
+        self.default_class = default_class
+        self.running = 0
+        self._passes: dict[str, float] = {}
+        self._virtual_time = 0.0
+        # класс -> OrderedDict(user_id -> deque[Future])
+        self._queues: dict[str, OrderedDict] = {}
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(waiters) for users in self._queues.values() for waiters in users.values())
+
+    def _class_for(self, tariff: str) -> str:
+        return tariff if tariff in self.weights else self.default_class
+
+    def _enqueue(self, cls: str, user_id: int) -> asyncio.Future:
+        users = self._queues.setdefault(cls, OrderedDict())
+        if not users:
+            # Класс простаивал: не даем ему накопить «кредит» за время простоя
+            self._passes[cls] = max(self._passes.get(cls, 0.0), self._virtual_time)
+        waiter = asyncio.get_running_loop().create_future()
+        users.setdefault(user_id, deque()).append(waiter)
+        return waiter
+
+    def _remove(self, cls: str, user_id: int, waiter: asyncio.Future):
+        users = self._queues.get(cls)
+        if not users or user_id not in users:
+            return
+        waiters = users[user_id]
+        if waiter in waiters:
+            waiters.remove(waiter)
+        if not waiters:
+            del users[user_id]
+
+    def _pop_next(self) -> asyncio.Future | None:
+        active = [cls for cls, users in self._queues.items() if users]
+        if not active:
+            return None
+        cls = min(active, key=lambda c: self._passes.get(c, 0.0))
+        self._virtual_time = self._passes.get(cls, 0.0)
+        self._passes[cls] = self._virtual_time + 1.0 / self.weights.get(cls, 1.0)
+
+        users = self._queues[cls]
+        user_id, waiters = next(iter(users.items()))
+        waiter = waiters.popleft()
+        # Круговой обход: пользователь с оставшимися запросами уходит в конец
+        del users[user_id]
+        if waiters:
+            users[user_id] = waiters
+        return waiter
+
+    def _dispatch(self):
+        while self.running < self.concurrency:
+            waiter = self._pop_next()
+            if waiter is None:
+                return
+            if waiter.done():
+                continue
+            self.running += 1
+            waiter.set_result(None)
+
+    async def acquire(self, tariff: str, user_id: int):
+        cls = self._class_for(tariff)
+        if self.running < self.concurrency and not self.waiting:
+            self.running += 1
+            return
+        waiter = self._enqueue(cls, user_id)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Слот уже выдан, но ожидающий отменен — возвращаем слот
+                self.release()
+            else:
+                self._remove(cls, user_id, waiter)
+            raise
+
+    def release(self):
+        self.running -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, tariff: str, user_id: int):
+        """Контекст, внутри которого выполняется запрос к провайдеру."""
+        await self.acquire(tariff, user_id)
+        try:
+            yield
+        finally:
+            self.release()
@@ -0,0 +1,45 @@
+from typing import Any, Mapping
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+
+import database
+
+
+class PgStorage(BaseStorage):
+    """
+    Хранилище FSM aiogram в Postgres (таблица fsm_states).
+
+    Нужно в режиме раздельных процессов: состояние пользователя ставит и бот
+    (обработчики), и воркер (после доставки результата включает режим диалога),
+    поэтому MemoryStorage одного процесса не подходит. Ключ строится так же, как
+    в RedisStorage aiogram. `update_data` сливает данные в БД одним оператором,
+    без чтения и записи всего словаря.
+    """
+
+    def __init__(self, store=database, key_builder: DefaultKeyBuilder | None = None):
+        self.store = store
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+
+    def _key(self, key: StorageKey) -> str:
+        return self.key_builder.build(key)
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self.store.set_fsm_state(self._key(key), state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        state, _ = await self.store.get_fsm_record(self._key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        await self.store.set_fsm_data(self._key(key), dict(data))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        _, data = await self.store.get_fsm_record(self._key(key))
+        return dict(data)
+
+    async def update_data(self, key: StorageKey, data: Mapping[str, Any]) -> dict[str, Any]:
+        return await self.store.update_fsm_data(self._key(key), dict(data))
+
+    async def close(self) -> None:
+        pass
@@ -0,0 +1,142 @@
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+
+from aiohttp import web
+
+
+class LoopLagMonitor:
+    """
+    Задержка event loop: насколько позже запланированного просыпается `sleep(interval)`.
+    Долгий синхронный код (CPU, блокирующий ввод-вывод) виден здесь раньше, чем в таймаутах.
+    Хранится `window` последних замеров.
+    """
+
+    def __init__(self, interval: float = 0.5, window: int = 20, clock=time.monotonic):
+        self.interval = interval
+        self._clock = clock
+        self._samples: deque = deque(maxlen=window)
+
+    async def run(self):
+        while True:
+            started = self._clock()
+            await asyncio.sleep(self.interval)
+            self.record(max(0.0, self._clock() - started - self.interval))
+
+    def record(self, lag: float):
+        self._samples.append(lag)
+
+    @property
+    def lag(self) -> float:
+        """Последний замер (сек)."""
+        return self._samples[-1] if self._samples else 0.0
+
+    @property
+    def max_lag(self) -> float:
+        """Худший замер в окне (сек)."""
+        return max(self._samples, default=0.0)
+
+
+class HealthChecks:
+    """
+    Эндпоинты `/healthz` и `/readyz` для docker-compose, оркестратора и балансировщика.
+
+    /healthz — жив ли процесс: event loop не завис (задержка не больше `max_loop_lag`).
+    /readyz — можно ли слать трафик: все проверки из `add` выполняются параллельно
+    с таймаутом `timeout`. Отказ критической проверки — 503 («fail», снять с балансировки).
+    Отказ некритической — 200 со статусом «degraded»: например, автомат модели хранится
+    в памяти процесса, но открывается из-за отказов внешнего API, которые видят и соседние
+    экземпляры, — переключение на соседний не поможет.
+
+    Проверка — `async probe() -> dict | None` (подробности в ответ); исключение или
+    `{"ok": False, ...}` — отказ. С `ttl` успешный результат кешируется: частые пробы
+    балансировщика не превращаются в такой же поток запросов к внешнему API, а отказ
+    перепроверяется сразу, чтобы восстановление было видно без задержки.
+    """
+
+    def __init__(self, lag_monitor: LoopLagMonitor, max_loop_lag: float = 1.0, timeout: float = 2.0,
+                 clock=time.monotonic):
+        self.lag_monitor = lag_monitor
+        self.max_loop_lag = max_loop_lag
+        self.timeout = timeout
+        self._clock = clock
+        self._started = clock()
+        self._checks: dict[str, tuple] = {}  # name -> (probe, critical, ttl)
+        self._cache: dict[str, tuple[float, dict]] = {}  # name -> (время проверки, результат)
+        self._runner: web.AppRunner | None = None
+
+    def add(self, name: str, probe, critical: bool = True, ttl: float = 0):
+        self._checks[name] = (probe, critical, ttl)
+
+    def _loop(self) -> dict:
+        return {
+            "ok": self.lag_monitor.max_lag <= self.max_loop_lag,
+            "lag_ms": round(self.lag_monitor.lag * 1000, 1),
+            "max_lag_ms": round(self.lag_monitor.max_lag * 1000, 1),
+        }
+
+    async def _run(self, name: str, probe, ttl: float) -> dict:
+        cached = self._cache.get(name)
+        if cached and self._clock() - cached[0] < ttl:
+            return cached[1]
+        started = time.perf_counter()
+        try:
+            details = await asyncio.wait_for(probe(), self.timeout) or {}
+            result = {"ok": True, **details}
+        except asyncio.TimeoutError:
+            result = {"ok": False, "error": f"timeout after {self.timeout:.1f}s"}
+        except Exception as e:
+            result = {"ok": False, "error": str(e) or type(e).__name__}
+        result["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        if result["ok"]:
+            self._cache[name] = (self._clock(), result)
+        else:
+            logging.warning(f"Health check {name} failed: {result.get('error', result)}")
+        return result
+
+    async def liveness(self) -> tuple[bool, dict]:
+        loop = self._loop()
+        return loop["ok"], {
+            "status": "ok" if loop["ok"] else "fail",
+            "uptime": round(self._clock() - self._started),
+            "event_loop": loop,
+        }
+
+    async def readiness(self) -> tuple[bool, dict]:
+        names = list(self._checks)
+        results = await asyncio.gather(*(self._run(name, probe, ttl) for name, (probe, _, ttl) in self._checks.items()))
+        checks = {"event_loop": self._loop(), **dict(zip(names, results))}
+        ready = checks["event_loop"]["ok"] and all(
+            checks[name]["ok"] for name, (_, critical, _) in self._checks.items() if critical)
+        status = "fail" if not ready else ("ok" if all(c["ok"] for c in checks.values()) else "degraded")
+        return ready, {"status": status, "checks": checks}
+
+    @staticmethod
+    def _respond(ok: bool, data: dict) -> web.Response:
+        return web.Response(body=json.dumps(data, ensure_ascii=False).encode(), status=200 if ok else 503,
+                            content_type="application/json", headers={"Cache-Control": "no-store"})
+
+    async def healthz(self, request: web.Request) -> web.Response:
+        return self._respond(*await self.liveness())
+
+    async def readyz(self, request: web.Request) -> web.Response:
+        return self._respond(*await self.readiness())
+
+    def add_routes(self, app: web.Application):
+        app.router.add_get("/healthz", self.healthz)
+        app.router.add_get("/readyz", self.readyz)
+
+    async def start(self, host: str, port: int):
+        """Отдельный сервер только с проверками — для процессов без HTTP API (воркеры)."""
+        app = web.Application()
+        self.add_routes(app)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logging.info(f"Health checks listening on {host}:{port}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
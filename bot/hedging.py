@@ -0,0 +1,92 @@
+import asyncio
+import time
+from collections import deque
+
+
+class LatencyTracker:
+    """Скользящая выборка длительностей успешных вызовов для одной модели."""
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples: deque = deque(maxlen=size)
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+
+    def percentile(self, q: float) -> float | None:
+        """Перцентиль q (0..1) или None, пока данных недостаточно."""
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(len(ordered) - 1, int(q * len(ordered)))
+        return ordered[index]
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+
+class HedgeBudget:
+    """
+    Лимит дополнительных запросов: каждый основной запрос начисляет `ratio`
+    кредита (не больше `burst`), каждый хедж тратит один кредит.
+    При ratio=0.1 дублируется не более ~10% запросов.
+    """
+
+    def __init__(self, ratio: float = 0.1, burst: float = 5.0):
+        self.ratio = ratio
+        self.burst = burst
+        self.credit = 0.0
+        self.spent = 0
+
+    def on_request(self):
+        self.credit = min(self.burst, self.credit + self.ratio)
+
+    def try_spend(self) -> bool:
+        if self.credit < 1.0:
+            return False
+        self.credit -= 1.0
+        self.spent += 1
+        return True
+
+
+def _silence(task: asyncio.Future):
+    # Проигравший запрос игнорируется: забираем исключение, чтобы не было
+    # предупреждения "Task exception was never retrieved"
+    if not task.cancelled():
+        task.exception()
+
+
+async def hedged(fn, delay: float, budget: HedgeBudget, tracker: LatencyTracker | None = None, clock=time.monotonic):
+    """
+    Выполняет `await fn()`; если ответа нет дольше `delay` секунд и бюджет позволяет,
+    запускает второй такой же запрос и возвращает результат того, кто ответит первым.
+    Ошибка возвращается только если упали оба запроса.
+    """
+    budget.on_request()
+
+    async def timed():
+        started = clock()
+        result = await fn()
+        if tracker is not None:
+            tracker.record(clock() - started)
+        return result
+
+    primary = asyncio.ensure_future(timed())
+    done, _ = await asyncio.wait({primary}, timeout=delay)
+    if done or not budget.try_spend():
+        return await primary
+
+    backup = asyncio.ensure_future(timed())
+    pending = {primary, backup}
+    first_error = None
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is None:
+                for other in pending:
+                    other.add_done_callback(_silence)
+                    other.cancel()
+                return task.result()
+            if first_error is None:
+                first_error = task.exception()
+    raise first_error
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+import os
+import socket
+import uuid
+from dataclasses import dataclass
+
+
+@dataclass
+class Job:
+    id: int  # generations.id
+    attempts: int
+    payload: dict
+
+
+def worker_owner() -> str:
+    """Уникальное имя процесса-владельца аренды: видно в БД, чей воркер держит задание."""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+class JobWorkers:
+    """
+    Воркеры очереди генераций на таблице generation_jobs.
+
+    Каждый из `workers` циклов забирает задание через `claim_generation_job`
+    (FOR UPDATE SKIP LOCKED — несколько процессов на разных хостах не получат
+    одно задание дважды) и держит его под арендой `lease` секунд, продлевая ее
+    heartbeat-ом. Если процесс упал, аренда истекает и задание забирает другой
+    воркер. Задание, забранное больше `max_attempts` раз (падает вместе с
+    процессом), не выполняется, а передается в `give_up`.
+
+    `handler(job)` и `give_up(job)` сами отвечают пользователю и возвращают деньги
+    при ошибке; после них задание удаляется из очереди. Свободные воркеры ждут
+    `notify()` из этого процесса или опрашивают БД раз в `poll_interval` секунд.
+    """
+
+    def __init__(self, store, handler, give_up, workers: int, lease: float, max_attempts: int,
+                 poll_interval: float = 1.0, owner: str | None = None):
+        self.store = store
+        self.handler = handler
+        self.give_up = give_up
+        self.workers = workers
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.owner = owner or worker_owner()
+        self.busy = 0
+        self._wakeup = asyncio.Event()
+
+    def notify(self):
+        """Новое задание в очереди — разбудить свободных воркеров без ожидания опроса."""
+        self._wakeup.set()
+
+    async def run(self):
+        await asyncio.gather(*(self._worker() for _ in range(self.workers)))
+
+    async def _worker(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                job = await self.store.claim_generation_job(self.owner, self.lease)
+            except Exception as e:
+                logging.error(f"Job claim failed: {e}")
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._process(job)
+
+    async def _heartbeat(self, job: Job):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                if not await self.store.extend_generation_job_lease(job.id, self.owner, self.lease):
+                    logging.warning(f"Job {job.id}: lease lost")
+                    return
+            except Exception as e:
+                logging.error(f"Job {job.id}: heartbeat failed: {e}")
+
+    async def _process(self, job: Job):
+        self.busy += 1
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+        try:
+            if job.attempts > self.max_attempts:
+                logging.error(f"Job {job.id}: giving up after {job.attempts - 1} attempts")
+                await self.give_up(job)
+            else:
+                await self.handler(job)
+        except Exception as e:
+            logging.error(f"Job {job.id} failed: {e}")
+        finally:
+            heartbeat.cancel()
+            self.busy -= 1
+        try:
+            await self.store.finish_generation_job(job.id, self.owner)
+        except Exception as e:
+            # Задание останется в очереди и после истечения аренды будет выполнено повторно
+            logging.error(f"Job {job.id}: failed to finish: {e}")
@@ -0,0 +1,42 @@
+import asyncio
+import logging
+import time
+
+# Сколько уведомлений в секунду отправлять при массовой рассылке из фоновых задач
+# (общий лимит Telegram — около 30 сообщений в секунду на бота)
+NOTIFY_RATE = 20
+
+
+async def run_periodic(name: str, job, interval: float, sleep=asyncio.sleep):
+    """
+    Выполняет `job()` сразу и затем каждые `interval` секунд.
+    Ошибка одного прогона логируется и не останавливает расписание.
+    """
+    while True:
+        started = time.monotonic()
+        try:
+            await job()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Job {name} failed: {e}")
+        else:
+            logging.debug(f"Job {name} finished in {time.monotonic() - started:.2f}s")
+        await sleep(interval)
+
+
+async def notify_users(bot, user_ids: list[int], text, rate: float = NOTIFY_RATE, sleep=asyncio.sleep) -> int:
+    """
+    Отправляет сообщение списку пользователей не быстрее `rate` в секунду.
+    `text` — строка или функция user_id -> строка (персональный текст).
+    Недоставленные (бот заблокирован, чат удален) пропускаются. Возвращает число доставленных.
+    """
+    delivered = 0
+    for user_id in user_ids:
+        try:
+            await bot.send_message(user_id, text(user_id) if callable(text) else text)
+            delivered += 1
+        except Exception as e:
+            logging.info(f"Notification to {user_id} skipped: {e}")
+        await sleep(1 / rate)
+    return delivered
@@ -0,0 +1,128 @@
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardMarkup, KeyboardButton
+from pricing import TARIFFS, MODEL_PRICES, MODEL_DISPLAY, RESOLUTION_SURCHARGES
+
+# Клавиатуры и тексты меню вынесены из main.py, чтобы их можно было
+# переиспользовать и измерять (см. tests/test_benchmarks.py) без запуска бота.
+
+def get_main_menu(tariff: str, balance: int | None = None):
+    profile_label = "👤 Мой кабинет"
+    if balance is not None:
+        profile_label += f" ({balance} NC)"
+    tariff_label = "💎 Тарифы"
+    if tariff:
+        tariff_label += f" ({tariff.upper()})"
+    kb = [
+        [KeyboardButton(text="🎨 К созданию")],
+        [KeyboardButton(text=profile_label), KeyboardButton(text=tariff_label)],
+        [KeyboardButton(text="❓ Помощь")]
+    ]
+    return ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True, one_time_keyboard=True)
+
+def get_minimal_menu():
+    """Короткая клавиатура с одной кнопкой «Главное меню»."""
+    kb = [
+        [KeyboardButton(text="🏠 Главное меню")]
+    ]
+    return ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True, one_time_keyboard=True)
+
+def get_creation_menu():
+    return ReplyKeyboardMarkup(
+        keyboard=[
+            [KeyboardButton(text="⚡ Flash"), KeyboardButton(text="🍌 Pro")],
+            [KeyboardButton(text="📸 Imagen")],
+            [KeyboardButton(text="🔙 Назад")]
+        ],
+        resize_keyboard=True,
+        input_field_placeholder="Выберите модель"
+    )
+
+def get_cancel_menu():
+    return ReplyKeyboardMarkup(
+        keyboard=[
+            [KeyboardButton(text="❌ Отмена")]
+        ],
+        resize_keyboard=True,
+        one_time_keyboard=True
+    )
+
+def build_config_menu(model: str, ar: str, res: str, tariff: str) -> tuple[str, InlineKeyboardMarkup]:
+    """
+    Собирает текст и inline-клавиатуру меню настройки генерации.
+    Чистая функция: не обращается к Telegram и FSM.
+    """
+    meta = MODEL_DISPLAY.get(model, {})
+    price_base = MODEL_PRICES.get(model, 0)
+    supports_res = meta.get("supports_resolution", False)
+    supports_dialogue = meta.get("supports_dialogue", False)
+
+    # Calculate Cost
+    surcharge = 0
+    if supports_res and res in RESOLUTION_SURCHARGES:
+        surcharge = RESOLUTION_SURCHARGES.get(res, 0)
+
+    total_cost = price_base + surcharge
+
+    # Build Text
+    text = (
+        f"⚙️ **Настройка генерации**\n\n"
+        f"🧠 Модель: **{meta.get('name', model)}**\n"
+        f"📐 AR: **{ar}**\n"
+    )
+
+    if supports_res:
+        text += f"🔍 Качество: **{res}**\n"
+
+    text += f"\n💰 Стоимость: **{total_cost} NC**\n"
+
+    if supports_dialogue:
+        text += "💬 **Поддерживает режим диалога**\n"
+
+    text += "\n✏️ **Введите промпт:**\nПросто напишите, что хотите увидеть.\n"
+
+    # Build markup
+    markup = InlineKeyboardMarkup(inline_keyboard=[])
+
+    # AR Row (Aspect Ratio)
+    ar_row = []
+    # AR options: для Imagen ограничиваемся допустимыми
+    imagen_ar_options = ["1:1", "3:4", "4:3", "9:16", "16:9"]
+    ar_options = imagen_ar_options if meta.get('family') == 'imagen' else ["1:1", "16:9", "9:16", "4:3", "3:4", "21:9", "9:21"]
+    for ratio in ar_options:
+        label = ratio
+        if ratio == ar:
+            label = f"✅ {ratio}"
+        ar_row.append(InlineKeyboardButton(text=label, callback_data=f"create:config:ar:{ratio}"))
+    markup.inline_keyboard.append(ar_row)
+
+    # Res Row (Only if supported)
+    if supports_res:
+        res_row = []
+        # Для Imagen используем 1K/2K; для остальных — прежние
+        options = ["1K", "2K"] if meta.get('family') == 'imagen' else ["1024x1024", "2K", "4K"]
+
+        user_tariff_rules = TARIFFS.get(tariff, TARIFFS['demo'])
+        can_high_res = user_tariff_rules.get('can_use_2k_4k', False)
+
+        for opt in options:
+            opt_label = "SD" if opt in ["1024x1024", "1K"] else opt
+            if opt in RESOLUTION_SURCHARGES:
+                 opt_label += f" (+{RESOLUTION_SURCHARGES[opt]} NC)"
+
+            is_locked = False
+            if opt in ["2K", "4K"] and not can_high_res and tariff != 'admin':
+                is_locked = True
+
+            if is_locked:
+                 opt_label = f"🔒 {opt_label}"
+
+            if opt == res and not is_locked:
+                opt_label = f"✅ {opt_label}"
+
+            res_row.append(InlineKeyboardButton(text=opt_label, callback_data=f"create:config:res:{opt}"))
+        markup.inline_keyboard.append(res_row)
+
+    # No "Enter Prompt" button anymore!
+    meta_fam = meta.get('family', 'banana')
+    markup.inline_keyboard.append([InlineKeyboardButton(text="⬅️ Назад к списку", callback_data=f"create:family:{meta_fam}")])
+
+    return text, markup
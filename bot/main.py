@@ -1,18 +1,46 @@
+import time
+# Отметка до остальных импортов: их время попадает в лог этапов запуска
+_import_started = time.perf_counter()
+
 import asyncio
 import logging
 from aiogram import Bot, Dispatcher, types
-from aiogram.types import WebAppInfo, BufferedInputFile, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, ReplyKeyboardMarkup, KeyboardButton
+from aiogram.types import WebAppInfo, BufferedInputFile, InputMediaPhoto, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
 from aiogram.filters import CommandStart, Command
 from aiogram import F
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
 import json
-from datetime import datetime
+from dataclasses import dataclass
+from datetime import datetime, timedelta
 from config import config
-from database import init_db, add_or_update_user, get_user, update_user_access, log_generation, get_stats, get_all_users_stats, update_generation_status, get_user_balance, update_balance, set_user_tariff, User, Generation, async_session
+from database import init_db, submit_generation_job, downgrade_expired_tariffs, grant_monthly_nc, create_broadcast, get_broadcast, get_recent_broadcasts, get_running_broadcasts, cancel_broadcast, add_or_update_user, get_user, update_user_access, get_stats, get_all_users_stats, finish_generation, fail_completed_generation, reconcile_stale_generations, get_generation, get_generation_history, set_generation_results, save_chat_history, load_chat_history, delete_chat_history, delete_expired_chat_histories, get_user_balance, update_balance, set_user_tariff, User, Generation, async_session
 from sqlalchemy import select, func
 from nano_service import nano_service
-from pricing import calculate_cost, validate_request, TARIFFS, PACKAGES, MODEL_PRICES, RUB_TO_NC, MODEL_DISPLAY, ASPECT_RATIOS, RESOLUTION_SURCHARGES
+from pricing import calculate_cost, price_table, DEFAULT_PRICE, validate_request, watch_pricing_file, TARIFFS, PACKAGES, MODEL_PRICES, MODEL_DISPLAY, MODEL_QUOTAS, TARIFF_WEIGHTS
+from keyboards import get_main_menu, get_minimal_menu, get_cancel_menu, build_config_menu
+from prompt_options import parse_prompt_options, PromptOptionError
+from session_store import SessionStore
+from rate_limit import RateLimiter
+from fair_queue import FairQueue
+from progress import StatusUpdater, progress_line
+from jobs import run_periodic, notify_users
+from broadcast import Broadcaster
+from media_groups import MediaGroupCollector
+from delayed_actions import DelayedActions
+from job_queue import Job, JobWorkers
+from fsm_storage import PgStorage
+from result_store import create_result_store, RESULT_HASH_RE
+from api import ApiError, WebApi
+from uploads import ChunkedUploads
+from startup import StartupPhases, wait_ready
+from health import HealthChecks, LoopLagMonitor
+from resilience import CircuitBreaker
+import database
+
+startup_phases = StartupPhases(started=_import_started)
+startup_phases.mark("imports")
 
 
 # Configure logging
@@ -20,26 +48,81 @@ logging.basicConfig(level=logging.INFO)
 
 # Initialize Bot and Dispatcher
 bot = Bot(token=config.BOT_TOKEN.get_secret_value())
-dp = Dispatcher()
+# Раздельные процессы (RUN_MODE bot/worker): состояние FSM и история диалогов — в Postgres, общие для всех
+SPLIT_MODE = config.RUN_MODE != "all"
+dp = Dispatcher(storage=PgStorage()) if SPLIT_MODE else Dispatcher()
+
+# Ограничение частоты запросов к провайдеру (общие квоты моделей + персональные лимиты тарифов)
+rate_limiter = RateLimiter(MODEL_QUOTAS, TARIFFS)
+# Модели вызываются в этом процессе (RUN_MODE all/worker): только здесь автоматы и квоты моделей
+# видят сбои и фактический расход. Процесс бота (RUN_MODE=bot) проверяет лишь персональные лимиты
+RUNS_JOBS = config.RUN_MODE != "bot"
+# Взвешенная очередь генераций по тарифам (веса — TARIFF_WEIGHTS в pricing.py)
+generation_queue = FairQueue(TARIFF_WEIGHTS, concurrency=config.GEN_MAX_CONCURRENCY)
 
 # --- Auth Logic ---
 
 ADMIN_IDS = [int(id.strip()) for id in config.ADMIN_IDS.split(",")]
 
-async def enforce_tariff_expiry(user: User | None, message: types.Message) -> User | None:
+TARIFF_EXPIRED_TEXT = "⏳ Срок вашей подписки истёк. Тариф переключен на DEMO."
+
+async def sweep_expired_tariffs():
     """
-    Если срок тарифа истёк и это не demo/admin — даунгрейдим до DEMO и уведомляем.
+    Фоновая задача: переводит истекшие подписки на DEMO одним UPDATE и уведомляет пользователей.
+    Обработчики сообщений срок тарифа не проверяют.
     """
-    if not user:
-        return user
-    if user.tariff_expires_at and user.tariff not in ["demo", "admin"]:
-        if datetime.now() >= user.tariff_expires_at:
-            await set_user_tariff(user.id, "demo", days=None)
-            await update_user_access(user.id, "demo")
-            user.tariff = "demo"
-            user.tariff_expires_at = None
-            await message.answer("⏳ Срок вашей подписки истёк. Тариф переключен на DEMO.")
-    return user
+    user_ids = await downgrade_expired_tariffs()
+    if user_ids:
+        logging.info(f"Tariff expiry: {len(user_ids)} users downgraded to demo")
+        await notify_users(bot, user_ids, TARIFF_EXPIRED_TEXT)
+
+async def grant_monthly_nc_job():
+    """
+    Фоновая задача: начисляет monthly_nc подписчикам за текущий цикл подписки
+    (30 дней от ее начала). Повторные прогоны начисляют только тем, у кого начался новый цикл.
+    """
+    amounts = {tariff: rules.get("monthly_nc", 0) for tariff, rules in TARIFFS.items()}
+    granted = await grant_monthly_nc(amounts, batch_size=config.NC_GRANT_BATCH)
+    if granted:
+        logging.info(f"Monthly NC: {granted} grants")
+
+async def run_broadcast(broadcast):
+    """Фоновая задача рассылки: продолжает с сохраненного курсора и отчитывается автору."""
+    broadcaster = Broadcaster(bot, database, rate=config.BROADCAST_RATE, batch_size=config.BROADCAST_BATCH)
+    try:
+        result = await broadcaster.run(broadcast)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logging.error(f"Broadcast {broadcast.id} stopped: {e}")
+        return
+    logging.info(f"Broadcast {broadcast.id} {result.status}: {result}")
+    try:
+        await bot.send_message(broadcast.created_by, format_broadcast(broadcast.id, result))
+    except Exception as e:
+        logging.error(f"Broadcast {broadcast.id}: failed to send report to {broadcast.created_by}: {e}")
+
+def format_broadcast(broadcast_id: int, item) -> str:
+    return (
+        f"📣 Рассылка #{broadcast_id}: {item.status}\n"
+        f"Доставлено: {item.delivered}, заблокировали бота: {item.blocked}, ошибок: {item.failed}"
+    )
+
+async def reconcile_stale_generations_job():
+    """
+    Фоновая задача (и первый прогон при старте): возвращает NC за генерации, зависшие
+    в pending без задания в очереди дольше GEN_STALE_AFTER, и сообщает пользователям.
+    """
+    cutoff = datetime.now() - timedelta(seconds=config.GEN_STALE_AFTER)
+    refunds = await reconcile_stale_generations(cutoff, price_table(), DEFAULT_PRICE)
+    if not refunds:
+        return
+    logging.warning(f"Reconciler: refunded {sum(r[2] for r in refunds)} stale generations for {len(refunds)} users")
+    texts = {
+        user_id: f"💰 Генерация не была завершена из-за сбоя. Возвращено {amount} NC. Баланс: {balance} NC"
+        for user_id, amount, _, balance in refunds
+    }
+    await notify_users(bot, list(texts), texts.get)
 
 async def check_access(user_id: int, model: str) -> bool:
     user = await get_user(user_id)
@@ -84,9 +167,6 @@ async def cmd_start(message: types.Message):
         message.from_user.username, 
         message.from_user.full_name
     )
-
-    # Проверка истечения тарифа с авто-даунгрейдом и уведомлением
-    user = await enforce_tariff_expiry(user, message)
     
     # If admin
     if message.from_user.id in ADMIN_IDS:
@@ -199,7 +279,9 @@ async def process_admin_callback(callback: CallbackQuery, state: FSMContext):
             "`/set_access [ID] [level]`\n"
             "Levels: `full`, `basic`, `demo`, `banned`\n\n"
             "💰 **Финансы:**\n"
-            "`/add_nc [ID] [amount]` - Выдать валюту"
+            "`/add_nc [ID] [amount]` - Выдать валюту\n\n"
+            "🖼 **Результаты:**\n"
+            "`/result [generation_id]` - Прислать сохраненный результат генерации"
         )
         await callback.message.answer(help_text, parse_mode="Markdown")
         await callback.answer()
@@ -356,12 +438,34 @@ async def process_admin_manage_callback(callback: CallbackQuery, state: FSMConte
         else:
             await callback.answer("User not found")
 
-async def delete_message_delayed(message: types.Message, delay: int):
-    await asyncio.sleep(delay)
+# Сильные ссылки на фоновые задачи: иначе event loop держит их только слабо,
+# и незавершенная задача может быть собрана GC
+background_tasks: set[asyncio.Task] = set()
+
+def spawn(coro) -> asyncio.Task:
+    """Запускает фоновую задачу и хранит ссылку на нее до завершения."""
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+# Все отложенные действия (временные «✅»-сообщения и т.п.) — в одном планировщике,
+# с сохранением в БД, чтобы после деплоя они не оставались в чате
+delayed_actions = DelayedActions(bot, store=database)
+
+# Результаты генераций (None — не сохраняются, RESULT_STORE=none)
+result_store = create_result_store(config)
+
+async def record_results(gen_id: int, images: list[bytes], file_id: str | None):
+    """
+    Сохраняет результаты в result_store и ссылается на них из generations вместе с file_id
+    отправленного фото (для истории). Выполняется в фоне и доставку не задерживает.
+    """
     try:
-        await message.delete()
-    except:
-        pass
+        hashes = [await result_store.put(image) for image in images] if result_store is not None else None
+        await set_generation_results(gen_id, hashes, file_id)
+    except Exception as e:
+        logging.error(f"Failed to record results of generation {gen_id}: {e}")
 
 @dp.callback_query(F.data.startswith("admin:set_tariff:"))
 async def process_admin_set_tariff(callback: CallbackQuery):
@@ -375,7 +479,7 @@ async def process_admin_set_tariff(callback: CallbackQuery):
     
     # Send temp notification
     msg = await callback.message.answer(f"✅ Тариф пользователя {user_id} изменен на **{tariff.upper()}**", parse_mode="Markdown")
-    asyncio.create_task(delete_message_delayed(msg, 3))
+    delayed_actions.delete_message(msg.chat.id, msg.message_id, 3)
     
     # Return to menu
     user = await get_user(user_id)
@@ -403,7 +507,7 @@ async def process_admin_set_duration(callback: CallbackQuery):
     
     # Temp notification
     msg = await callback.message.answer(msg_text, parse_mode="Markdown")
-    asyncio.create_task(delete_message_delayed(msg, 3))
+    delayed_actions.delete_message(msg.chat.id, msg.message_id, 3)
     
     user = await get_user(user_id) # Refresh
     await callback.message.delete()
@@ -437,7 +541,7 @@ async def process_balance_input(message: types.Message, state: FSMContext):
         
         # Temp Success Msg
         msg = await message.answer(f"✅ Баланс пользователя {target_user_id} установлен на **{amount} NC**.", parse_mode="Markdown")
-        asyncio.create_task(delete_message_delayed(msg, 3))
+        delayed_actions.delete_message(msg.chat.id, msg.message_id, 3)
         
         # Try to edit the prompt message back to menu
         success = False
@@ -462,7 +566,7 @@ async def process_balance_input(message: types.Message, state: FSMContext):
     except ValueError:
         # Invalid input: Send temp error message
         msg = await message.answer("❌ Введите корректное число.")
-        asyncio.create_task(delete_message_delayed(msg, 3))
+        delayed_actions.delete_message(msg.chat.id, msg.message_id, 3)
 
 async def send_users_list(message: types.Message):
     stats_list = await get_all_users_stats()
@@ -555,11 +659,205 @@ async def cmd_add_nc(message: types.Message):
     except Exception as e:
         await message.answer(f"Error: {e}")
 
+@dp.message(Command("broadcast"))
+async def cmd_broadcast(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+
+    # html_text сохраняет форматирование; первое слово — сама команда
+    parts = message.html_text.split(maxsplit=1)
+    if len(parts) < 2:
+        await message.answer("Usage: `/broadcast текст объявления`", parse_mode="Markdown")
+        return
+
+    broadcast = await create_broadcast(message.from_user.id, parts[1])
+    spawn(run_broadcast(broadcast))
+    await message.answer(
+        f"📣 Рассылка #{broadcast.id} запущена ({config.BROADCAST_RATE:g} сообщ./с).\n"
+        f"Прогресс: /broadcast_status, отмена: /broadcast_cancel {broadcast.id}"
+    )
+
+@dp.message(Command("broadcast_status"))
+async def cmd_broadcast_status(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+
+    broadcasts = await get_recent_broadcasts()
+    if not broadcasts:
+        await message.answer("Рассылок еще не было.")
+        return
+    await message.answer("\n\n".join(format_broadcast(b.id, b) for b in broadcasts))
+
+@dp.message(Command("broadcast_cancel"))
+async def cmd_broadcast_cancel(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+
+    args = message.text.split()
+    if len(args) != 2 or not args[1].isdigit():
+        await message.answer("Usage: `/broadcast_cancel [id]`", parse_mode="Markdown")
+        return
+
+    # Рассылка остановится после текущей страницы получателей
+    if await cancel_broadcast(int(args[1])):
+        await message.answer(f"⏹ Рассылка #{args[1]} отменена.")
+    else:
+        broadcast = await get_broadcast(int(args[1]))
+        await message.answer(format_broadcast(broadcast.id, broadcast) if broadcast else "Рассылка не найдена.")
+
+@dp.message(Command("result"))
+async def cmd_result(message: types.Message):
+    """Повторная отправка сохраненного результата генерации (аудит, разбор жалоб) без обращения к провайдеру."""
+    if message.from_user.id not in ADMIN_IDS:
+        return
+
+    args = message.text.split()
+    if len(args) != 2 or not args[1].isdigit():
+        await message.answer("Usage: `/result [generation_id]`", parse_mode="Markdown")
+        return
+
+    gen = await get_generation(int(args[1]))
+    if gen is None or result_store is None or not gen.result_hashes:
+        await message.answer("Результат не сохранен.")
+        return
+    for i, digest in enumerate(gen.result_hashes):
+        data = await result_store.get(digest)
+        if data is None:
+            await message.answer(f"Файл {digest[:12]}… удален по сроку хранения.")
+            continue
+        await message.answer_document(
+            BufferedInputFile(data, filename=f"generation_{gen.id}_{i + 1}.png"),
+            caption=f"#{gen.id} · user {gen.user_id} · {gen.model} · {gen.created_at:%d.%m.%Y %H:%M}"
+        )
+
+# --- History ---
+
+HISTORY_EPOCH = datetime(1970, 1, 1)
+
+def history_cursor(gen: Generation) -> str:
+    """Ключ keyset-пагинации (created_at, id) в callback_data: микросекунды и id."""
+    return f"{(gen.created_at - HISTORY_EPOCH) // timedelta(microseconds=1)}_{gen.id}"
+
+def parse_history_cursor(value: str) -> tuple[datetime, int]:
+    micros, gen_id = value.split("_")
+    return HISTORY_EPOCH + timedelta(microseconds=int(micros)), int(gen_id)
+
+def history_card(gen: Generation, has_newer: bool, has_older: bool) -> tuple[str, InlineKeyboardMarkup]:
+    model_name = MODEL_DISPLAY.get(gen.model, {}).get("name") or MODEL_NAMES.get(gen.model, gen.model)
+    model_name = model_name.replace("_", "\\_")
+    # Подпись фото — не больше 1024 символов; обратные кавычки ломают блок кода
+    prompt = gen.prompt[:700] + "..." if len(gen.prompt) > 700 else gen.prompt
+    prompt = prompt.replace("`", "'")
+    caption = (
+        f"🕘 *{gen.created_at:%d.%m.%Y %H:%M}* · {model_name}\n"
+        f"📐 AR: `{gen.aspect_ratio}` · `{gen.resolution or '—'}`\n\n"
+        f"```\n{prompt}\n```"
+    )
+    cursor = history_cursor(gen)
+    nav = []
+    if has_newer:
+        nav.append(InlineKeyboardButton(text="⬅️ Новее", callback_data=f"hist:n:{cursor}"))
+    if has_older:
+        nav.append(InlineKeyboardButton(text="Старше ➡️", callback_data=f"hist:o:{cursor}"))
+    rows = [nav] if nav else []
+    cost = calculate_cost(gen.model, gen.resolution)
+    rows.append([InlineKeyboardButton(text=f"🔁 Повторить ({cost} NC)", callback_data=f"hist:r:{gen.id}")])
+    rows.append([InlineKeyboardButton(text="✖️ Закрыть", callback_data="hist:x")])
+    return caption, InlineKeyboardMarkup(inline_keyboard=rows)
+
+async def remember_file_id(gen_id: int, file_id: str):
+    try:
+        await set_generation_results(gen_id, file_id=file_id)
+    except Exception as e:
+        logging.error(f"Failed to cache file id of generation {gen_id}: {e}")
+
+async def show_history(message: types.Message, user_id: int, cursor: tuple[datetime, int] | None = None,
+                       older: bool = True, replace: bool = False) -> bool:
+    """
+    Карточка генерации из истории: следующая за `cursor` в нужную сторону (без курсора — последняя).
+    Фото показывается по сохраненному file_id без повторной загрузки; если его нет, берется
+    из result_store. replace — заменить карточку в `message`. False — в эту сторону генераций нет.
+    """
+    # Лишняя запись показывает, есть ли куда листать дальше в ту же сторону
+    rows = await get_generation_history(user_id, cursor, older, limit=2)
+    if not rows:
+        return False
+    gen = rows[0]
+    if older:
+        has_newer, has_older = cursor is not None, len(rows) > 1
+    else:
+        has_newer, has_older = len(rows) > 1, True
+    caption, markup = history_card(gen, has_newer, has_older)
+
+    photo = gen.tg_file_id
+    if photo is None and result_store is not None and gen.result_hashes:
+        data = await result_store.get(gen.result_hashes[0])
+        if data is not None:
+            photo = BufferedInputFile(data, filename=f"generation_{gen.id}.png")
+
+    if replace and photo is not None and message.photo:
+        sent = await message.edit_media(InputMediaPhoto(media=photo, caption=caption, parse_mode="Markdown"), reply_markup=markup)
+    else:
+        if replace:
+            try:
+                await message.delete()
+            except:
+                pass
+        if photo is not None:
+            sent = await message.answer_photo(photo, caption=caption, parse_mode="Markdown", reply_markup=markup)
+        else:
+            sent = await message.answer(caption, parse_mode="Markdown", reply_markup=markup)
+
+    # Фото загружено из хранилища — запоминаем file_id, дальше показываем без загрузки
+    if gen.tg_file_id is None and isinstance(sent, types.Message) and sent.photo:
+        spawn(remember_file_id(gen.id, sent.photo[-1].file_id))
+    return True
+
+@dp.message(Command("history"))
+async def cmd_history(message: types.Message):
+    if not await show_history(message, message.from_user.id):
+        await message.answer("🕘 История пока пуста — здесь появятся ваши генерации.")
+
+@dp.callback_query(F.data.startswith("hist:"))
+async def process_history_callback(callback: CallbackQuery, state: FSMContext):
+    parts = callback.data.split(":")
+    action = parts[1]
+    user_id = callback.from_user.id
+
+    if action == "x":
+        try:
+            await callback.message.delete()
+        except:
+            pass
+        await callback.answer()
+
+    elif action in ("o", "n"):
+        # hist:o без курсора — открыть историю с последней генерации (из профиля)
+        cursor = parse_history_cursor(parts[2]) if len(parts) > 2 else None
+        shown = await show_history(callback.message, user_id, cursor, older=(action == "o"), replace=cursor is not None)
+        if shown:
+            await callback.answer()
+        else:
+            await callback.answer("Больше генераций нет." if cursor else "История пока пуста.")
+
+    elif action == "r":
+        # Повтор с теми же моделью, промптом, AR и разрешением — через обычные проверки и списание
+        gen = await get_generation(int(parts[2]))
+        if gen is None or gen.user_id != user_id:
+            await callback.answer("Генерация не найдена.", show_alert=True)
+            return
+        await state.clear()
+        data = {"prompt": gen.prompt, "model": gen.model, "aspect_ratio": gen.aspect_ratio}
+        if gen.resolution:
+            data["resolution"] = gen.resolution
+        await state.set_data(data)
+        await callback.answer("🔁 Повторяю...")
+        await trigger_generation(callback.message, state)
+
 @dp.message(Command("profile"))
 @dp.message(F.text.startswith("👤 Мой кабинет"))
 async def cmd_profile(message: types.Message):
     user = await get_user(message.from_user.id)
-    user = await enforce_tariff_expiry(user, message)
     if not user:
         return
         
@@ -579,7 +877,8 @@ async def cmd_profile(message: types.Message):
     
     markup = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="💰 Пополнить баланс", callback_data="nav:buy")],
-        [InlineKeyboardButton(text="⬆️ Сменить тариф", callback_data="nav:upgrade")]
+        [InlineKeyboardButton(text="⬆️ Сменить тариф", callback_data="nav:upgrade")],
+        [InlineKeyboardButton(text="🕘 История генераций", callback_data="hist:o")]
     ])
     
     await message.answer(msg, parse_mode="Markdown", reply_markup=markup)
@@ -762,26 +1061,6 @@ async def process_tariff_purchase(user_id: int, tariff: str, message: types.Mess
         input_field_placeholder="Выберите действие"
     )
 
-def get_creation_menu():
-    return types.ReplyKeyboardMarkup(
-        keyboard=[
-            [types.KeyboardButton(text="⚡ Flash"), types.KeyboardButton(text="🍌 Pro")],
-            [types.KeyboardButton(text="📸 Imagen")],
-            [types.KeyboardButton(text="🔙 Назад")]
-        ],
-        resize_keyboard=True,
-        input_field_placeholder="Выберите модель"
-    )
-
-def get_cancel_menu():
-    return types.ReplyKeyboardMarkup(
-        keyboard=[
-            [types.KeyboardButton(text="❌ Отмена")]
-        ],
-        resize_keyboard=True,
-        one_time_keyboard=True
-    )
-
 # --- Command Handlers ---
 
 @dp.message(F.text == "🔙 Назад")
@@ -806,8 +1085,7 @@ async def cmd_cancel(message: types.Message, state: FSMContext):
     balance = user.balance if user else None
 
     # Cleanup session
-    if message.chat.id in chat_sessions:
-        del chat_sessions[message.chat.id]
+    await drop_chat_session(message.chat.id)
 
     current_state = await state.get_state()
     if current_state is None:
@@ -846,6 +1124,13 @@ async def handle_web_app_data(message: types.Message, state: FSMContext):
         if not can_high_res and target_res != '1024x1024':
              target_res = '1024x1024' # Force standard
 
+        # Ошибки во флагах промпта показываем сразу, до запроса референсов
+        try:
+            parse_prompt_options(data['prompt'])
+        except PromptOptionError as e:
+            await answer_option_error(message, e)
+            return
+
         # Save params to FSM
         await state.update_data(
             prompt=data['prompt'],
@@ -857,6 +1142,8 @@ async def handle_web_app_data(message: types.Message, state: FSMContext):
         use_ref = data.get('use_reference', False)
         if use_ref:
              # Reusing the unified input handler state!
+            # Фото придут следующими сообщениями — текст рядом с ними тоже ждет сборки
+            await state.update_data(awaiting_refs=True)
             await state.set_state(GenStates.waiting_for_prompt)
             await message.answer(
                 "🍌 **Принято!** Теперь отправьте 1-3 фото-референса.\n",
@@ -869,12 +1156,9 @@ async def handle_web_app_data(message: types.Message, state: FSMContext):
 
 async def start_generation_flow(message: types.Message, state: FSMContext, model: str):
     # Setup Cleanup
-    if message.chat.id in chat_sessions:
-        del chat_sessions[message.chat.id]
+    await drop_chat_session(message.chat.id)
 
-    # Enforce tariff expiry before access checks
     user = await get_user(message.chat.id)
-    user = await enforce_tariff_expiry(user, message)
 
     # Access Check
     if not await check_access(message.chat.id, model):
@@ -889,7 +1173,7 @@ async def start_generation_flow(message: types.Message, state: FSMContext, model
         return
 
     await state.set_state(GenStates.waiting_for_prompt)
-    await state.update_data(model=model, ref_images=[], prompt="")
+    await state.update_data(model=model, ref_images=[], prompt="", awaiting_refs=False)
     
     model_messages = {
         "imagen": (
@@ -954,6 +1238,7 @@ async def cmd_help(message: types.Message):
         "• Full: 990₽, +8000 NC; все модели; refs 5; 2K/4K для Pro, 1K/2K для Imagen Std/Ultra\n"
         "• Admin: полный доступ\n\n"
         "Курс: 1 RUB = 10 NC. Для генерации списываются NC по моделям выше.\n\n"
+        "🕘 /history — ваши прошлые генерации и повтор с теми же настройками.\n\n"
         "🎨 **WebApp**: Нажмите 'Открыть приложение', чтобы настроить всё визуально!"
     )
     await message.answer(help_text, parse_mode="Markdown", reply_markup=get_main_menu(level, balance))
@@ -975,29 +1260,80 @@ async def cmd_imagen(message: types.Message, state: FSMContext):
 
 
 
-async def trigger_generation(message: types.Message, state: FSMContext):
-    # 0. Context & Access
-    user = await get_user(message.chat.id)
-    user = await enforce_tariff_expiry(user, message)
-    # Fallback if no user (shouldn't happen)
-    if not user:
-        return
-        
+async def answer_option_error(message: types.Message, error: PromptOptionError):
+    await message.answer(
+        f"⚠️ {error.message}\n"
+        f"💡 Флаги: `--ar 16:9`, `--2k`, `--n 3`, `--model pro`, `--seed 42`, `--no-dialogue`",
+        parse_mode="Markdown"
+    )
+
+class GenerationRefused(Exception):
+    """
+    Генерация отклонена до списания NC. `text` и `reply_markup` — ответ в чат,
+    `reason` — код для HTTP API: invalid, forbidden, balance, unavailable, rate_limited.
+    """
+
+    def __init__(self, reason: str, text: str, reply_markup=None, parse_mode: str | None = None):
+        super().__init__(text)
+        self.reason = reason
+        self.text = text
+        self.reply_markup = reply_markup
+        self.parse_mode = parse_mode
+
+@dataclass
+class GenerationPlan:
+    model: str
+    model_id: str
+    prompt: str
+    aspect_ratio: str
+    resolution: str
+    variants: int
+    unit_cost: int
+    seed: int | None
+    no_dialogue: bool
+
+    @property
+    def cost(self) -> int:
+        return self.unit_cost * self.variants
+
+def balance_markup(tariff: str) -> InlineKeyboardMarkup:
+    # Подготовка кнопок в зависимости от тарифа
+    tariff_lower = tariff.lower()
+    if tariff_lower == "demo":
+        buttons = [
+            InlineKeyboardButton(text="🧾 Оформить подписку", callback_data="balance:subscribe"),
+            InlineKeyboardButton(text="💰 Купить монеты", callback_data="balance:coins")
+        ]
+    elif tariff_lower == "basic":
+        buttons = [
+            InlineKeyboardButton(text="⬆️ Повысить тариф", callback_data="balance:upgrade"),
+            InlineKeyboardButton(text="💰 Купить монеты", callback_data="balance:coins")
+        ]
+    else:  # full/admin
+        buttons = [
+            InlineKeyboardButton(text="💰 Купить монеты", callback_data="balance:coins")
+        ]
+    return InlineKeyboardMarkup(inline_keyboard=[buttons])
+
+async def plan_generation(user: User, model: str, options, aspect_ratio: str, resolution: str,
+                          ref_count: int) -> GenerationPlan:
+    """
+    Проверки перед списанием — общие для чата и HTTP API: промпт, тариф, доступность модели,
+    баланс и лимиты частоты. Возвращает параметры генерации; слот лимита частоты уже занят
+    (если поставить задание не удалось — rate_limiter.release). Raises: GenerationRefused.
+    """
+    prompt = options.prompt
     tariff = user.tariff
-    data = await state.get_data()
-    prompt = data.get('prompt', '').strip()
-    model = data.get('model')
-    refs = data.get('ref_images', []) # List of file_ids
-    
+
     # 1. Validation
-    if not prompt: 
-        await message.answer("⚠️ Эмм... А рисовать-то что? Напишите хоть пару слов.", reply_markup=get_cancel_menu())
-        return # Keep state
+    if not prompt:
+        raise GenerationRefused("invalid", "⚠️ Эмм... А рисовать-то что? Напишите хоть пару слов.",
+                                reply_markup=get_cancel_menu())
 
     # 3. Parse AR & Res (Pre-validation logic to get final params)
-    import re
-    ar = data.get('aspect_ratio', '1:1')
-    target_res = data.get('resolution', '1024x1024')
+    ar = options.aspect_ratio or aspect_ratio
+    target_res = options.resolution or resolution
+    variants = options.variants
     
     # Normalize Imagen resolutions (supports only 1K/2K; fast ignores size)
     if model and "imagen" in model:
@@ -1005,24 +1341,14 @@ async def trigger_generation(message: types.Message, state: FSMContext):
             target_res = "1K"
         if target_res == "4K":
             target_res = "2K"
-    
-    # Regex for various dashes: -, --, —, –
-    match_ar = re.search(r'(?:--|—|–|-)ar\s+(\d+:\d+)', prompt)
-    if match_ar:
-        ar = match_ar.group(1)
-        prompt = re.sub(r'(?:--|—|–|-)ar\s+\d+:\d+', '', prompt).strip()
-
-    # Regex for resolution
-    match_res = re.search(r'(?:--|—|–|-)(1k|2k|4k)', prompt, re.IGNORECASE)
-    if match_res:
-        requested_res = match_res.group(1).upper()
-        prompt = re.sub(r'(?:--|—|–|-)(1k|2k|4k)', '', prompt, flags=re.IGNORECASE).strip()
-        target_res = requested_res
-    
+        if options.seed is not None:
+            raise GenerationRefused("invalid", "⚠️ `--seed` поддерживается только моделями Nano Banana (Gemini).",
+                                    parse_mode="Markdown")
+
     # --- PRICING & LIMITS CHECK ---
     
     # Check Limits
-    is_valid, reason = validate_request(tariff, model, target_res, len(refs), ar)
+    is_valid, reason = validate_request(tariff, model, target_res, ref_count, ar)
     if not is_valid:
         # If invalid, check if we can suggest upgrade
         if "доступна с тарифа БАЗОВЫЙ" in reason:
@@ -1031,117 +1357,383 @@ async def trigger_generation(message: types.Message, state: FSMContext):
              msg = f"{reason}\n💡 Апгрейд: `/upgrade`"
         else:
              msg = reason
-        await message.answer(msg, parse_mode="Markdown")
         # Do NOT clear state, let them adjust? Or clear? 
         # Better let them adjust or cancel.
-        return 
+        raise GenerationRefused("forbidden", msg, parse_mode="Markdown")
+
+    # Модель отключена автоматом после серии сбоев провайдера: отвечаем сразу, ничего не списывая
+    available, retry_after = nano_service.is_available(model) if RUNS_JOBS else (True, 0.0)
+    if not available:
+        raise GenerationRefused(
+            "unavailable",
+            f"⏳ Модель сейчас перегружена у провайдера.\n"
+            f"Попробуйте через ~{max(1, round(retry_after))} сек. или выберите другую модель.",
+            reply_markup=get_cancel_menu()
+        )
+
+    # Calculate Cost (за каждое изображение)
+    unit_cost = calculate_cost(model, target_res)
+    cost = unit_cost * variants
 
-    # Calculate Cost
-    cost = calculate_cost(model, target_res)
-    
     # Check Balance
     if user.balance < cost:
-        # Подготовка кнопок в зависимости от тарифа
-        tariff_lower = user.tariff.lower()
-        buttons = []
-        if tariff_lower == "demo":
-            buttons = [
-                InlineKeyboardButton(text="🧾 Оформить подписку", callback_data="balance:subscribe"),
-                InlineKeyboardButton(text="💰 Купить монеты", callback_data="balance:coins")
-            ]
-        elif tariff_lower == "basic":
-            buttons = [
-                InlineKeyboardButton(text="⬆️ Повысить тариф", callback_data="balance:upgrade"),
-                InlineKeyboardButton(text="💰 Купить монеты", callback_data="balance:coins")
-            ]
-        else:  # full/admin
-            buttons = [
-                InlineKeyboardButton(text="💰 Купить монеты", callback_data="balance:coins")
-            ]
-        markup = InlineKeyboardMarkup(inline_keyboard=[buttons])
-
-        await message.answer(
+        raise GenerationRefused(
+            "balance",
             f"📉 **Недостаточно средств!**\n"
             f"Стоимость: `{cost} NC`\n"
             f"Ваш баланс: `{user.balance} NC`",
             parse_mode="Markdown",
-            reply_markup=markup
+            reply_markup=balance_markup(user.tariff)
+        )
+
+    # Лимиты частоты (глобальные квоты модели и персональный по тарифу) — до списания NC
+    model_id = nano_service.resolve_model(model)
+    eta = await rate_limiter.acquire(user.id, tariff, model_id, max_wait=config.RATE_LIMIT_MAX_WAIT, requests=variants,
+                                     per_model=RUNS_JOBS)
+    if eta:
+        raise GenerationRefused(
+            "rate_limited",
+            f"🚦 Слишком много запросов. Попробуйте через ~{max(1, round(eta))} сек.\n"
+            f"Средства не списаны.",
+            reply_markup=get_cancel_menu()
         )
-        return
 
-    # Deduct Balance
-    new_balance = await update_balance(user.id, -cost)
+    return GenerationPlan(model=model, model_id=model_id, prompt=prompt, aspect_ratio=ar, resolution=target_res,
+                          variants=variants, unit_cost=unit_cost, seed=options.seed, no_dialogue=options.no_dialogue)
 
-    # 4. Status Message
-    from aiogram.utils.markdown import hide_link
-    ref_info = f"\n📎 Refs: {len(refs)}" if refs else ""
-    status_text = (
-        f"🍌 **Генерирую...** (`{model}`)\n"
-        f"💰 Будет списано: `{cost} NC` (Останется: `{new_balance}`)\n"
+def generation_status_text(plan: GenerationPlan, user: User, ref_count: int) -> str:
+    ref_info = f"\n📎 Refs: {ref_count}" if ref_count else ""
+    variants_info = f"\n🖼 Вариантов: {plan.variants}" if plan.variants > 1 else ""
+    prompt = plan.prompt
+    return (
+        f"🍌 **Генерирую...** (`{plan.model}`)\n"
+        f"💰 Будет списано: `{plan.cost} NC` (Останется: `{user.balance - plan.cost}`)\n"
         f"📝 `{prompt[:50] + '...' if len(prompt)>50 else prompt}`\n"
-        f"📐 AR: `{ar}`"
-        f"{ref_info}"
+        f"📐 AR: `{plan.aspect_ratio}`"
+        f"{ref_info}{variants_info}"
     )
+
+async def enqueue_generation(user: User, plan: GenerationPlan, chat_id: int, refs: list, status_msg: types.Message,
+                             status_text: str, continuation: bool = False,
+                             config_message_id: int | None = None, ref_hashes: list | None = None) -> int:
+    """
+    Списание, запись генерации и задание в очереди — одной транзакцией. Дальше генерацию
+    выполняет воркер: оплаченная работа переживает рестарт и падение процесса.
+    `refs` — file_id фото в Telegram, `ref_hashes` — загруженные из мини-приложения (в result_store).
+    Возвращает id генерации (он же id задания). При ошибке освобождает слот лимита и пробрасывает ее.
+    """
+    # Все, что нужно воркеру для выполнения и доставки без исходного сообщения
+    payload = {
+        "chat_id": chat_id,
+        "user_id": user.id,
+        "tariff": user.tariff,
+        "model": plan.model,
+        "model_id": plan.model_id,
+        "prompt": plan.prompt,
+        "aspect_ratio": plan.aspect_ratio,
+        "resolution": plan.resolution,
+        "variants": plan.variants,
+        "unit_cost": plan.unit_cost,
+        "seed": plan.seed,
+        "refs": refs,
+        "ref_hashes": ref_hashes or [],
+        "continuation": continuation and plan.variants == 1 and not plan.no_dialogue,
+        "no_dialogue": plan.no_dialogue,
+        "status_message_id": status_msg.message_id,
+        "status_text": status_text,
+        "config_message_id": config_message_id,
+        # Процесс, где прошли проверки автомата и квот модели (см. run_generation_job)
+        "planned_by": generation_workers.owner,
+    }
+    try:
+        gen_id, _ = await submit_generation_job(user.id, plan.cost, plan.model, plan.prompt, plan.aspect_ratio,
+                                                plan.resolution, payload)
+    except Exception:
+        rate_limiter.release(user.id, plan.model_id, requests=plan.variants, per_model=RUNS_JOBS)
+        raise
+    generation_workers.notify()
+    return gen_id
+
+async def trigger_generation(message: types.Message, state: FSMContext):
+    # 0. Context & Access
+    user = await get_user(message.chat.id)
+    # Fallback if no user (shouldn't happen)
+    if not user:
+        return
+        
+    data = await state.get_data()
+    prompt = data.get('prompt', '').strip()
+    model = data.get('model')
+    refs = data.get('ref_images', []) # List of file_ids
     
-    processing_msg = await message.answer(status_text, parse_mode="Markdown")
+    # Флаги промпта (--ar, --1k/2k/4k, --n, --model, --seed, --no-dialogue) поверх настроек
+    try:
+        options = parse_prompt_options(prompt)
+    except PromptOptionError as e:
+        await answer_option_error(message, e)
+        return # Keep state
+
+    # Продолжение диалога идет в чат-сессии той модели, с которой диалог начат. Флаг одноразовый:
+    # его ставит подтверждение реплики, а следующая генерация («Создать ещё» и т.п.) — уже новая
+    continuation = bool(data.get('is_dialogue_continuation'))
+    if continuation:
+        await state.update_data(is_dialogue_continuation=False)
+        model = data.get('dialogue_model', model)
+    # --model действует только на этот запрос и в состояние не пишется. Чужую чат-сессию
+    # другая модель продолжить не может: это новая генерация без истории диалога
+    if options.prompt and options.model and options.model != model:
+        model = options.model
+        if continuation:
+            continuation = False
+            await drop_chat_session(message.chat.id)
+
+    try:
+        plan = await plan_generation(user, model, options, data.get('aspect_ratio', '1:1'),
+                                     data.get('resolution', '1024x1024'), len(refs))
+    except GenerationRefused as e:
+        await message.answer(e.text, parse_mode=e.parse_mode, reply_markup=e.reply_markup)
+        return # Keep state
+
+    # 4. Status Message
+    status_text = generation_status_text(plan, user, len(refs))
     
-    # Log
-    gen_id = await log_generation(message.chat.id, model, prompt, ar, target_res, 'pending')
-
-    # Helpers for caption
-    def get_token_suffix(count: int) -> str:
-        if count % 10 == 1 and count % 100 != 11:
-            return "токен"
-        elif 2 <= count % 10 <= 4 and (count % 100 < 10 or count % 100 >= 20):
-            return "токена"
-        else:
-            return "токенов"
+    # Альбом нельзя отправить с reply-клавиатурой, поэтому в режиме вариантов она приходит со статусом
+    processing_msg = await message.answer(
+        status_text,
+        parse_mode="Markdown",
+        reply_markup=get_minimal_menu() if plan.variants > 1 else None
+    )
 
-    MODEL_NAMES = {
-        "nano_banana": "Nano Banana (Gemini 2.5 Flash)",
-        "nano_banana_pro": "Nano Banana Pro (Gemini 3 Pro)",
-        "imagen": "Imagen 4 Fast"
-    }
+    # Add Dialogue Ref if exists
+    dialogue_ref = data.get('dialogue_ref_file_id')
+    if dialogue_ref and dialogue_ref not in refs:
+        refs.append(dialogue_ref)
 
     try:
+        await enqueue_generation(user, plan, message.chat.id, refs, processing_msg, status_text,
+                                 continuation=continuation,
+                                 config_message_id=data.get("config_message_id"))
+    except Exception as e:
+        logging.error(f"Failed to submit generation for {user.id}: {e}")
+        await processing_msg.edit_text("❌ Не удалось поставить генерацию в очередь. Средства не списаны.")
+
+# Коды отказов plan_generation -> HTTP-статусы API
+REFUSAL_STATUS = {"invalid": 400, "forbidden": 403, "balance": 402, "unavailable": 503, "rate_limited": 429}
+
+async def submit_web_generation(user_id: int, params: dict) -> int:
+    """
+    Генерация из мини-приложения (POST /api/jobs): те же проверки, списание и очередь, что
+    и в чате; статус и результат бот присылает в чат пользователя. Возвращает id генерации.
+    Raises: ApiError.
+    """
+    user = await get_user(user_id)
+    if user is None:
+        raise ApiError(404, "user not found, send /start to the bot")
+    if user.access_level == 'banned':
+        raise ApiError(403, "banned", "forbidden")
+
+    model = params.get('model', 'nano_banana')
+    prompt = params.get('prompt')
+    if model not in nano_service.models and model not in MODEL_DISPLAY:
+        raise ApiError(400, f"unknown model {model!r}", "invalid")
+    # Короткие имена мини-приложения -> ID модели: цены и тарифы заданы по ID (как в /api/models)
+    model = nano_service.models.get(model, model)
+    if not isinstance(prompt, str) or len(prompt) > 4096:
+        raise ApiError(400, "prompt must be a string up to 4096 characters", "invalid")
+    # Референсы — хеши из /api/uploads; их число проверяет тариф в plan_generation
+    ref_hashes = params.get('refs') or []
+    if not isinstance(ref_hashes, list) or not all(isinstance(h, str) and RESULT_HASH_RE.fullmatch(h) for h in ref_hashes):
+        raise ApiError(400, "refs must be a list of upload hashes", "invalid")
+    if ref_hashes and not MODEL_DISPLAY.get(model, {}).get("supports_references"):
+        raise ApiError(400, "this model does not accept references", "invalid")
+
+    # Как в handle_web_app_data: без доступа к 2K/4K разрешение приводится к стандартному
+    _, can_high_res = get_user_limits(user.tariff)
+    resolution = str(params.get('resolution', '1024x1024'))
+    if not can_high_res and resolution != '1024x1024':
+        resolution = '1024x1024'
+
+    try:
+        options = parse_prompt_options(prompt.strip())
+    except PromptOptionError as e:
+        raise ApiError(400, e.message.replace("`", ""), "invalid")
+    if options.model:
+        model = options.model
+
+    try:
+        plan = await plan_generation(user, model, options, str(params.get('aspect_ratio', '1:1')), resolution,
+                                     len(ref_hashes))
+    except GenerationRefused as e:
+        # Текст для чата — без разметки Markdown
+        raise ApiError(REFUSAL_STATUS[e.reason], e.text.replace("**", "").replace("`", ""), e.reason)
+
+    status_text = generation_status_text(plan, user, len(ref_hashes))
+    try:
+        status_msg = await bot.send_message(user.id, status_text, parse_mode="Markdown")
+    except Exception as e:
+        rate_limiter.release(user.id, plan.model_id, requests=plan.variants, per_model=RUNS_JOBS)
+        logging.error(f"Failed to send status for web generation of {user.id}: {e}")
+        raise ApiError(503, "can't reach the chat, open the bot and press /start", "unavailable")
+    # Новая генерация из мини-приложения начинает новый диалог
+    await drop_chat_session(user.id)
+    try:
+        return await enqueue_generation(user, plan, user.id, [], status_msg, status_text, ref_hashes=ref_hashes)
+    except Exception as e:
+        logging.error(f"Failed to submit web generation for {user.id}: {e}")
+        await status_msg.edit_text("❌ Не удалось поставить генерацию в очередь. Средства не списаны.")
+        raise ApiError(503, "queue unavailable, nothing was charged", "unavailable")
+
+# HTTP API мини-приложения: читает БД через тот же движок, что и бот, генерации ставит в общую очередь.
+# Референсы загружаются частями в UPLOAD_DIR и хранятся в хранилище результатов
+uploads = ChunkedUploads(config.UPLOAD_DIR, config.UPLOAD_TTL)
+# Проверки здоровья: /readyz снимает экземпляр с балансировки, если недоступна БД или Bot API.
+# Очередь и автоматы моделей — для наблюдения (статус degraded). Очередь общая (Postgres), автоматы —
+# в памяти этого процесса; но открываются они из-за отказов API модели, которые видят и соседние экземпляры
+loop_lag = LoopLagMonitor()
+health = HealthChecks(loop_lag, max_loop_lag=config.HEALTH_MAX_LOOP_LAG, timeout=config.HEALTH_CHECK_TIMEOUT)
+
+async def check_bot_api() -> dict:
+    me = await bot.get_me()
+    return {"username": me.username}
+
+async def check_generation_queue() -> dict:
+    depth = await database.get_generation_queue_depth()
+    # В этом процессе: заняты воркеры очереди и ждут слота в справедливой очереди
+    return {**depth, "local_busy": generation_workers.busy, "local_waiting": generation_queue.waiting}
+
+async def check_models() -> dict:
+    models = {name: {"model": target, **nano_service.breaker_for(target).snapshot()}
+              for name, target in nano_service.models.items()}
+    return {"ok": all(m["state"] != CircuitBreaker.OPEN for m in models.values()), "models": models}
+
+health.add("database", database.ping)
+health.add("bot_api", check_bot_api, ttl=config.HEALTH_BOT_API_TTL)
+health.add("queue", check_generation_queue, critical=False)
+if RUNS_JOBS:
+    health.add("models", check_models, critical=False)
+
+web_api = WebApi(database, config.BOT_TOKEN.get_secret_value(), nano_service.models,
+                 origin=config.WEBAPP_ORIGIN, init_data_ttl=config.INIT_DATA_TTL,
+                 cache_max_age=config.API_CACHE_MAX_AGE, submit=submit_web_generation,
+                 uploads=uploads, ref_store=result_store, upload_chunk_size=config.UPLOAD_CHUNK_SIZE,
+                 health=health)
+
+# Helpers for caption
+def get_token_suffix(count: int) -> str:
+    if count % 10 == 1 and count % 100 != 11:
+        return "токен"
+    elif 2 <= count % 10 <= 4 and (count % 100 < 10 or count % 100 >= 20):
+        return "токена"
+    else:
+        return "токенов"
+
+MODEL_NAMES = {
+    "nano_banana": "Nano Banana (Gemini 2.5 Flash)",
+    "nano_banana_pro": "Nano Banana Pro (Gemini 3 Pro)",
+    "imagen": "Imagen 4 Fast"
+}
+
+def job_state(chat_id: int, user_id: int) -> FSMContext:
+    """FSM-контекст пользователя для воркера, у которого нет исходного апдейта."""
+    return FSMContext(storage=dp.storage, key=StorageKey(bot_id=bot.id, chat_id=chat_id, user_id=user_id))
+
+async def run_generation_job(job: Job):
+    """
+    Выполняет оплаченную генерацию из очереди и доставляет результат через Bot API.
+    При ошибке возвращает стоимость и сообщает пользователю.
+    """
+    p = job.payload
+    gen_id = job.id
+    chat_id, user_id, tariff = p["chat_id"], p["user_id"], p["tariff"]
+    model, model_id, prompt = p["model"], p["model_id"], p["prompt"]
+    ar, target_res, variants, unit_cost = p["aspect_ratio"], p["resolution"], p["variants"], p["unit_cost"]
+    cost = unit_cost * variants
+    refs = p["refs"]
+    state = job_state(chat_id, user_id)
+    delivered = False  # результат уже у пользователя: после этого NC не возвращаются
+
+    # Прогресс потоковой генерации дописывается в статус с ограничением частоты правок
+    status_text = p["status_text"]
+    status_updater = StatusUpdater(
+        lambda text: bot.edit_message_text(text, chat_id=chat_id, message_id=p["status_message_id"], parse_mode="Markdown"),
+        interval=config.STATUS_EDIT_INTERVAL
+    )
+
+    async def on_progress(kind: str, text: str):
+        line = progress_line(kind, text)
+        if line:
+            await status_updater.update(f"{status_text}\n\n{line}")
+
+    try:
+        if p.get("planned_by") != generation_workers.owner:
+            # Задание спланировал другой процесс: его автомат и квоты модели не видят вызовов
+            # отсюда. Проверяем по состоянию этого процесса; отказ — возврат NC ниже,
+            # а settle идет в те же корзины, что расходует этот acquire
+            available, retry_after = nano_service.is_available(model)
+            if not available:
+                raise RuntimeError(f"модель перегружена у провайдера, попробуйте через ~{max(1, round(retry_after))} сек.")
+            eta = await rate_limiter.acquire(user_id, tariff, model_id, max_wait=config.RATE_LIMIT_MAX_WAIT,
+                                             requests=variants, per_user=False)
+            if eta:
+                raise RuntimeError(f"слишком много запросов к модели, попробуйте через ~{max(1, round(eta))} сек.")
+
         # Download refs
         image_bytes_list = []
-        
-        # Add Dialogue Ref if exists
-        dialogue_ref = data.get('dialogue_ref_file_id')
-        if dialogue_ref and dialogue_ref not in refs:
-             refs.append(dialogue_ref)
-
-        if refs:
-            bot_instance = message.bot
-            for file_id in refs:
-                file = await bot_instance.get_file(file_id)
-                io_bytes = await bot_instance.download_file(file.file_path)
-                image_bytes_list.append(io_bytes.read())
+        for file_id in refs:
+            file = await bot.get_file(file_id)
+            io_bytes = await bot.download_file(file.file_path)
+            image_bytes_list.append(io_bytes.read())
+        # Референсы из мини-приложения — уже в хранилище, без скачивания из Telegram
+        for digest in p.get("ref_hashes", []):
+            data = await result_store.get(digest) if result_store is not None else None
+            if data is None:
+                raise RuntimeError("референс из приложения больше не доступен, загрузите его заново")
+            image_bytes_list.append(bytes(data))
 
         # Call API
         # Retrieve existing chat session if in dialogue mode
-        chat_session = None
-        is_continuation = data.get('is_dialogue_continuation', False)
-        
-        if is_continuation:
-             chat_session = chat_sessions.get(message.chat.id)
+        chat_session = await get_chat_session(chat_id) if p["continuation"] else None
 
-        image_bytes, token_count, new_chat_session = await nano_service.generate_image(
-            prompt=prompt,
-            aspect_ratio=ar,
-            resolution=target_res,
-            model_type=model,
-            reference_images=image_bytes_list,
-            chat_session=chat_session
-        )
-        
-        # Mark Completed
-        await update_generation_status(gen_id, 'completed', token_count)
+        # Очередь к провайдеру со справедливым распределением по тарифам и пользователям
+        try:
+            async with generation_queue.slot(tariff, user_id):
+                if variants > 1:
+                    images, token_count = await nano_service.generate_images(
+                        prompt=prompt,
+                        aspect_ratio=ar,
+                        resolution=target_res,
+                        model_type=model,
+                        reference_images=image_bytes_list,
+                        number_of_images=variants,
+                        seed=p["seed"]
+                    )
+                    new_chat_session = None
+                else:
+                    image_bytes, token_count, new_chat_session = await nano_service.generate_image(
+                        prompt=prompt,
+                        aspect_ratio=ar,
+                        resolution=target_res,
+                        model_type=model,
+                        reference_images=image_bytes_list,
+                        chat_session=chat_session,
+                        on_progress=on_progress,
+                        seed=p["seed"]
+                    )
+                    images = [image_bytes]
+        finally:
+            status_updater.close()
+
+        # Mark Completed; часть вариантов не удалась — возвращаем их стоимость (в той же транзакции)
+        refund = unit_cost * (variants - len(images))
+        cost -= refund
+        new_balance = await finish_generation(gen_id, 'completed', token_count, refund=refund)
+        if new_balance is None:
+            new_balance = await get_user_balance(user_id)
+        rate_limiter.settle(model_id, token_count, requests=variants)
         
         # Save session if exists
         if new_chat_session:
-            chat_sessions[message.chat.id] = new_chat_session
+            await put_chat_session(chat_id, new_chat_session, model_id)
 
         # Format Caption
         model_display = MODEL_NAMES.get(model, model)
@@ -1170,7 +1762,8 @@ async def trigger_generation(message: types.Message, state: FSMContext):
         
         # Check if dialogue is supported
         model_meta = MODEL_DISPLAY.get(model, {})
-        supports_dialogue = model_meta.get("supports_dialogue", False)
+        # Варианты генерируются без чат-сессии, продолжать диалог не с чем; --no-dialogue отключает его явно
+        supports_dialogue = model_meta.get("supports_dialogue", False) and variants == 1 and not p["no_dialogue"]
 
         # Inline Result Actions
         result_inline_rows = [
@@ -1187,35 +1780,49 @@ async def trigger_generation(message: types.Message, state: FSMContext):
         if supports_dialogue:
              # Включаем режим ожидания диалога для всех, даже для демо, чтобы ловить их сообщения
              await state.set_state(GenStates.dialogue_standby)
+             # Модель, чья чат-сессия сохранена: по ней считается и выполняется продолжение
+             await state.update_data(dialogue_model=model)
              if tariff != 'demo':
                  logging.info(f"DIALOGUE: Activated for model {model}, tariff {tariff}")
              else:
                  # Демо: диалог недоступен, но оставляем минимальную клавиатуру и очищаем чат-сессию
-                 if message.chat.id in chat_sessions:
-                     del chat_sessions[message.chat.id]
+                 await drop_chat_session(chat_id)
                  logging.info(f"DIALOGUE: Demo user, showing upgrade prompt on next message.")
         else:
              logging.info(f"DIALOGUE: NOT activated for model {model}, tariff {tariff}, supports_dialogue={supports_dialogue}")
              await state.clear()
              # Clear session if not continuing
-             if message.chat.id in chat_sessions:
-                 del chat_sessions[message.chat.id]
+             await drop_chat_session(chat_id)
         
         # Send Result (attach minimal reply keyboard here to avoid extra text message)
-        photo = BufferedInputFile(image_bytes, filename=f"banana_{model}.png")
-        await message.answer_photo(
-             photo,
-             caption=final_caption,
-             parse_mode="Markdown",
-             reply_markup=reply_keyboard
-        )
+        if len(images) > 1:
+            # Все варианты одним альбомом, подпись — у первого
+            sent = await bot.send_media_group(chat_id, [
+                InputMediaPhoto(
+                    media=BufferedInputFile(img, filename=f"banana_{model}_{i + 1}.png"),
+                    caption=final_caption if i == 0 else None,
+                    parse_mode="Markdown" if i == 0 else None
+                )
+                for i, img in enumerate(images)
+            ])
+        else:
+            photo = BufferedInputFile(images[0], filename=f"banana_{model}.png")
+            sent = [await bot.send_photo(
+                 chat_id,
+                 photo,
+                 caption=final_caption,
+                 parse_mode="Markdown",
+                 reply_markup=reply_keyboard
+            )]
+        delivered = True
+        spawn(record_results(gen_id, images, sent[0].photo[-1].file_id if sent and sent[0].photo else None))
 
         # Send inline buttons and update reply keyboard
-        actions_msg = await message.answer("Выберите действие:", reply_markup=result_inline)
+        actions_msg = await bot.send_message(chat_id, "Выберите действие:", reply_markup=result_inline)
 
         # Обновить реплай-клавиатуру: диалоговая или минимальная (чтобы убрать главное меню)
         if supports_dialogue:
-            dlg_msg = await message.answer("💬 Режим диалога", reply_markup=reply_keyboard)
+            dlg_msg = await bot.send_message(chat_id, "💬 Режим диалога", reply_markup=reply_keyboard)
             # Сохраняем ID сообщения с индикатором диалога, чтобы можно было удалить при завершении
             await state.update_data(dialogue_indicator_msg_id=dlg_msg.message_id, actions_msg_id=actions_msg.message_id)
 
@@ -1223,33 +1830,103 @@ async def trigger_generation(message: types.Message, state: FSMContext):
         
         # Cleanup
         try:
-            await processing_msg.delete()
+            await bot.delete_message(chat_id=chat_id, message_id=p["status_message_id"])
         except:
             pass
             
         # Delete Config Message (Menu)
-        config_msg_id = data.get("config_message_id")
+        config_msg_id = p["config_message_id"]
         if config_msg_id:
              try:
-                 await message.bot.delete_message(chat_id=message.chat.id, message_id=config_msg_id)
+                 await bot.delete_message(chat_id=chat_id, message_id=config_msg_id)
              except:
                  pass
 
     except Exception as e:
-        # REFUND
-        refund_bal = await update_balance(user.id, cost)
-        await update_generation_status(gen_id, 'failed')
-        
-        await message.answer(
-            f"❌ Упс! Ошибка генерации: {e}\n"
-            f"💰 **Средства возвращены.** Баланс: {refund_bal} NC", 
-            reply_markup=get_main_menu(tariff, refund_bal)
-        )
-        if message.chat.id in chat_sessions:
-            del chat_sessions[message.chat.id]
+        if delivered:
+            # Картинка у пользователя, сломалось что-то после (меню, состояние диалога) — не возврат
+            logging.error(f"Generation {gen_id} delivered, post-processing failed: {e}")
+            await drop_chat_session(chat_id)
+            return
+
+        # REFUND: pending -> failed, либо completed -> failed, если результат не доставлен.
+        # Оба перехода условные: генерацию, уже возвращенную сверкой или abandon, не трогают
+        refund_bal = await finish_generation(gen_id, 'failed', refund=cost)
+        if refund_bal is None:
+            refund_bal = await fail_completed_generation(gen_id, cost)
+        if refund_bal is None:
+            logging.warning(f"Generation {gen_id} failed after it was already refunded: {e}")
+            await bot.send_message(chat_id, f"❌ Упс! Ошибка генерации: {e}")
+        else:
+            await bot.send_message(
+                chat_id,
+                f"❌ Упс! Ошибка генерации: {e}\n"
+                f"💰 **Средства возвращены.** Баланс: {refund_bal} NC",
+                reply_markup=get_main_menu(tariff, refund_bal)
+            )
+        await drop_chat_session(chat_id)
+
+async def abandon_generation_job(job: Job):
+    """
+    Задание несколько раз падало вместе с процессом воркера: не выполняем, возвращаем NC.
+    Генерация могла успеть стать completed, если процесс умер до отправки картинки:
+    без ссылок на отправленный результат она тоже возвращается (completed -> failed).
+    """
+    p = job.payload
+    refund_bal = await finish_generation(job.id, 'failed', refund=p["unit_cost"] * p["variants"])
+    if refund_bal is None:
+        gen = await get_generation(job.id)
+        if gen is None or gen.status != 'completed' or gen.tg_file_id or gen.result_hashes:
+            return
+        # Стоимость уже уменьшена на возврат за неудавшиеся варианты — возвращаем остаток
+        refund_bal = await fail_completed_generation(job.id, gen.cost or 0)
+        if refund_bal is None:
+            return
+    await bot.send_message(
+        p["chat_id"],
+        f"❌ Генерацию не удалось выполнить.\n"
+        f"💰 **Средства возвращены.** Баланс: {refund_bal} NC",
+        reply_markup=get_main_menu(p["tariff"], refund_bal)
+    )
+
+# Воркеры очереди генераций (generation_jobs); запускаются в main()
+generation_workers = JobWorkers(
+    store=database,
+    handler=run_generation_job,
+    give_up=abandon_generation_job,
+    workers=config.GEN_WORKERS,
+    lease=config.GEN_JOB_LEASE,
+    max_attempts=config.GEN_JOB_MAX_ATTEMPTS,
+    poll_interval=config.GEN_JOB_POLL_INTERVAL
+)
     
 # In-memory session storage (simple approach for single instance bot)
-chat_sessions = {}
+# Ограничено по TTL и размеру, чтобы брошенные диалоги не копились в памяти
+chat_sessions = SessionStore(ttl=config.CHAT_SESSION_TTL, max_size=config.CHAT_SESSION_MAX)
+
+# В режиме раздельных процессов продолжение диалога может попасть на любой воркер,
+# поэтому история чата хранится в chat_histories с тем же TTL
+async def get_chat_session(chat_id: int):
+    if not SPLIT_MODE:
+        return chat_sessions.get(chat_id)
+    data = await load_chat_history(chat_id, config.CHAT_SESSION_TTL)
+    return nano_service.load_chat(data) if data else None
+
+async def put_chat_session(chat_id: int, chat_session, model_id: str):
+    if not SPLIT_MODE:
+        chat_sessions[chat_id] = chat_session
+        return
+    await save_chat_history(chat_id, nano_service.dump_chat(chat_session, model_id))
+
+async def drop_chat_session(chat_id: int):
+    chat_sessions.pop(chat_id)
+    if SPLIT_MODE:
+        await delete_chat_history(chat_id)
+
+async def prune_chat_histories_job():
+    removed = await delete_expired_chat_histories(config.CHAT_SESSION_TTL)
+    if removed:
+        logging.info(f"Pruned {removed} expired chat histories")
 
 class GenStates(StatesGroup):
     waiting_for_prompt = State()
@@ -1257,7 +1934,9 @@ class GenStates(StatesGroup):
     dialogue_standby = State()
     dialogue_confirm = State()
 
-processing_tasks = {}
+album_collector = MediaGroupCollector(min_wait=config.ALBUM_MIN_WAIT, max_wait=config.ALBUM_MAX_WAIT)
+# Отдельные сообщения одного чата (текст + фото по одному) — та же сборка по паузе, ключ — чат
+prompt_collector = MediaGroupCollector(min_wait=config.PROMPT_COLLECT_WAIT, max_wait=config.PROMPT_COLLECT_WAIT)
 
 @dp.message(GenStates.dialogue)
 async def process_dialogue_step(message: types.Message, state: FSMContext):
@@ -1273,11 +1952,55 @@ async def process_dialogue_step(message: types.Message, state: FSMContext):
 @dp.message(GenStates.waiting_for_prompt)
 async def process_prompt_input(message: types.Message, state: FSMContext):
     # This handler catches EVERYTHING: text, photos
-    
+    # Альбом приходит отдельными апдейтами — собираем его целиком, одиночное сообщение обрабатываем сразу
+    if message.media_group_id:
+        album_collector.add(message.media_group_id, message, lambda messages: collect_prompt_messages(messages, state))
+        return
+    await collect_prompt_messages([message], state)
+
+async def collect_prompt_messages(messages: list[types.Message], state: FSMContext):
+    """
+    Текст без фото запускает генерацию сразу, если для чата ничего не собирается и бот
+    не просил прислать фото (`awaiting_refs`). Сообщения с фото, когда фото в генерации
+    возможны (тариф с референсами и модель их принимает), копятся `PROMPT_COLLECT_WAIT` сек.:
+    фото, отправленные по одному, и текст рядом с ними дают одну платную генерацию,
+    а не по одной на сообщение. Набралось фото до лимита тарифа — запуск без ожидания.
+    """
+    message = messages[0]
+    text = next((m.text or m.caption for m in messages if m.text or m.caption), None)
+    key = f"chat:{message.chat.id}"
+    if text and text.lower() in ["отмена", "cancel", "❌ отмена"]:
+        # Отмена сбрасывает и то, что уже собрано
+        prompt_collector.discard(key)
+        await cmd_cancel(message, state)
+        return
+
     data = await state.get_data()
+    user = await get_user(message.from_user.id)
+    max_refs, _ = get_user_limits(user.access_level if user else 'demo')
+    model = data.get('model', 'nano_banana')
+    accepts_refs = MODEL_DISPLAY.get(nano_service.models.get(model, model), {}).get("supports_references", False)
+    wants_refs = any(m.photo for m in messages) or data.get('awaiting_refs')
+    if prompt_collector.get(key) is None and (max_refs == 0 or not accepts_refs or not wants_refs):
+        await process_prompt_messages(messages, state)
+        return
+
+    for m in messages:
+        prompt_collector.add(key, m, lambda collected: process_prompt_messages(collected, state))
+    collected = prompt_collector.get(key) or []
+    photos = sum(1 for m in collected if m.photo)
+    if photos and len(data.get('ref_images', [])) + photos >= max_refs:
+        prompt_collector.flush(key)
+
+async def process_prompt_messages(messages: list[types.Message], state: FSMContext):
+    """Промпт и референсы из одного сообщения или целого альбома; сразу запускает генерацию."""
+    message = messages[0]
+    data = await state.get_data()
+    if data.get('awaiting_refs'):
+        await state.update_data(awaiting_refs=False)
     
-    # 1. Capture Text/Caption
-    text = message.text or message.caption
+    # 1. Capture Text/Caption (в альбоме подпись обычно только у одного элемента)
+    text = next((m.text or m.caption for m in messages if m.text or m.caption), None)
     
     # Check for Cancel explicitly
     if text and text.lower() in ["отмена", "cancel", "❌ отмена"]:
@@ -1287,8 +2010,9 @@ async def process_prompt_input(message: types.Message, state: FSMContext):
     if text and not text.startswith("/"): # Ignore commands just in case
         await state.update_data(prompt=text) # Overwrite prompt with latest text
     
-    # 2. Capture Photos
-    if message.photo:
+    # 2. Capture Photos (Best quality)
+    photos = [m.photo[-1].file_id for m in messages if m.photo]
+    if photos:
         user_level = (await get_user(message.from_user.id)).access_level
         max_refs, _ = get_user_limits(user_level)
         
@@ -1297,26 +2021,15 @@ async def process_prompt_input(message: types.Message, state: FSMContext):
              return
 
         refs = list(data.get('ref_images', []))
-        current_refs_count = len(refs)
-        if current_refs_count >= max_refs:
-            await message.answer(f"⚠️ Лимит фото для вашего уровня: {max_refs}. Это фото не добавлено.")
-            # Don't add, but continue debounce so generation starts with existing refs
-        else:
-            photo = message.photo[-1] # Best quality
-            refs.append(photo.file_id)
+        free = max(0, max_refs - len(refs))
+        if len(photos) > free:
+            # Лишние не добавляем, но генерацию запускаем с тем, что есть
+            await message.answer(f"⚠️ Лимит фото для вашего уровня: {max_refs}. Не добавлено фото: {len(photos) - free}.")
+        if free:
+            refs.extend(photos[:free])
             await state.update_data(ref_images=refs)
 
-    # 3. Debounce (Smart Delay)
-    key = (message.chat.id, message.from_user.id)
-    if key in processing_tasks:
-        processing_tasks[key].cancel()
-    
-    async def delayed_generation():
-        await asyncio.sleep(2.0)
-        del processing_tasks[key]
-        await trigger_generation(message, state)
-
-    processing_tasks[key] = asyncio.create_task(delayed_generation())
+    await trigger_generation(message, state)
 
 
 
@@ -1333,7 +2046,11 @@ async def cmd_help(message: types.Message):
         "Используется для оплаты генераций. Баланс пополняется покупкой пакетов или подпиской.\n\n"
         "**Команды в чате:**\n"
         "--ar X:Y (например --ar 16:9) - Соотношение сторон\n"
-        "--4k - Повышенное разрешение (для Full)\n\n"
+        "--4k - Повышенное разрешение (для Full)\n"
+        "--n 2..4 - Несколько вариантов сразу\n"
+        "--model flash|pro|imagen|basic|ultra - Другая модель\n"
+        "--seed N - Повторяемый результат (Nano Banana)\n"
+        "--no-dialogue - Без режима диалога\n\n"
         "**Поддержка:** @admin_handle"
     )
     await message.answer(text, parse_mode="Markdown")
@@ -1410,11 +2127,18 @@ async def process_dialogue_standby(message: types.Message, state: FSMContext):
          return
 
     # 3. Save Context and show confirmation
+    # Флаги в реплике диалога разбираются так же, как в trigger_generation
+    try:
+        options = parse_prompt_options(dialogue_text)
+    except PromptOptionError as e:
+        await answer_option_error(message, e)
+        return
+
     data = await state.get_data()
-    model = data.get("model", "gemini-3-pro-image-preview")
+    model = options.model or data.get("dialogue_model") or data.get("model", "gemini-3-pro-image-preview")
     # Use same pricing logic as основной триггер, включая надбавки за разрешение
-    resolution = data.get("resolution", "1024x1024")
-    cost = calculate_cost(model, resolution)
+    resolution = options.resolution or data.get("resolution", "1024x1024")
+    cost = calculate_cost(model, resolution) * options.variants
 
     # Show confirmation message with inline buttons
     confirm_markup = InlineKeyboardMarkup(inline_keyboard=[
@@ -1448,11 +2172,10 @@ async def process_dialogue_confirm_callback(callback: CallbackQuery, state: FSMC
     async def finish_dialog():
         # Clear FSM and chat session
         await state.clear()
-        if callback.message.chat.id in chat_sessions:
-            del chat_sessions[callback.message.chat.id]
+        await drop_chat_session(callback.message.chat.id)
         # Temp notification
         finish_msg = await callback.message.answer("✅ Диалог завершен.")
-        asyncio.create_task(delete_message_delayed(finish_msg, 3))
+        delayed_actions.delete_message(finish_msg.chat.id, finish_msg.message_id, 3)
         # Удаляем индикатор "Режим диалога", если есть
         indicator_id = data.get("dialogue_indicator_msg_id")
         if indicator_id:
@@ -1692,81 +2415,7 @@ async def show_config_menu(message: types.Message, state: FSMContext, user: User
     ar = data.get("aspect_ratio", "1:1")
     res = data.get("resolution", "1024x1024")
     
-    meta = MODEL_DISPLAY.get(model, {})
-    price_base = MODEL_PRICES.get(model, 0)
-    supports_res = meta.get("supports_resolution", False)
-    supports_refs = meta.get("supports_references", False)
-    supports_dialogue = meta.get("supports_dialogue", False)
-
-    # Calculate Cost
-    surcharge = 0
-    if supports_res and res in RESOLUTION_SURCHARGES:
-        surcharge = RESOLUTION_SURCHARGES.get(res, 0)
-        
-    total_cost = price_base + surcharge
-    
-    # Build Text
-    text = (
-        f"⚙️ **Настройка генерации**\n\n"
-        f"🧠 Модель: **{meta.get('name', model)}**\n"
-        f"📐 AR: **{ar}**\n"
-    )
-    
-    if supports_res:
-        text += f"🔍 Качество: **{res}**\n"
-    
-    text += f"\n💰 Стоимость: **{total_cost} NC**\n"
-
-    if supports_dialogue:
-        text += "💬 **Поддерживает режим диалога**\n"
-
-    text += "\n✏️ **Введите промпт:**\nПросто напишите, что хотите увидеть.\n"
-
-    # Build markup
-    markup = InlineKeyboardMarkup(inline_keyboard=[])
-
-    # AR Row (Aspect Ratio)
-    ar_row = []
-    # AR options: для Imagen ограничиваемся допустимыми
-    imagen_ar_options = ["1:1", "3:4", "4:3", "9:16", "16:9"]
-    ar_options = imagen_ar_options if meta.get('family') == 'imagen' else ["1:1", "16:9", "9:16", "4:3", "3:4", "21:9", "9:21"]
-    for ratio in ar_options:
-        label = ratio
-        if ratio == ar:
-            label = f"✅ {ratio}"
-        ar_row.append(InlineKeyboardButton(text=label, callback_data=f"create:config:ar:{ratio}"))
-    markup.inline_keyboard.append(ar_row)
-
-    # Res Row (Only if supported)
-    if supports_res:
-        res_row = []
-        # Для Imagen используем 1K/2K; для остальных — прежние
-        options = ["1K", "2K"] if meta.get('family') == 'imagen' else ["1024x1024", "2K", "4K"]
-        
-        user_tariff_rules = TARIFFS.get(user.tariff, TARIFFS['demo'])
-        can_high_res = user_tariff_rules.get('can_use_2k_4k', False)
-        
-        for opt in options:
-            opt_label = "SD" if opt in ["1024x1024", "1K"] else opt
-            if opt in RESOLUTION_SURCHARGES:
-                 opt_label += f" (+{RESOLUTION_SURCHARGES[opt]} NC)"
-            
-            is_locked = False
-            if opt in ["2K", "4K"] and not can_high_res and user.tariff != 'admin':
-                is_locked = True
-                
-            if is_locked:
-                 opt_label = f"🔒 {opt_label}"
-            
-            if opt == res and not is_locked:
-                opt_label = f"✅ {opt_label}"
-            
-            res_row.append(InlineKeyboardButton(text=opt_label, callback_data=f"create:config:res:{opt}"))
-        markup.inline_keyboard.append(res_row)
-    
-    # No "Enter Prompt" button anymore!
-    meta_fam = meta.get('family', 'banana')
-    markup.inline_keyboard.append([InlineKeyboardButton(text="⬅️ Назад к списку", callback_data=f"create:family:{meta_fam}")])
+    text, markup = build_config_menu(model, ar, res, user.tariff)
     
     try:
         await message.edit_text(text, parse_mode="Markdown", reply_markup=markup)
@@ -1778,28 +2427,6 @@ async def show_config_menu(message: types.Message, state: FSMContext, user: User
     # Save ID for later deletion
     await state.update_data(config_message_id=msg_id)
 
-def get_main_menu(tariff: str, balance: int | None = None):
-    profile_label = "👤 Мой кабинет"
-    if balance is not None:
-        profile_label += f" ({balance} NC)"
-    tariff_label = "💎 Тарифы"
-    if tariff:
-        tariff_label += f" ({tariff.upper()})"
-    kb = [
-        [KeyboardButton(text="🎨 К созданию")],
-        [KeyboardButton(text=profile_label), KeyboardButton(text=tariff_label)],
-        [KeyboardButton(text="❓ Помощь")]
-    ]
-    return ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True, one_time_keyboard=True)
-
-def get_minimal_menu():
-    """Returns a minimal reply keyboard with just 'Main Menu'."""
-    kb = [
-        [KeyboardButton(text="🏠 Главное меню")]
-    ]
-    return ReplyKeyboardMarkup(keyboard=kb, resize_keyboard=True, one_time_keyboard=True)
-
-
 @dp.message(CreationStates.waiting_for_prompt)
 async def process_creation_prompt(message: types.Message, state: FSMContext):
     # Capture prompt
@@ -1905,23 +2532,123 @@ async def handle_unknown_text(message: types.Message, state: FSMContext):
     )
     await message.answer(msg, reply_markup=get_main_menu(level, balance), parse_mode="Markdown")
 
+async def prune_result_store_job():
+    removed = await result_store.prune()
+    if removed:
+        logging.info(f"Pruned {removed} stored results")
+
+async def run_worker():
+    """
+    Процесс-воркер (RUN_MODE=worker): апдейты не получает, только выполняет задания
+    из generation_jobs и доставляет результаты через Bot API. Новые задания будят его
+    через LISTEN/NOTIFY, без этого — опрос раз в GEN_JOB_POLL_INTERVAL сек.
+    """
+    spawn(database.listen_generation_jobs(generation_workers.notify))
+    spawn(run_periodic("chat_histories", prune_chat_histories_job, config.CHAT_SESSION_TTL))
+    logging.info(f"Generation worker {generation_workers.owner} started ({config.GEN_WORKERS} workers)")
+    await generation_workers.run()
+
+async def set_bot_commands():
+    try:
+        await bot.set_my_commands([
+            types.BotCommand(command="start", description="Запустить бота"),
+        ])
+    except Exception as e:
+        logging.error(f"Failed to set bot commands: {e}")
+
+async def warm_up_nano_service():
+    """SDK Gemini импортируется в фоне после запуска, а не при импорте main."""
+    try:
+        elapsed = await asyncio.to_thread(nano_service.warm_up)
+        logging.info(f"Gemini client ready in {elapsed:.2f}s")
+    except Exception as e:
+        logging.error(f"Failed to warm up Gemini client: {e}")
+
 async def main():
-    logging.info("Starting bot...")
-    
-    # Set bot commands menu
-    commands = [
-        types.BotCommand(command="start", description="Запустить бота"),
-    ]
-    await bot.set_my_commands(commands)
-    
-    # Wait for DB to be ready
-    await asyncio.sleep(5) 
+    startup_phases.mark("module_init")
+    logging.info(f"Starting bot (RUN_MODE={config.RUN_MODE})...")
+    spawn(loop_lag.run())
+
+    # Меню команд и SDK Gemini не нужны для приема апдейтов — не задерживают запуск
+    if config.RUN_MODE != "worker":
+        spawn(set_bot_commands())
+    if config.RUN_MODE != "bot":
+        spawn(warm_up_nano_service())
+
+    # Цены и тарифы из файла (если задан): первая загрузка — сразу, дальше перезагрузка при изменении.
+    # Если файл битый, остаются встроенные таблицы pricing.py
+    if config.PRICING_FILE:
+        spawn(watch_pricing_file(config.PRICING_FILE, config.PRICING_RELOAD_INTERVAL))
+
+    # Postgres может подниматься одновременно с ботом (docker-compose): проверяем с нарастающей
+    # паузой, если база уже готова — первая же попытка проходит за миллисекунды
+    await wait_ready("Postgres", database.ping, config.DB_STARTUP_TIMEOUT)
+    startup_phases.mark("db_wait")
     try:
         await init_db()
         logging.info("Database initialized.")
     except Exception as e:
         logging.error(f"Failed to init DB: {e}")
+    startup_phases.mark("init_db")
+
+    if result_store is not None:
+        try:
+            await result_store.open()
+        except Exception as e:
+            logging.error(f"Failed to open result store: {e}")
+        startup_phases.mark("result_store")
+
+    if config.RUN_MODE == "worker":
+        # У воркера нет HTTP API — проверки здоровья на отдельном сервере
+        if config.API_PORT:
+            try:
+                await health.start(config.API_HOST, config.API_PORT)
+            except OSError as e:
+                logging.error(f"Failed to start health checks: {e}")
+        logging.info(f"Startup finished in {startup_phases.summary()}")
+        await run_worker()
+        return
+
+    if config.API_PORT:
+        try:
+            await web_api.start(config.API_HOST, config.API_PORT)
+            # Завершение генераций (в том числе в процессах-воркерах) будит потоки статуса SSE
+            spawn(database.listen_notifications({database.STATUS_CHANNEL: web_api.job_changed}))
+            spawn(run_periodic("uploads_prune", uploads.prune, config.UPLOAD_TTL / 4))
+        except OSError as e:
+            logging.error(f"Failed to start web API: {e}")
+        startup_phases.mark("web_api")
+
+    # Истечение подписок проверяется фоном, а не на каждое сообщение
+    spawn(run_periodic("tariff_expiry", sweep_expired_tariffs, config.TARIFF_SWEEP_INTERVAL))
+    spawn(run_periodic("monthly_nc", grant_monthly_nc_job, config.NC_GRANT_INTERVAL))
+    spawn(run_periodic("reconcile_generations", reconcile_stale_generations_job, config.GEN_RECONCILE_INTERVAL))
+    if result_store is not None:
+        spawn(run_periodic("result_store_prune", prune_result_store_job, config.RESULT_PRUNE_INTERVAL))
+
+    # Воркеры очереди генераций: подхватывают и оплаченные задания, брошенные до рестарта.
+    # В режиме bot задания выполняют отдельные процессы worker.py
+    if config.RUN_MODE == "all":
+        spawn(generation_workers.run())
+
+    # Отложенные удаления, не выполненные до рестарта
+    try:
+        restored = await delayed_actions.restore()
+        if restored:
+            logging.info(f"Restored {restored} delayed actions")
+    except Exception as e:
+        logging.error(f"Failed to restore delayed actions: {e}")
+
+    # Незавершенные рассылки продолжаются с сохраненного курсора
+    try:
+        for broadcast in await get_running_broadcasts():
+            logging.info(f"Resuming broadcast {broadcast.id} after user {broadcast.last_user_id}")
+            spawn(run_broadcast(broadcast))
+    except Exception as e:
+        logging.error(f"Failed to resume broadcasts: {e}")
+    startup_phases.mark("restore")
 
+    logging.info(f"Startup finished in {startup_phases.summary()}")
     await dp.start_polling(bot)
 
 if __name__ == "__main__":
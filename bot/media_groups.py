@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+
+# Telegram отдает альбом не больше чем из 10 элементов
+MAX_ALBUM_SIZE = 10
+
+# Ждем тишины в k раз дольше самого большого наблюдаемого интервала между элементами
+GAP_FACTOR = 3.0
+
+
+@dataclass
+class _Album:
+    messages: list
+    on_complete: object
+    last_at: float
+    max_gap: float = 0.0
+    task: asyncio.Task | None = field(default=None, repr=False)
+
+
+class MediaGroupCollector:
+    """
+    Собирает сообщения альбома по `media_group_id` и отдает их одним списком.
+
+    Telegram присылает альбом отдельными апдейтами без признака «последний», поэтому
+    альбом считается собранным после паузы без новых элементов. Пауза адаптивная:
+    `GAP_FACTOR` × наибольший интервал между уже пришедшими элементами, в пределах
+    [min_wait, max_wait]. Полный альбом (10 элементов) отдается сразу.
+    На каждый альбом — одна задача ожидания, без перезапуска таймера на каждый элемент.
+    """
+
+    def __init__(self, min_wait: float = 0.3, max_wait: float = 1.5, clock=time.monotonic, sleep=asyncio.sleep):
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        self._clock = clock
+        self._sleep = sleep
+        self._albums: dict[str, _Album] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        """Сколько альбомов еще собирается."""
+        return len(self._albums)
+
+    def get(self, group_id: str) -> list | None:
+        """Уже собранные элементы группы или None, если она не собирается."""
+        album = self._albums.get(group_id)
+        return album.messages if album else None
+
+    def _wait_for(self, album: _Album) -> float:
+        return min(self.max_wait, max(self.min_wait, album.max_gap * GAP_FACTOR))
+
+    def _start(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def add(self, group_id: str, message, on_complete):
+        """
+        Добавляет элемент альбома. `on_complete(messages)` — корутина, вызывается
+        один раз для всего альбома; для дальнейших элементов того же альбома
+        переданный `on_complete` не используется.
+        """
+        now = self._clock()
+        album = self._albums.get(group_id)
+        if album is None:
+            album = self._albums[group_id] = _Album([message], on_complete, now)
+            album.task = self._start(self._wait(group_id, album))
+            return
+        album.messages.append(message)
+        album.max_gap = max(album.max_gap, now - album.last_at)
+        album.last_at = now
+        if len(album.messages) >= MAX_ALBUM_SIZE:
+            self.flush(group_id)
+
+    def flush(self, group_id: str):
+        """Отдает группу сразу, не дожидаясь паузы (например, набралось нужное число фото)."""
+        album = self._albums.get(group_id)
+        if album is None:
+            return
+        album.task.cancel()
+        self._start(self._complete(group_id, album))
+
+    def discard(self, group_id: str):
+        """Бросает группу без вызова обработчика (пользователь отменил ввод)."""
+        album = self._albums.pop(group_id, None)
+        if album is not None:
+            album.task.cancel()
+
+    async def _wait(self, group_id: str, album: _Album):
+        while True:
+            remaining = album.last_at + self._wait_for(album) - self._clock()
+            if remaining <= 0:
+                break
+            await self._sleep(remaining)
+        await self._complete(group_id, album)
+
+    async def _complete(self, group_id: str, album: _Album):
+        if self._albums.get(group_id) is not album:
+            return
+        del self._albums[group_id]
+        try:
+            await album.on_complete(album.messages)
+        except Exception as e:
+            logging.error(f"Album {group_id} handler failed: {e}")
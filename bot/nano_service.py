@@ -1,55 +1,304 @@
 import asyncio
 import logging
+import time
 import base64
+import json
+from functools import cached_property
 from io import BytesIO
-from google import genai
-from google.genai import types
-from PIL import Image
 from config import config
+from pricing import MODEL_DISPLAY
+from resilience import RetryPolicy, CircuitBreaker, call_with_retry
+from hedging import LatencyTracker, HedgeBudget, hedged
 
 class NanoBananaService:
     def __init__(self):
         self.logger = logging.getLogger("NanoBanana")
-        self.client = genai.Client(api_key=config.GEMINI_API_KEY.get_secret_value())
         # Mapping generic names to specific models
         self.models = {
             "nano_banana": "gemini-2.5-flash-image",
             "nano_banana_pro": "gemini-3-pro-image-preview",
             "imagen": "imagen-4.0-fast-generate-001"
         }
+        self.retry_policy = RetryPolicy(
+            max_attempts=config.GEN_RETRY_ATTEMPTS,
+            base_delay=config.GEN_RETRY_BASE_DELAY,
+            max_delay=config.GEN_RETRY_MAX_DELAY,
+            deadline=config.GEN_RETRY_DEADLINE
+        )
+        # Отдельный автомат на каждую модель: деградация одной не отключает остальные
+        self.breakers: dict[str, CircuitBreaker] = {}
+        # Латентность по моделям (для адаптивной задержки хеджа) и бюджет доп. запросов
+        self.latency: dict[str, LatencyTracker] = {}
+        self.hedge_models = {m.strip() for m in config.HEDGE_MODELS.split(",") if m.strip()}
+        self.hedge_budgets: dict[str, HedgeBudget] = {}
 
-    async def generate_image(self, prompt: str, aspect_ratio: str = "1:1", resolution: str = "1K", model_type: str = "nano_banana_pro", reference_images: list = None, chat_session = None) -> tuple[bytes, int, object]:
+    @cached_property
+    def client(self):
         """
-        Generate an image using the Gemini API.
-        Returns: (image_bytes, token_count, chat_session_obj)
+        Клиент Gemini создается при первом обращении: импорт google.genai занимает секунды,
+        а процессу бота без генераций (RUN_MODE=bot) он не нужен вовсе.
+        """
+        from google import genai
+        return genai.Client(api_key=config.GEMINI_API_KEY.get_secret_value())
+
+    def warm_up(self) -> float:
+        """
+        Импортирует SDK и создает клиент заранее, чтобы первая генерация не ждала.
+        Вызывается в отдельном потоке после запуска. Возвращает затраченное время (сек).
+        """
+        started = time.perf_counter()
+        from google.genai import types  # noqa: F401
+        from PIL import Image  # noqa: F401
+        self.client
+        return time.perf_counter() - started
+
+    def resolve_model(self, model_type: str) -> str:
+        """Возвращает API-имя модели по короткому имени (nano_banana) или полному ID из мастерской."""
+        if model_type in self.models:
+            return self.models[model_type]
+        if model_type in MODEL_DISPLAY:
+            return model_type
+        return self.models["nano_banana_pro"]
+
+    def breaker_for(self, target_model: str) -> CircuitBreaker:
+        breaker = self.breakers.get(target_model)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                target_model,
+                error_rate=config.BREAKER_ERROR_RATE,
+                min_calls=config.BREAKER_MIN_CALLS,
+                window=config.BREAKER_WINDOW,
+                cooldown=config.BREAKER_COOLDOWN
+            )
+            self.breakers[target_model] = breaker
+        return breaker
+
+    def is_available(self, model_type: str) -> tuple[bool, float]:
+        """Проверка до списания средств: (доступна ли модель, через сколько секунд повторить)."""
+        breaker = self.breaker_for(self.resolve_model(model_type))
+        return breaker.allow(), breaker.retry_after()
+
+    def hedge_delay(self, target_model: str) -> float:
+        """Задержка перед дублирующим запросом: наблюдаемый перцентиль латентности в пределах [min, max]."""
+        observed = self.latency.setdefault(target_model, LatencyTracker()).percentile(config.HEDGE_PERCENTILE)
+        if observed is None:
+            return config.HEDGE_DEFAULT_DELAY
+        return min(config.HEDGE_MAX_DELAY, max(config.HEDGE_MIN_DELAY, observed))
+
+    async def _call(self, target_model: str, fn, hedge: bool = False):
+        """
+        Вызов API с повторами и учетом автомата модели.
+        hedge=True допустим только для вызовов без состояния (не чат-сессия).
         """
+        tracker = self.latency.setdefault(target_model, LatencyTracker())
+
+        if hedge and config.HEDGING_ENABLED and target_model in self.hedge_models:
+            budget = self.hedge_budgets.setdefault(target_model, HedgeBudget(ratio=config.HEDGE_BUDGET_RATIO))
+            attempt = lambda: hedged(fn, self.hedge_delay(target_model), budget, tracker)
+        else:
+            async def attempt():
+                started = time.monotonic()
+                result = await fn()
+                tracker.record(time.monotonic() - started)
+                return result
+
+        return await call_with_retry(attempt, self.retry_policy, self.breaker_for(target_model), logger=self.logger)
+
+    @staticmethod
+    def _normalize_resolution(resolution: str) -> str:
         # Map generic resolution strings if they come in legacy format
         res_map = {"1024x1024": "1K", "2048x2048": "2K", "4096x4096": "4K"}
-        final_res = res_map.get(resolution, resolution) # Default to passing through if already 1K/2K
+        return res_map.get(resolution, resolution) # Default to passing through if already 1K/2K
+
+    @staticmethod
+    def _imagen_config(target_model: str, aspect_ratio: str, final_res: str, number_of_images: int = 1):
+        gen_config_args = {
+            "number_of_images": number_of_images,
+            "aspect_ratio": aspect_ratio,
+            "person_generation": "allow_all"  # всегда allow_all по умолчанию
+        }
+        # image_size только для стандарт/ultra (fast не поддерживает)
+        if "fast" not in target_model:
+            gen_config_args["image_size"] = final_res
+        from google.genai import types
+        return types.GenerateImagesConfig(**gen_config_args)
+
+    @staticmethod
+    def _gemini_config(target_model: str, aspect_ratio: str, final_res: str, include_thoughts: bool = False, seed: int | None = None):
+        from google.genai import types
+        image_config_args = {
+             "aspect_ratio": aspect_ratio
+        }
+        config_args = {}
+        if seed is not None:
+            config_args["seed"] = seed
+        
+        # Flash (gemini-2.5-flash-image) supports aspect_ratio BUT NOT image_size (1K triggers error).
+        # Pro (gemini-3-pro) supports both.
+        if "gemini-3-pro" in target_model:
+            image_config_args["image_size"] = final_res
+            # Pro «думает» перед генерацией — при стриминге показываем ход мыслей в статусе
+            if include_thoughts:
+                config_args["thinking_config"] = types.ThinkingConfig(include_thoughts=True)
+        
+        return types.GenerateContentConfig(
+            response_modalities=['IMAGE', 'TEXT'],
+            image_config=types.ImageConfig(**image_config_args),
+            **config_args
+        )
+
+    def _prepare_contents(self, prompt: str, reference_images: list | None) -> list:
+        contents = [prompt]
+        if reference_images:
+            from PIL import Image
+            for img_bytes in reference_images:
+                try:
+                    img = Image.open(BytesIO(img_bytes))
+                    contents.append(img)
+                except Exception as e:
+                    self.logger.error(f"Failed to process ref: {e}")
+        return contents
+
+    def _generate_content(self, target_model: str, prompt: str, reference_images: list | None, config_args):
+        """
+        Синхронный generate_content для asyncio.to_thread. Объекты PIL создаются заново на каждую
+        попытку: хеджированные попытки идут в соседних потоках, а сериализация одного Image
+        из нескольких потоков небезопасна.
+        """
+        return self.client.models.generate_content(
+            model=target_model, contents=self._prepare_contents(prompt, reference_images), config=config_args
+        )
+
+    @staticmethod
+    def _extract_image(response) -> tuple[bytes, int]:
+        token_count = 0
+        if response.usage_metadata:
+            token_count = response.usage_metadata.total_token_count
+
+        for part in response.parts or []:
+            if part.inline_data:
+                return part.inline_data.data, token_count
+
+        raise Exception("No image in response")
+
+    async def _notify(self, on_progress, kind: str, text: str):
+        # Ошибка отображения прогресса не должна ронять генерацию
+        try:
+            await on_progress(kind, text)
+        except Exception as e:
+            self.logger.warning(f"Progress callback failed: {e}")
+
+    async def _stream(self, make_stream, on_progress) -> tuple[bytes, int]:
+        """
+        Читает потоковый ответ в отдельном потоке и передает части в event loop по мере прихода:
+        мысли и текст — в on_progress(kind, text), первое изображение — событием "image".
+        Поток всегда дочитывается до конца, иначе чат-сессия не запишет ход в историю.
+        Returns: (image_bytes, token_count)
+        """
+        loop = asyncio.get_running_loop()
+        chunks: asyncio.Queue = asyncio.Queue()
+        done = object()
+
+        def pump():
+            try:
+                for chunk in make_stream():
+                    loop.call_soon_threadsafe(chunks.put_nowait, chunk)
+            except Exception as e:
+                loop.call_soon_threadsafe(chunks.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(chunks.put_nowait, done)
+
+        reader = asyncio.ensure_future(asyncio.to_thread(pump))
+        image_bytes, token_count, error = None, 0, None
+        while (chunk := await chunks.get()) is not done:
+            if isinstance(chunk, Exception):
+                error = chunk
+                continue
+            if chunk.usage_metadata and chunk.usage_metadata.total_token_count:
+                token_count = chunk.usage_metadata.total_token_count
+            for part in chunk.parts or []:
+                if part.inline_data and not part.thought:
+                    if image_bytes is None:
+                        image_bytes = part.inline_data.data
+                        await self._notify(on_progress, "image", "")
+                elif part.text:
+                    await self._notify(on_progress, "thought" if part.thought else "text", part.text)
+        await reader
+
+        if error:
+            raise error
+        if image_bytes is None:
+            raise Exception("No image in response")
+        return image_bytes, token_count
+
+    async def generate_images(self, prompt: str, aspect_ratio: str = "1:1", resolution: str = "1K", model_type: str = "nano_banana", reference_images: list = None, number_of_images: int = 2, seed: int | None = None) -> tuple[list[bytes], int]:
+        """
+        Несколько вариантов за один запрос пользователя (без диалога).
+        Imagen — один вызов с number_of_images, Gemini — параллельные вызовы.
+        Возвращает (список изображений, токены); если часть вариантов не удалась,
+        возвращаются успешные, ошибка — только если не удалось ни одного.
+        seed (только Gemini) задает первый вариант, остальные — seed+1, seed+2...
+        """
+        final_res = self._normalize_resolution(resolution)
+        target_model = self.resolve_model(model_type)
+        self.logger.info(f"Requests {number_of_images} variants ({model_type}): prompt='{prompt}', res={final_res}, refs={len(reference_images) if reference_images else 0}")
+
+        try:
+            if "imagen" in target_model:
+                response = await self._call(target_model, lambda: asyncio.to_thread(
+                    self.client.models.generate_images,
+                    model=target_model,
+                    prompt=prompt,
+                    config=self._imagen_config(target_model, aspect_ratio, final_res, number_of_images)
+                ), hedge=True)
+                images = [img.image.image_bytes for img in (response.generated_images or []) if img.image]
+                if not images:
+                    raise Exception("No image in Imagen response")
+                return images, 0
+
+            async def one_variant(index: int):
+                config_args = self._gemini_config(
+                    target_model, aspect_ratio, final_res, seed=None if seed is None else (seed + index) % 2**31
+                )
+                response = await self._call(target_model, lambda: asyncio.to_thread(
+                    self._generate_content, target_model, prompt, reference_images, config_args
+                ), hedge=True)
+                return self._extract_image(response)
+
+            results = await asyncio.gather(*(one_variant(i) for i in range(number_of_images)), return_exceptions=True)
+            successes = [r for r in results if not isinstance(r, BaseException)]
+            if not successes:
+                raise results[0]
+            return [img for img, _ in successes], sum(tokens for _, tokens in successes)
+
+        except Exception as e:
+            self.logger.error(f"Variants generation failed: {e}")
+            raise e
+
+    async def generate_image(self, prompt: str, aspect_ratio: str = "1:1", resolution: str = "1K", model_type: str = "nano_banana_pro", reference_images: list = None, chat_session = None, on_progress = None, seed: int | None = None) -> tuple[bytes, int, object]:
+        """
+        Generate an image using the Gemini API.
+        on_progress — async (kind, text): если передан, Gemini отвечает потоково
+        и промежуточные части ("thought"/"text"/"image") приходят по мере генерации.
+        seed фиксирует генерацию Gemini (Imagen его не получает).
+        Returns: (image_bytes, token_count, chat_session_obj)
+        """
+        final_res = self._normalize_resolution(resolution)
 
         self.logger.info(f"Requests gen ({model_type}): prompt='{prompt}', res={final_res}, refs={len(reference_images) if reference_images else 0}")
         
-        target_model = self.models.get(model_type, self.models["nano_banana_pro"])
+        target_model = self.resolve_model(model_type)
 
         try:
             # Special handling for Imagen models which use generate_images
             if "imagen" in target_model:
                 # Imagen 4 (fast/standard/ultra)
-                gen_config_args = {
-                    "number_of_images": 1,
-                    "aspect_ratio": aspect_ratio,
-                    "person_generation": "allow_all"  # всегда allow_all по умолчанию
-                }
-                # image_size только для стандарт/ultra (fast не поддерживает)
-                if "fast" not in target_model:
-                    gen_config_args["image_size"] = final_res
-                
-                response = await asyncio.to_thread(
+                response = await self._call(target_model, lambda: asyncio.to_thread(
                     self.client.models.generate_images,
                     model=target_model,
                     prompt=prompt,
-                    config=types.GenerateImagesConfig(**gen_config_args)
-                )
+                    config=self._imagen_config(target_model, aspect_ratio, final_res)
+                ), hedge=True)
                 if response.generated_images:
                     return response.generated_images[0].image.image_bytes, 0, None  # No token count/chat for Imagen
                 raise Exception("No image in Imagen response")
@@ -57,44 +306,39 @@ class NanoBananaService:
             
             # --- Gemini Flow (Flash/Pro) ---
 
-            # Config construction
-            image_config_args = {
-                 "aspect_ratio": aspect_ratio
-            }
-            
-            # Flash (gemini-2.5-flash-image) supports aspect_ratio BUT NOT image_size (1K triggers error).
-            # Pro (gemini-3-pro) supports both.
-            if "gemini-3-pro" in target_model:
-                image_config_args["image_size"] = final_res
-            
-            config_args = types.GenerateContentConfig(
-                response_modalities=['IMAGE', 'TEXT'],
-                image_config=types.ImageConfig(**image_config_args)
-            )
-
-            # Prepare contents
-            contents = [prompt]
-            if reference_images:
-                for img_bytes in reference_images:
-                    try:
-                        img = Image.open(BytesIO(img_bytes))
-                        contents.append(img)
-                    except Exception as e:
-                        self.logger.error(f"Failed to process ref: {e}")
+            # Хеджированные запросы не стримим: дубль нельзя отменить посреди потока
+            hedgeable = config.HEDGING_ENABLED and target_model in self.hedge_models
+            streaming = on_progress is not None and config.GEN_STREAMING
+            config_args = self._gemini_config(target_model, aspect_ratio, final_res, include_thoughts=streaming, seed=seed)
+            contents = self._prepare_contents(prompt, reference_images)
             
             # --- Chat / Generate Switch ---
             response = None
             
+            if "gemini-3-pro" in target_model and not chat_session:
+                # Pro всегда начинает чат, чтобы можно было продолжить диалог
+                chat_session = self.client.chats.create(model=target_model)
+
+            if streaming and (chat_session or not hedgeable):
+                if chat_session:
+                    make_stream = lambda: chat_session.send_message_stream(message=contents, config=config_args)
+                else:
+                    make_stream = lambda: self.client.models.generate_content_stream(
+                        model=target_model, contents=contents, config=config_args
+                    )
+                image_bytes, token_count = await self._call(target_model, lambda: self._stream(make_stream, on_progress))
+                return image_bytes, token_count, chat_session
+
             # If we already have a session, send message to it
             if chat_session:
-                response = await asyncio.to_thread(
+                response = await self._call(target_model, lambda: asyncio.to_thread(
                     chat_session.send_message,
                     message=contents, # In chat, we send 'message' not 'contents' usually, but SDK unifies this somewhat. 
                     # Actually for chat.send_message, it typically takes a string or list of parts. 
                     # If contents is a list, we might need to be careful. 
                     # Let's trust logic for now or refine if errors.
                     config=config_args
-                )
+                ))
             else:
                 # Fresh generation
                 # If Pro, we might want to START a chat to enable editing later?
@@ -111,36 +355,33 @@ class NanoBananaService:
                 # Actually, the example showed: 
                 # `chat = client.chats.create(...)` then `response = chat.send_message(...)`
                 
-                # So if we want dialogue, we should probably instantiate a chat.
-                
-                if "gemini-3-pro" in target_model:
-                     chat_session = self.client.chats.create(model=target_model)
-                     response = await asyncio.to_thread(
-                        chat_session.send_message,
-                        message=contents,
-                        config=config_args
-                     )
-                else:
-                    # Flash / others
-                    response = await asyncio.to_thread(
-                        self.client.models.generate_content,
-                        model=target_model,
-                        contents=contents,
-                        config=config_args
-                    )
+                # So if we want dialogue, we should probably instantiate a chat
+                # (Pro-чат создается выше, сюда попадают Flash и прочие).
+                response = await self._call(target_model, lambda: asyncio.to_thread(
+                    self._generate_content, target_model, prompt, reference_images, config_args
+                ), hedge=True)
 
-            token_count = 0
-            if response.usage_metadata:
-                token_count = response.usage_metadata.total_token_count
-
-            for part in response.parts:
-                if part.inline_data:
-                    return part.inline_data.data, token_count, chat_session
-            
-            raise Exception("No image in response")
+            image_bytes, token_count = self._extract_image(response)
+            return image_bytes, token_count, chat_session
 
         except Exception as e:
             self.logger.error(f"Generation failed: {e}")
             raise e
 
+    @staticmethod
+    def dump_chat(chat_session, model_id: str) -> str:
+        """
+        Чат-сессия в JSON (модель и история, картинки — base64), чтобы продолжить диалог в другом процессе.
+        `model_id` — API-имя модели, на которой создан чат (`resolve_model`): SDK его публично не отдает.
+        """
+        return json.dumps({
+            "model": model_id,
+            "history": [content.model_dump(mode="json", exclude_none=True) for content in chat_session.get_history()],
+        })
+
+    def load_chat(self, data: str):
+        """Восстанавливает чат-сессию из `dump_chat`."""
+        chat = json.loads(data)
+        return self.client.chats.create(model=chat["model"], history=chat["history"])
+
 nano_service = NanoBananaService()
@@ -1,5 +1,16 @@
 
 # Tariff & Pricing Configuration
+#
+# Значения ниже — встроенные таблицы по умолчанию. Если задан PRICING_FILE,
+# цены, надбавки, тарифы и пакеты загружаются из JSON (см. pricing.example.json)
+# и перечитываются на лету: словари обновляются на месте, а проверки в
+# calculate_cost/validate_request идут по скомпилированным таблицам.
+
+import asyncio
+import json
+import logging
+import os
+from dataclasses import dataclass
 
 # Start bonus for new users (in NC)
 START_BONUS = 1000
@@ -16,12 +27,29 @@ MODEL_PRICES = {
     "gemini-3-pro-image-preview": 400
 }
 
+# Цена модели, которой нет в MODEL_PRICES
+DEFAULT_PRICE = 100
+
+# Модели, к цене которых добавляются надбавки за разрешение
+SURCHARGE_MODELS = ["gemini-3-pro-image-preview"]
+
 # Extra costs (add to base price)
 RESOLUTION_SURCHARGES = {
     "2K": 100, # Base 400 + 100 = 500
     "4K": 350  # Base 400 + 350 = 750 (User Request: 750 for 4K)
 }
 
+# Квоты провайдера на модель (лимиты проекта в Google AI Studio):
+# rpm — запросов в минуту, tpm — токенов в минуту, est_tokens — оценка токенов на запрос
+# (фактический расход учитывается после ответа). Для Imagen токены не считаются.
+MODEL_QUOTAS = {
+    "imagen-4.0-fast-generate-001": {"rpm": 10},
+    "imagen-4.0-generate-001": {"rpm": 10},
+    "imagen-4.0-ultra-generate-001": {"rpm": 5},
+    "gemini-2.5-flash-image": {"rpm": 100, "tpm": 1000000, "est_tokens": 1500},
+    "gemini-3-pro-image-preview": {"rpm": 20, "tpm": 500000, "est_tokens": 2500}
+}
+
 # UI Metadata
 MODEL_DISPLAY = {
     "imagen-4.0-fast-generate-001": {"name": "Imagen 4 (Fast)", "family": "imagen", "short": "Fast", "supports_resolution": False, "supports_references": False, "supports_dialogue": False},
@@ -48,8 +76,10 @@ TARIFFS = {
         "max_resolution": "1024x1024",
         "allowed_resolutions": ["1024x1024"],
         "max_refs": 0, # No refs
+        "max_ref_bytes": 0, # Размер одного референса при загрузке из мини-приложения
         "allowed_ar": ["1:1"], # Only square
-        "can_use_2k_4k": False
+        "can_use_2k_4k": False,
+        "requests_per_minute": 3
     },
     "basic": {
         "price_rub": 390,
@@ -64,8 +94,10 @@ TARIFFS = {
         "max_resolution": "1024x1024",
         "allowed_resolutions": ["1024x1024"],
         "max_refs": 1,
+        "max_ref_bytes": 5 * 1024 * 1024,
         "allowed_ar": ["*"], # All
-        "can_use_2k_4k": False
+        "can_use_2k_4k": False,
+        "requests_per_minute": 6
     },
     "full": {
         "price_rub": 990,
@@ -74,16 +106,32 @@ TARIFFS = {
         "max_resolution": "4K", 
         "allowed_resolutions": ["1024x1024", "2K", "4K"],
         "max_refs": 5,
+        "max_ref_bytes": 10 * 1024 * 1024,
         "allowed_ar": ["*"],
-        "can_use_2k_4k": True
+        "can_use_2k_4k": True,
+        "requests_per_minute": 12
     },
     # Admin gets full access effectively, handled by logic override
     "admin": {
         "can_use_2k_4k": True,
-        "max_refs": 10
+        "max_refs": 10,
+        "max_ref_bytes": 20 * 1024 * 1024,
+        "requests_per_minute": 60
     }
 }
 
+# Веса тарифов в очереди генераций (fair_queue.py): при перегрузке провайдера
+# доли слотов пропорциональны весам, внутри тарифа пользователи обслуживаются по кругу
+TARIFF_WEIGHTS = {
+    "admin": 8,
+    "full": 4,
+    "basic": 2,
+    "demo": 1
+}
+
+# Максимум вариантов за один запрос (`--n`); цена — calculate_cost за каждое изображение
+MAX_VARIANTS = 4
+
 # Top-up Packages
 PACKAGES = {
     "handful": {
@@ -112,17 +160,90 @@ PACKAGES = {
     }
 }
 
+HIGH_RESOLUTIONS = frozenset({"2K", "4K"})
+
+
+@dataclass(frozen=True)
+class TariffRules:
+    """Правила тарифа в виде для быстрых проверок. None в множествах — без ограничений."""
+    name: str
+    allowed_models: frozenset | None
+    allowed_ar: frozenset | None
+    max_refs: int
+    can_use_2k_4k: bool
+    # Тексты отказов собираются при компиляции, а не на каждый запрос
+    refs_error: str
+    ar_error: str
+
+
+@dataclass(frozen=True)
+class PricingTables:
+    """
+    Скомпилированные таблицы: заменяются целиком одной ссылкой, поэтому читатели
+    видят согласованный снимок. Словари внутри после сборки не изменяются.
+    """
+    costs: dict    # model -> {разрешение: цена}; ключ None — базовая цена
+    tariffs: dict  # tariff -> TariffRules
+
+
+def _star_set(values: list) -> frozenset | None:
+    return None if "*" in values else frozenset(values)
+
+
+def compile_tables(model_prices: dict, surcharges: dict, surcharge_models: list, tariffs: dict) -> PricingTables:
+    """Собирает таблицы поиска из словарей в формате этого модуля. Raises: ValueError/KeyError/TypeError."""
+    costs = {model: {None: int(price)} for model, price in model_prices.items()}
+    for model in surcharge_models:
+        prices = costs.setdefault(model, {None: DEFAULT_PRICE})
+        for res, extra in surcharges.items():
+            # Оба регистра, чтобы не вызывать upper() на каждый запрос
+            prices[res.upper()] = prices[res.lower()] = prices[None] + int(extra)
+
+    rules = {}
+    for name, tariff in tariffs.items():
+        if name == "admin":
+            continue  # admin проверяется отдельно и не ограничивается
+        max_refs = int(tariff["max_refs"])
+        allowed_ar = _star_set(tariff["allowed_ar"])
+        if allowed_ar == {"1:1"}:
+            ar_error = f"❌ Тариф {name.upper()} поддерживает только соотношение 1:1 (квадрат)."
+        else:
+            ar_error = f"❌ Тариф {name.upper()} поддерживает соотношения: {', '.join(sorted(allowed_ar or []))}."
+        rules[name] = TariffRules(
+            name=name,
+            allowed_models=_star_set(tariff["allowed_models"]),
+            allowed_ar=allowed_ar,
+            max_refs=max_refs,
+            can_use_2k_4k=bool(tariff["can_use_2k_4k"]),
+            refs_error=("❌ Загрузка изображений доступна с тарифа БАЗОВЫЙ." if max_refs == 0
+                        else f"❌ Тариф {name.upper()} позволяет максимум {max_refs} референс(ов)."),
+            ar_error=ar_error,
+        )
+    if "demo" not in rules:
+        raise ValueError("В тарифах нет demo (используется по умолчанию)")
+
+    return PricingTables(costs=costs, tariffs=rules)
+
+
+_tables = compile_tables(MODEL_PRICES, RESOLUTION_SURCHARGES, SURCHARGE_MODELS, TARIFFS)
+
+
+def current_tables() -> PricingTables:
+    """Текущий снимок таблиц. После каждой перезагрузки цен — новый объект (ключ для кешей)."""
+    return _tables
+
+
+def price_table() -> dict:
+    """Текущие цены как JSON-совместимый словарь {model: {resolution или "": цена}} — для расчетов в SQL."""
+    return {model: {res or "": price for res, price in prices.items()} for model, prices in _tables.costs.items()}
+
+
 def calculate_cost(model: str, resolution: str) -> int:
     """Calculates the cost of a generation request."""
-    base_cost = MODEL_PRICES.get(model, 100) # Default safe fallback
-    
-    # Handle resolution surcharge for Gemini 3 Pro
-    if model == "gemini-3-pro-image-preview":
-        res_upper = resolution.upper() if resolution else "1024x1024"
-        if res_upper in RESOLUTION_SURCHARGES:
-            base_cost += RESOLUTION_SURCHARGES[res_upper]
-            
-    return base_cost
+    prices = _tables.costs.get(model)
+    if prices is None:
+        return DEFAULT_PRICE # Default safe fallback
+    return prices.get(resolution, prices[None])
 
 def validate_request(tariff: str, model: str, resolution: str, ref_count: int, ar: str) -> tuple[bool, str]:
     """
@@ -131,29 +252,88 @@ def validate_request(tariff: str, model: str, resolution: str, ref_count: int, a
     """
     if tariff == 'admin':
         return True, ""
-        
-    rules = TARIFFS.get(tariff, TARIFFS['demo']) # Fallback to demo
+
+    tariffs = _tables.tariffs
+    rules = tariffs.get(tariff) or tariffs['demo'] # Fallback to demo
     
     # 1. Model Check
-    if "*" not in rules['allowed_models'] and model not in rules['allowed_models']:
+    if rules.allowed_models is not None and model not in rules.allowed_models:
         return False, f"❌ Модель {model} недоступна на тарифе {tariff.upper()}."
         
     # 2. Resolution Check (specifically for 2K/4K)
-    res_upper = resolution.upper() if resolution else "1024x1024"
-    if res_upper in ["2K", "4K"] and not rules['can_use_2k_4k']:
-        return False, f"❌ Разрешение {res_upper} доступно только на тарифе ПОЛНЫЙ."
+    if resolution and not rules.can_use_2k_4k:
+        res_upper = resolution.upper()
+        if res_upper in HIGH_RESOLUTIONS:
+            return False, f"❌ Разрешение {res_upper} доступно только на тарифе ПОЛНЫЙ."
         
     # 3. Ref Check
-    if ref_count > rules['max_refs']:
-        if rules['max_refs'] == 0:
-             return False, "❌ Загрузка изображений доступна с тарифа БАЗОВЫЙ."
-        return False, f"❌ Тариф {tariff.upper()} позволяет максимум {rules['max_refs']} референс(ов)."
+    if ref_count > rules.max_refs:
+        return False, rules.refs_error
         
     # 4. AR Check
-    if "*" not in rules['allowed_ar']:
-        # If strict AR, check if it matches allowed (mostly 1:1)
-        # We need to normalize current strict check implies only 1:1 is allowed for Demo
-        if ar != "1:1":
-             return False, f"❌ Тариф {tariff.upper()} поддерживает только соотношение 1:1 (квадрат)."
+    if rules.allowed_ar is not None and ar not in rules.allowed_ar:
+        return False, rules.ar_error
 
     return True, ""
+
+
+# --- Загрузка из файла и горячая перезагрузка ---
+
+# Секции JSON-файла и словари модуля, которые они заменяют
+PRICING_SECTIONS = {
+    "model_prices": MODEL_PRICES,
+    "resolution_surcharges": RESOLUTION_SURCHARGES,
+    "tariffs": TARIFFS,
+    "packages": PACKAGES,
+}
+
+
+def load_pricing(path: str):
+    """
+    Читает JSON с таблицами, компилирует их и атомарно подменяет текущие.
+    Отсутствующие секции остаются прежними. При ошибке в файле ничего не меняется.
+    Raises: OSError, ValueError (в т.ч. json.JSONDecodeError), KeyError, TypeError.
+    """
+    global _tables
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if not isinstance(data, dict):
+        raise ValueError("Ожидается JSON-объект с секциями таблиц")
+
+    sections = {name: data.get(name, current) for name, current in PRICING_SECTIONS.items()}
+    surcharge_models = data.get("surcharge_models", SURCHARGE_MODELS)
+    # Сначала компилируем: невалидный файл не должен оставить таблицы в полуобновленном виде
+    tables = compile_tables(sections["model_prices"], sections["resolution_surcharges"], surcharge_models, sections["tariffs"])
+
+    _tables = tables
+    for name, current in PRICING_SECTIONS.items():
+        if sections[name] is not current:
+            current.clear()
+            current.update(sections[name])
+    if surcharge_models is not SURCHARGE_MODELS:
+        SURCHARGE_MODELS[:] = surcharge_models
+
+
+async def watch_pricing_file(path: str, interval: float = 5.0):
+    """
+    Следит за mtime файла цен и перезагружает таблицы при изменении.
+    Уже запущенные генерации не затрагиваются: их цена посчитана до списания.
+    Подмена выполняется без await, поэтому обработчики видят либо старые, либо новые таблицы.
+    """
+    last_mtime = None
+    while True:
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError as e:
+            if last_mtime is not None:
+                logging.error(f"Pricing file unavailable, keeping current tables: {e}")
+            mtime = None
+        if mtime is not None and mtime != last_mtime:
+            try:
+                load_pricing(path)
+                logging.info(f"Pricing loaded from {path}")
+            except Exception as e:
+                # Битый файл — остаемся на прежних таблицах до следующего изменения
+                logging.error(f"Failed to load pricing from {path}: {e}")
+        last_mtime = mtime
+        await asyncio.sleep(interval)
@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import re
+import time
+
+# Символы разметки Markdown, которые ломают статус при вставке текста модели
+MARKDOWN_CHARS_RE = re.compile(r'[*_`\[\]]')
+# Мысли Gemini обычно начинаются с заголовка вида **Planning the scene**
+THOUGHT_TITLE_RE = re.compile(r'\*\*(.+?)\*\*')
+
+PROGRESS_SNIPPET_LEN = 120
+
+
+def progress_line(kind: str, text: str) -> str:
+    """Строка прогресса для статусного сообщения по событию потоковой генерации."""
+    if kind == "image":
+        return "🖼 Изображение готово, отправляю..."
+    match = THOUGHT_TITLE_RE.search(text) if kind == "thought" else None
+    if match:
+        snippet = match.group(1)
+    else:
+        lines = text.strip().splitlines()
+        snippet = lines[0] if lines else ""
+    snippet = MARKDOWN_CHARS_RE.sub('', snippet).strip()
+    if len(snippet) > PROGRESS_SNIPPET_LEN:
+        snippet = snippet[:PROGRESS_SNIPPET_LEN] + "..."
+    if not snippet:
+        return ""
+    icon = "💭" if kind == "thought" else "✍️"
+    return f"{icon} {snippet}"
+
+
+class StatusUpdater:
+    """
+    Редактирует статусное сообщение не чаще раза в `interval` секунд.
+    Обновления внутри интервала схлопываются: по его истечении отправляется
+    только последнее. Ошибки редактирования (сообщение удалено, текст
+    не изменился) игнорируются — статус не должен ронять генерацию.
+    """
+
+    def __init__(self, edit, interval: float, clock=time.monotonic, sleep=asyncio.sleep):
+        self._edit = edit
+        self.interval = interval
+        self._clock = clock
+        self._sleep = sleep
+        self._sent_at: float | None = None
+        self._sent_text: str | None = None
+        self._pending: str | None = None
+        self._timer: asyncio.Task | None = None
+        self._closed = False
+
+    async def update(self, text: str):
+        if self._closed or text == self._sent_text:
+            return
+        self._pending = text
+        wait = 0.0 if self._sent_at is None else self._sent_at + self.interval - self._clock()
+        if wait <= 0:
+            await self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later(wait))
+
+    async def _flush_later(self, delay: float):
+        await self._sleep(delay)
+        self._timer = None
+        await self._flush()
+
+    async def _flush(self):
+        text, self._pending = self._pending, None
+        if text is None or self._closed:
+            return
+        self._sent_at = self._clock()
+        self._sent_text = text
+        try:
+            await self._edit(text)
+        except Exception as e:
+            logging.debug(f"Status edit skipped: {e}")
+
+    def close(self):
+        """Останавливает обновления (перед удалением статусного сообщения)."""
+        self._closed = True
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
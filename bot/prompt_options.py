@@ -0,0 +1,126 @@
+import re
+from dataclasses import dataclass
+
+from pricing import MAX_VARIANTS, MODEL_DISPLAY
+
+# Грамматика флагов промпта, компилируется один раз при импорте.
+# Флаг начинается с тире (-, --, —, –) в начале строки или после пробела
+# и заканчивается пробелом или концом строки; значение — следующее слово.
+# Неизвестные флаги остаются частью промпта.
+OPTION_RE = re.compile(r'''
+    [-—–](?<!\S[-—–])-?    # тире не после буквы; с символа-класса начинается быстрый поиск
+    (?:
+        (?P<switch>no-dialogue|[124]k)
+      | (?P<flag>ar|n|model|seed)(?:\s+(?P<value>\S+))?
+    )
+    (?=\s|$)
+''', re.IGNORECASE | re.VERBOSE)
+
+AR_VALUE_RE = re.compile(r'\d+:\d+')
+INT_VALUE_RE = re.compile(r'\d+')
+
+# Короткие имена моделей для --model (плюс полные ID из MODEL_DISPLAY)
+MODEL_ALIASES = {
+    "flash": "gemini-2.5-flash-image",
+    "banana": "gemini-2.5-flash-image",
+    "pro": "gemini-3-pro-image-preview",
+    "imagen": "imagen-4.0-fast-generate-001",
+    "fast": "imagen-4.0-fast-generate-001",
+    "basic": "imagen-4.0-generate-001",
+    "ultra": "imagen-4.0-ultra-generate-001",
+    **{model_id: model_id for model_id in MODEL_DISPLAY},
+}
+
+MAX_SEED = 2**31 - 1
+
+
+class PromptOptionError(ValueError):
+    """Некорректный флаг в промпте. `option` — имя флага, `message` — текст для пользователя."""
+
+    def __init__(self, option: str, message: str):
+        super().__init__(message)
+        self.option = option
+        self.message = message
+
+
+@dataclass
+class PromptOptions:
+    """Результат разбора промпта. None — флаг не указан, действует значение из настроек."""
+    prompt: str
+    aspect_ratio: str | None = None
+    resolution: str | None = None
+    variants: int = 1
+    model: str | None = None
+    seed: int | None = None
+    no_dialogue: bool = False
+
+
+def _require(option: str, value: str | None, pattern: re.Pattern, hint: str) -> str:
+    if value is None or not pattern.fullmatch(value):
+        raise PromptOptionError(option, f"Неверное значение `--{option}`: {hint}.")
+    return value
+
+
+def _apply(options: PromptOptions, switch: str | None, flag: str | None, value: str | None):
+    """Записывает один флаг в `options`. Raises: PromptOptionError — тогда `options` не меняются."""
+    if switch:
+        switch = switch.lower()
+        if switch == "no-dialogue":
+            options.no_dialogue = True
+        else:
+            options.resolution = switch.upper()
+        return
+
+    flag = flag.lower()
+    if flag == "ar":
+        options.aspect_ratio = _require("ar", value, AR_VALUE_RE, "ожидается формат `16:9`")
+    elif flag == "n":
+        variants = int(_require("n", value, INT_VALUE_RE, f"ожидается число от 1 до {MAX_VARIANTS}"))
+        if not 1 <= variants <= MAX_VARIANTS:
+            raise PromptOptionError("n", f"Количество вариантов `--n` — от 1 до {MAX_VARIANTS}.")
+        options.variants = variants
+    elif flag == "model":
+        model = MODEL_ALIASES.get((value or "").lower())
+        if model is None:
+            aliases = ", ".join(alias for alias in MODEL_ALIASES if alias not in MODEL_DISPLAY)
+            raise PromptOptionError("model", f"Неизвестная модель `--model`. Доступны: {aliases}.")
+        options.model = model
+    else:
+        seed = int(_require("seed", value, INT_VALUE_RE, f"ожидается число от 0 до {MAX_SEED}"))
+        if seed > MAX_SEED:
+            raise PromptOptionError("seed", f"Неверное значение `--seed`: ожидается число от 0 до {MAX_SEED}.")
+        options.seed = seed
+
+
+def parse_prompt_options(text: str) -> PromptOptions:
+    """
+    Разбирает флаги промпта за один проход:
+    `--ar X:Y`, `--1k/--2k/--4k`, `--n N`, `--model NAME`, `--seed N`, `--no-dialogue`.
+    Повторный флаг переопределяет предыдущий. Флаг с одним дефисом (`-n`) — флаг,
+    только если значение подходит, иначе это обычный текст («rock -n roll»).
+    Raises: PromptOptionError при неверном значении флага с `--` или длинным тире.
+    """
+    # Без тире флагов быть не может — обычный промпт не прогоняем через грамматику
+    if "-" not in text and "—" not in text and "–" not in text:
+        return PromptOptions(prompt=text.strip())
+
+    options = PromptOptions(prompt="")
+    pieces = []
+    pos = 0
+    for match in OPTION_RE.finditer(text):
+        try:
+            _apply(options, *match.groups())
+        except PromptOptionError:
+            if match.group(0).startswith("-") and not match.group(0).startswith("--"):
+                continue
+            raise
+        start, end = match.span()
+        pieces.append(text[pos:start])
+        pos = end
+
+    if not pieces:
+        options.prompt = text.strip()
+        return options
+    pieces.append(text[pos:])
+    options.prompt = " ".join(filter(None, map(str.strip, pieces)))
+    return options
@@ -0,0 +1,148 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Классический token bucket: `rate` единиц в секунду, не больше `capacity`.
+    Баланс может уйти в минус через `adjust` — так учитывается фактический
+    расход токенов, который становится известен только после ответа модели.
+    """
+
+    def __init__(self, rate: float, capacity: float, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self._clock = clock
+        self.tokens = capacity
+        self._updated = clock()
+
+    def _refill(self):
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self, amount: float = 1.0) -> float:
+        """Через сколько секунд в корзине будет `amount` единиц (0 — уже есть)."""
+        self._refill()
+        # Запрос больше емкости пропускаем на полной корзине, иначе он не пройдет никогда
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float = 1.0):
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+    def adjust(self, delta: float):
+        """Корректирует баланс (отрицательное значение — доплата за перерасход)."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + delta)
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+
+class RateLimiter:
+    """
+    Ограничение частоты запросов к провайдеру перед списанием NC.
+
+    Глобально на модель — RPM и TPM из квот проекта (`MODEL_QUOTAS`),
+    на пользователя — RPM по тарифу (`TARIFFS[...]["requests_per_minute"]`).
+    Все корзины проверяются до списания, поэтому отказ ничего не расходует.
+
+    Корзины живут в памяти процесса. Квоты модели (`per_model`) имеет смысл расходовать
+    там, где идут вызовы модели и приходит фактический расход для `settle`, —
+    в процессе бота это только персональный лимит (`per_user`).
+    """
+
+    # Сколько пользовательских корзин держать до очистки полных (неактивных)
+    PRUNE_THRESHOLD = 10000
+
+    def __init__(self, model_quotas: dict, tariffs: dict, clock=time.monotonic, sleep=asyncio.sleep):
+        self._clock = clock
+        self._sleep = sleep
+        self.tariffs = tariffs
+        self.model_quotas = model_quotas
+        self.model_rpm: dict[str, TokenBucket] = {}
+        self.model_tpm: dict[str, TokenBucket] = {}
+        for model, quota in model_quotas.items():
+            if quota.get("rpm"):
+                self.model_rpm[model] = TokenBucket(quota["rpm"] / 60, quota["rpm"], clock)
+            if quota.get("tpm"):
+                self.model_tpm[model] = TokenBucket(quota["tpm"] / 60, quota["tpm"], clock)
+        self.users: dict[int, TokenBucket] = {}
+
+    def estimated_tokens(self, model: str) -> int:
+        return self.model_quotas.get(model, {}).get("est_tokens", 0)
+
+    def _user_bucket(self, user_id: int, tariff: str) -> TokenBucket | None:
+        rpm = self.tariffs.get(tariff, {}).get("requests_per_minute")
+        if not rpm:
+            return None
+        bucket = self.users.get(user_id)
+        if bucket is None or bucket.capacity != rpm:
+            if len(self.users) >= self.PRUNE_THRESHOLD:
+                self.prune()
+            bucket = TokenBucket(rpm / 60, rpm, self._clock)
+            self.users[user_id] = bucket
+        return bucket
+
+    def prune(self):
+        """Удаляет корзины пользователей, которые давно ничего не запрашивали (полные)."""
+        for user_id in [uid for uid, bucket in self.users.items() if bucket.is_full()]:
+            del self.users[user_id]
+
+    def _buckets(self, user_id: int, tariff: str | None, model: str, requests: int,
+                 per_user: bool, per_model: bool) -> list[tuple[TokenBucket, float]]:
+        checks = []
+        if per_user:
+            user_bucket = self._user_bucket(user_id, tariff) if tariff is not None else self.users.get(user_id)
+            checks.append((user_bucket, 1))
+        if per_model:
+            checks += [(self.model_rpm.get(model), requests),
+                       (self.model_tpm.get(model), self.estimated_tokens(model) * requests)]
+        return [(bucket, amount) for bucket, amount in checks if bucket is not None and amount]
+
+    def try_acquire(self, user_id: int, tariff: str, model: str, requests: int = 1,
+                    per_user: bool = True, per_model: bool = True) -> float:
+        """
+        Пытается занять слот во всех корзинах сразу.
+        `requests` — сколько вызовов модели породит запрос (варианты `--n`):
+        квоты модели расходуются на каждый, персональный лимит — один раз.
+        Возвращает 0, если слот занят, иначе — сколько секунд ждать.
+        """
+        checks = self._buckets(user_id, tariff, model, requests, per_user, per_model)
+        eta = max((bucket.wait_time(amount) for bucket, amount in checks), default=0.0)
+        if eta > 0:
+            return eta
+        for bucket, amount in checks:
+            bucket.consume(amount)
+        return 0.0
+
+    async def acquire(self, user_id: int, tariff: str, model: str, max_wait: float, requests: int = 1,
+                      per_user: bool = True, per_model: bool = True) -> float:
+        """
+        Ждет слот не дольше `max_wait` секунд.
+        Возвращает 0 при успехе или ETA в секундах, если ждать пришлось бы дольше.
+        """
+        deadline = self._clock() + max_wait
+        while True:
+            eta = self.try_acquire(user_id, tariff, model, requests, per_user, per_model)
+            if eta == 0:
+                return 0.0
+            if self._clock() + eta > deadline:
+                return eta
+            await self._sleep(eta)
+
+    def settle(self, model: str, actual_tokens: int, requests: int = 1):
+        """Учитывает разницу между оценкой и фактическим расходом токенов."""
+        bucket = self.model_tpm.get(model)
+        if bucket is not None and actual_tokens:
+            bucket.adjust(self.estimated_tokens(model) * requests - actual_tokens)
+
+    def release(self, user_id: int, model: str, requests: int = 1, per_user: bool = True, per_model: bool = True):
+        """Возвращает слот, если запрос так и не был отправлен провайдеру (те же корзины, что в acquire)."""
+        for bucket, amount in self._buckets(user_id, None, model, requests, per_user, per_model):
+            bucket.adjust(amount)
@@ -0,0 +1,197 @@
+import asyncio
+import random
+import time
+from collections import deque
+from dataclasses import dataclass
+
+# HTTP-коды провайдера, при которых повтор имеет смысл (перегрузка, таймауты, 5xx)
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+# Сетевые ошибки транспорта (httpx внутри google-genai), распознаются по имени класса,
+# чтобы не тянуть httpx в зависимости этого модуля
+RETRYABLE_EXCEPTION_NAMES = {
+    "ConnectError", "ConnectTimeout", "ReadTimeout", "WriteTimeout", "PoolTimeout",
+    "ReadError", "RemoteProtocolError", "ServerDisconnectedError",
+}
+
+
+class CircuitOpenError(Exception):
+    """Модель временно отключена автоматом (circuit breaker) — запрос не отправляется."""
+
+    def __init__(self, model: str, retry_after: float):
+        self.model = model
+        self.retry_after = retry_after
+        super().__init__(
+            f"Модель {model} сейчас перегружена у провайдера. "
+            f"Попробуйте через ~{max(1, round(retry_after))} сек. или выберите другую модель."
+        )
+
+
+def is_retryable(exc: BaseException) -> bool:
+    """Определяет, стоит ли повторять запрос после ошибки."""
+    code = getattr(exc, "code", None)
+    if not isinstance(code, int):
+        code = getattr(exc, "status_code", None)
+    if isinstance(code, int):
+        return code in RETRYABLE_STATUS
+    if isinstance(exc, (TimeoutError, ConnectionError)):
+        return True
+    return type(exc).__name__ in RETRYABLE_EXCEPTION_NAMES
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """Параметры повторов: экспоненциальная задержка с полным джиттером и общий дедлайн."""
+    max_attempts: int = 3
+    base_delay: float = 1.0
+    max_delay: float = 8.0
+    deadline: float = 120.0
+
+    def backoff(self, attempt: int, rand=random.random) -> float:
+        """Задержка перед повтором номер `attempt` (с 1)."""
+        cap = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return cap * rand()
+
+
+class CircuitBreaker:
+    """
+    Автомат отключения модели по доле ошибок в скользящем окне.
+
+    closed    — запросы идут, исходы копятся в окне;
+    open      — запросы сразу отклоняются до истечения cooldown;
+    half_open — пропускается одна пробная попытка: успех закрывает автомат, ошибка снова открывает,
+                нейтральный исход (`record_neutral`) только освобождает место для следующей пробы.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, error_rate: float = 0.5, min_calls: int = 5,
+                 window: float = 60.0, cooldown: float = 30.0, clock=time.monotonic):
+        self.name = name
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.cooldown = cooldown
+        self._clock = clock
+        self._outcomes: deque = deque()  # (timestamp, ok)
+        self.state = self.CLOSED
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    def _trim(self, now: float):
+        while self._outcomes and now - self._outcomes[0][0] > self.window:
+            self._outcomes.popleft()
+
+    def retry_after(self) -> float:
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self._opened_at + self.cooldown - self._clock())
+
+    def allow(self) -> bool:
+        """Можно ли сейчас отправить запрос (без побочных эффектов для closed)."""
+        if self.state == self.OPEN and self.retry_after() <= 0:
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+        if self.state == self.OPEN:
+            return False
+        if self.state == self.HALF_OPEN:
+            return not self._probe_in_flight
+        return True
+
+    def before_call(self):
+        """Резервирует попытку или бросает CircuitOpenError."""
+        if not self.allow():
+            raise CircuitOpenError(self.name, self.retry_after() or self.cooldown)
+        if self.state == self.HALF_OPEN:
+            self._probe_in_flight = True
+
+    def record_success(self):
+        if self.state == self.HALF_OPEN:
+            self._reset()
+            return
+        self._record(True)
+
+    def record_neutral(self):
+        """Исход, ничего не говорящий о здоровье провайдера: в окно не пишется, автомат не закрывает."""
+        if self.state == self.HALF_OPEN:
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        if self.state == self.HALF_OPEN:
+            self._open()
+            return
+        self._record(False)
+        failures = sum(1 for _, ok in self._outcomes if not ok)
+        if len(self._outcomes) >= self.min_calls and failures / len(self._outcomes) >= self.error_rate:
+            self._open()
+
+    def _record(self, ok: bool):
+        now = self._clock()
+        self._outcomes.append((now, ok))
+        self._trim(now)
+
+    def _open(self):
+        self.state = self.OPEN
+        self._opened_at = self._clock()
+        self._probe_in_flight = False
+        self._outcomes.clear()
+
+    def _reset(self):
+        self.state = self.CLOSED
+        self._probe_in_flight = False
+        self._outcomes.clear()
+
+    def snapshot(self) -> dict:
+        """Состояние автомата для логов и проверок здоровья."""
+        self._trim(self._clock())
+        failures = sum(1 for _, ok in self._outcomes if not ok)
+        return {
+            "state": self.state,
+            "calls": len(self._outcomes),
+            "failures": failures,
+            "retry_after": round(self.retry_after(), 1),
+        }
+
+
+async def call_with_retry(fn, policy: RetryPolicy, breaker: CircuitBreaker | None = None,
+                          retryable=is_retryable, sleep=asyncio.sleep, clock=time.monotonic, logger=None):
+    """
+    Выполняет `await fn()` с повторами по политике и учетом автомата.
+
+    В автомат засчитываются только повторяемые ошибки (перегрузка, 5xx, сеть):
+    отказ модерации или неверный запрос не говорит о здоровье провайдера и считается
+    нейтральным — ни успехом, ни ошибкой.
+    """
+    deadline = clock() + policy.deadline
+    attempt = 0
+    while True:
+        if breaker:
+            breaker.before_call()
+        attempt += 1
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            if breaker:
+                breaker.record_neutral()
+            raise
+        except Exception as e:
+            can_retry = retryable(e)
+            if breaker:
+                if can_retry:
+                    breaker.record_failure()
+                else:
+                    breaker.record_neutral()
+            if not can_retry or attempt >= policy.max_attempts:
+                raise
+            delay = policy.backoff(attempt)
+            if clock() + delay > deadline:
+                raise
+            if logger:
+                logger.warning(f"Attempt {attempt} failed ({e}), retrying in {delay:.1f}s")
+            await sleep(delay)
+            continue
+        if breaker:
+            breaker.record_success()
+        return result
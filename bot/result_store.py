@@ -0,0 +1,285 @@
+import asyncio
+import hashlib
+import hmac
+import logging
+import mmap
+import os
+import re
+import time
+import uuid
+import xml.etree.ElementTree as ET
+from datetime import datetime, timezone
+from urllib.parse import quote, unquote, urlsplit
+
+import aiohttp
+from yarl import URL
+
+RESULT_HASH_RE = re.compile(r"[0-9a-f]{64}")
+
+# Недописанные временные файлы старше этого (сек) — остатки упавшего процесса
+STALE_TMP_AGE = 3600
+
+S3_NS = "{http://s3.amazonaws.com/doc/2006-03-01/}"
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def shard_path(digest: str) -> str:
+    """ab/cd/abcd… — два уровня каталогов, чтобы в одном каталоге не копились миллионы файлов."""
+    if not RESULT_HASH_RE.fullmatch(digest):
+        raise ValueError(f"Invalid result hash: {digest!r}")
+    return f"{digest[:2]}/{digest[2:4]}/{digest}"
+
+
+def _expired(files: list[tuple[float, int, str]], now: float, max_age: float, max_bytes: int) -> list[str]:
+    """
+    Что удалить из `files` [(mtime, size, key)]: старше `max_age` сек., затем самые старые,
+    пока общий объем больше `max_bytes`. 0 — без ограничения.
+    """
+    files = sorted(files)
+    cutoff = now - max_age if max_age else float("-inf")
+    drop = [key for mtime, _, key in files if mtime < cutoff]
+    files = [f for f in files if f[0] >= cutoff]
+    if max_bytes:
+        total = sum(size for _, size, _ in files)
+        for _, size, key in files:
+            if total <= max_bytes:
+                break
+            drop.append(key)
+            total -= size
+    return drop
+
+
+class LocalResultStore:
+    """
+    Хранилище результатов генераций в локальном каталоге, адресуемое по содержимому.
+
+    Ключ — SHA-256 изображения, файл лежит в `root/ab/cd/<hash>`: одинаковые
+    результаты хранятся один раз, запись идемпотентна. Файл пишется во временный
+    и переименовывается, поэтому читатель не увидит недописанный результат.
+    `get` отдает файл через mmap (bytes-like, без копирования в память процесса).
+    Файловые операции выполняются в потоке, чтобы не блокировать event loop.
+    """
+
+    def __init__(self, root: str, max_age: float = 0, max_bytes: int = 0, clock=time.time):
+        self.root = root
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self._clock = clock
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, shard_path(digest))
+
+    async def open(self):
+        await asyncio.to_thread(os.makedirs, self.root, exist_ok=True)
+
+    async def close(self):
+        pass
+
+    async def put(self, data: bytes) -> str:
+        """Сохраняет изображение и возвращает его хеш."""
+        return await asyncio.to_thread(self._put, data)
+
+    def _put(self, data: bytes) -> str:
+        digest = content_hash(data)
+        path = self.path(digest)
+        if os.path.exists(path):
+            # Повторный результат: продлеваем срок хранения
+            os.utime(path)
+            return digest
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        return digest
+
+    async def get(self, digest: str):
+        """Содержимое результата (mmap) или None, если его нет или он удален по сроку хранения."""
+        return await asyncio.to_thread(self._get, digest)
+
+    def _get(self, digest: str):
+        try:
+            with open(self.path(digest), "rb") as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return b""
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return None
+
+    async def prune(self) -> int:
+        """Удаляет результаты по сроку хранения и пределу объема. Возвращает число удаленных."""
+        return await asyncio.to_thread(self._prune)
+
+    def _prune(self) -> int:
+        now = self._clock()
+        files = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if name.endswith(".tmp"):
+                    if st.st_mtime < now - STALE_TMP_AGE:
+                        os.remove(path)
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+        drop = _expired(files, now, self.max_age, self.max_bytes)
+        for path in drop:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        return len(drop)
+
+
+def sign_v4(method: str, url: str, headers: dict, payload_hash: str, access_key: str, secret_key: str,
+            region: str, service: str = "s3", now: datetime | None = None) -> dict:
+    """
+    Подпись запроса AWS Signature Version 4. `url` уже закодирован (путь и query).
+    Возвращает заголовки запроса вместе с Authorization.
+    """
+    now = now or datetime.now(timezone.utc)
+    amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+    scope = f"{amz_date[:8]}/{region}/{service}/aws4_request"
+    parts = urlsplit(url)
+    headers = {**headers, "Host": parts.netloc, "x-amz-date": amz_date, "x-amz-content-sha256": payload_hash}
+
+    query = "&".join(sorted(
+        f"{quote(unquote(k), safe='-_.~')}={quote(unquote(v), safe='-_.~')}"
+        for k, _, v in (pair.partition("=") for pair in parts.query.split("&") if pair)
+    ))
+    canonical = {k.lower(): " ".join(str(v).split()) for k, v in headers.items()}
+    signed_headers = ";".join(sorted(canonical))
+    canonical_request = "\n".join([
+        method,
+        parts.path or "/",
+        query,
+        "".join(f"{k}:{canonical[k]}\n" for k in sorted(canonical)),
+        signed_headers,
+        payload_hash,
+    ])
+    string_to_sign = "\n".join([
+        "AWS4-HMAC-SHA256", amz_date, scope, hashlib.sha256(canonical_request.encode()).hexdigest()
+    ])
+
+    key = f"AWS4{secret_key}".encode()
+    for part in (amz_date[:8], region, service, "aws4_request"):
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+    headers["Authorization"] = (
+        f"AWS4-HMAC-SHA256 Credential={access_key}/{scope}, SignedHeaders={signed_headers}, Signature={signature}"
+    )
+    return headers
+
+
+EMPTY_HASH = content_hash(b"")
+
+
+class S3ResultStore:
+    """
+    Хранилище результатов в S3-совместимом сервисе (AWS S3, MinIO), с теми же ключами,
+    что и локальное: `prefix + ab/cd/<hash>`. Запросы подписываются SigV4 и идут через
+    aiohttp, адресация path-style (`endpoint/bucket/key`), как принято для MinIO.
+    Срок хранения и предел объема применяются в `prune` по листингу бакета.
+    """
+
+    def __init__(self, endpoint: str, bucket: str, access_key: str, secret_key: str,
+                 region: str = "us-east-1", prefix: str = "results/", max_age: float = 0, max_bytes: int = 0,
+                 clock=time.time):
+        self.endpoint = endpoint.rstrip("/")
+        self.bucket = bucket
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.region = region
+        self.prefix = prefix
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self._clock = clock
+        self._session: aiohttp.ClientSession | None = None
+
+    def _url(self, key: str = "", query: str = "") -> str:
+        url = f"{self.endpoint}/{quote(self.bucket)}"
+        if key:
+            url += "/" + quote(key, safe="/-_.~")
+        return f"{url}?{query}" if query else url
+
+    async def _request(self, method: str, url: str, data: bytes = b"", payload_hash: str | None = None,
+                       headers: dict | None = None) -> tuple[int, bytes]:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        signed = sign_v4(method, url, headers or {}, payload_hash or content_hash(data),
+                         self.access_key, self.secret_key, self.region)
+        async with self._session.request(method, URL(url, encoded=True), data=data or None, headers=signed) as resp:
+            return resp.status, await resp.read()
+
+    async def open(self):
+        """Создает бакет, если его еще нет (MinIO из docker-compose стартует пустым)."""
+        status, _ = await self._request("HEAD", self._url())
+        if status == 404:
+            status, body = await self._request("PUT", self._url())
+            if status != 200:
+                raise RuntimeError(f"S3 create bucket {self.bucket}: HTTP {status} {body[:200]!r}")
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    async def put(self, data: bytes) -> str:
+        digest = content_hash(data)
+        # Хеш содержимого и есть x-amz-content-sha256 — второй раз не считаем
+        status, body = await self._request("PUT", self._url(self.prefix + shard_path(digest)), data, digest,
+                                           {"Content-Type": "image/png"})
+        if status != 200:
+            raise RuntimeError(f"S3 put {digest}: HTTP {status} {body[:200]!r}")
+        return digest
+
+    async def get(self, digest: str) -> bytes | None:
+        status, body = await self._request("GET", self._url(self.prefix + shard_path(digest)), payload_hash=EMPTY_HASH)
+        if status == 404:
+            return None
+        if status != 200:
+            raise RuntimeError(f"S3 get {digest}: HTTP {status} {body[:200]!r}")
+        return body
+
+    async def _list(self) -> list[tuple[float, int, str]]:
+        files = []
+        token = None
+        while True:
+            query = f"list-type=2&prefix={quote(self.prefix, safe='-_.~')}"
+            if token:
+                query += f"&continuation-token={quote(token, safe='-_.~')}"
+            status, body = await self._request("GET", self._url(query=query), payload_hash=EMPTY_HASH)
+            if status != 200:
+                raise RuntimeError(f"S3 list: HTTP {status} {body[:200]!r}")
+            root = ET.fromstring(body)
+            for item in root.iter(f"{S3_NS}Contents"):
+                modified = datetime.fromisoformat(item.findtext(f"{S3_NS}LastModified").replace("Z", "+00:00"))
+                files.append((modified.timestamp(), int(item.findtext(f"{S3_NS}Size")), item.findtext(f"{S3_NS}Key")))
+            if root.findtext(f"{S3_NS}IsTruncated") != "true":
+                return files
+            token = root.findtext(f"{S3_NS}NextContinuationToken")
+
+    async def prune(self) -> int:
+        drop = _expired(await self._list(), self._clock(), self.max_age, self.max_bytes)
+        for key in drop:
+            status, _ = await self._request("DELETE", self._url(key), payload_hash=EMPTY_HASH)
+            if status not in (200, 204, 404):
+                logging.warning(f"S3 delete {key}: HTTP {status}")
+        return len(drop)
+
+
+def create_result_store(config):
+    """Хранилище по настройкам RESULT_STORE (None — результаты не сохраняются)."""
+    max_age = config.RESULT_MAX_AGE_DAYS * 86400
+    if config.RESULT_STORE == "local":
+        return LocalResultStore(config.RESULT_STORE_DIR, max_age, config.RESULT_MAX_BYTES)
+    if config.RESULT_STORE == "s3":
+        return S3ResultStore(config.S3_ENDPOINT, config.S3_BUCKET, config.S3_ACCESS_KEY,
+                             config.S3_SECRET_KEY.get_secret_value(), config.S3_REGION,
+                             max_age=max_age, max_bytes=config.RESULT_MAX_BYTES)
+    return None
@@ -0,0 +1,80 @@
+import time
+from collections import OrderedDict
+
+
+class SessionStore:
+    """
+    Хранилище чат-сессий Gemini с ограничением по времени жизни и количеству.
+
+    Повторяет интерфейс словаря, который использовался раньше (`in`, `get`,
+    `del`, присваивание), но не растет бесконечно: сессии, к которым не
+    обращались дольше `ttl` секунд, и самые старые сверх `max_size` удаляются.
+    """
+
+    def __init__(self, ttl: float = 3600, max_size: int = 1000, clock=time.monotonic):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._clock = clock
+        self._items: OrderedDict = OrderedDict()  # key -> (value, last_access)
+
+    def _expired(self, last_access: float) -> bool:
+        return self._clock() - last_access > self.ttl
+
+    def prune(self) -> int:
+        """Удаляет просроченные сессии. Возвращает количество удаленных."""
+        removed = 0
+        # Порядок — от давно использованных к недавним, поэтому можно остановиться на первой живой
+        while self._items:
+            key, (_, last_access) = next(iter(self._items.items()))
+            if not self._expired(last_access):
+                break
+            del self._items[key]
+            removed += 1
+        return removed
+
+    def get(self, key, default=None):
+        item = self._items.get(key)
+        if item is None:
+            return default
+        value, last_access = item
+        if self._expired(last_access):
+            del self._items[key]
+            return default
+        self._items[key] = (value, self._clock())
+        self._items.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._items[key] = (value, self._clock())
+        self._items.move_to_end(key)
+        self.prune()
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __contains__(self, key) -> bool:
+        item = self._items.get(key)
+        if item is None:
+            return False
+        if self._expired(item[1]):
+            del self._items[key]
+            return False
+        return True
+
+    def __delitem__(self, key):
+        del self._items[key]
+
+    def pop(self, key, default=None):
+        item = self._items.pop(key, None)
+        return default if item is None else item[0]
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+_MISSING = object()
@@ -0,0 +1,62 @@
+import asyncio
+import logging
+import time
+
+from resilience import RetryPolicy
+
+
+async def wait_ready(name: str, probe, timeout: float = 60.0, attempt_timeout: float = 5.0,
+                     policy: RetryPolicy | None = None, clock=time.monotonic, sleep=asyncio.sleep) -> bool:
+    """
+    Ждет готовности зависимости: `probe()` повторяется с экспоненциальной задержкой, пока
+    не пройдет или не истечет `timeout` сек. Если зависимость уже поднята, ожидание
+    занимает одну попытку, а не фиксированную паузу. Возвращает True, если дождались.
+    """
+    policy = policy or RetryPolicy(base_delay=0.05, max_delay=2.0)
+    deadline = clock() + timeout
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            await asyncio.wait_for(probe(), attempt_timeout)
+            if attempt > 1:
+                logging.info(f"{name} is ready after {attempt} attempts")
+            return True
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            delay = policy.backoff(attempt)
+            if clock() + delay > deadline:
+                logging.error(f"{name} is not ready after {timeout:.0f}s: {e}")
+                return False
+            logging.info(f"Waiting for {name} (attempt {attempt}): {e}")
+        await sleep(delay)
+
+
+class StartupPhases:
+    """
+    Длительность этапов запуска процесса: импорт, ожидание БД, инициализация и т.д.
+    Итог одной строкой в лог показывает, на что уходит время рестарта.
+    """
+
+    def __init__(self, started: float | None = None, clock=time.perf_counter):
+        self._clock = clock
+        self._started = clock() if started is None else started
+        self._last = self._started
+        self.phases: list[tuple[str, float]] = []
+
+    def mark(self, name: str) -> float:
+        """Закрывает этап `name` (от предыдущей отметки до сейчас). Возвращает его длительность."""
+        now = self._clock()
+        elapsed = now - self._last
+        self.phases.append((name, elapsed))
+        self._last = now
+        return elapsed
+
+    @property
+    def total(self) -> float:
+        return self._last - self._started
+
+    def summary(self) -> str:
+        parts = ", ".join(f"{name} {elapsed * 1000:.0f} ms" for name, elapsed in self.phases)
+        return f"{self.total:.2f}s ({parts})"
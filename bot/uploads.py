@@ -0,0 +1,192 @@
+import asyncio
+import contextlib
+import json
+import os
+import re
+import time
+import uuid
+
+_UPLOAD_ID_RE = re.compile(r"[0-9a-f]{32}")
+
+
+class UploadError(Exception):
+    """Ошибка загрузки с HTTP-статусом; `offset` — сколько байт уже принято (для 409)."""
+
+    def __init__(self, status: int, message: str, offset: int | None = None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.offset = offset
+
+
+class ChunkedUploads:
+    """
+    Возобновляемые загрузки частями (по мотивам протокола tus) в каталоге `root`.
+
+    Клиент объявляет размер, затем шлет части с указанием смещения. Если соединение
+    оборвалось, он спрашивает принятое смещение и продолжает с него. Принятые байты
+    лежат в `<id>.part`, владелец и размер — в `<id>.json`, поэтому загрузку можно
+    продолжить и после рестарта бота. Незавершенные загрузки старше `ttl` сек.
+    удаляет `prune`. Файловые операции выполняются в потоке, не блокируя event loop.
+    """
+
+    def __init__(self, root: str, ttl: float = 3600, clock=time.time):
+        self.root = root
+        self.ttl = ttl
+        self._clock = clock
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._user_locks: dict[int, asyncio.Lock] = {}
+
+    def _paths(self, upload_id: str) -> tuple[str, str]:
+        if not _UPLOAD_ID_RE.fullmatch(upload_id):
+            raise UploadError(404, "upload not found")
+        base = os.path.join(self.root, upload_id)
+        return f"{base}.json", f"{base}.part"
+
+    @contextlib.asynccontextmanager
+    async def _lock(self, upload_id: str):
+        """
+        Блокировка одной загрузки. Неверный id отклоняется до создания блокировки,
+        а после 404 на несуществующую загрузку запись из `_locks` удаляется,
+        иначе запросы с выдуманными id растили бы словарь без предела.
+        """
+        meta_path, _ = self._paths(upload_id)
+        lock = self._locks.setdefault(upload_id, asyncio.Lock())
+        try:
+            async with lock:
+                yield
+        except UploadError as e:
+            if e.status == 404 and self._locks.get(upload_id) is lock and not os.path.exists(meta_path):
+                del self._locks[upload_id]
+            raise
+
+    def _meta_files(self):
+        """(id, путь к <id>.json) всех загрузок в каталоге."""
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return
+        for name in names:
+            upload_id, ext = os.path.splitext(name)
+            if ext == ".json" and _UPLOAD_ID_RE.fullmatch(upload_id):
+                yield upload_id, os.path.join(self.root, name)
+
+    def _count(self, user_id: int) -> int:
+        count = 0
+        for _, meta_path in self._meta_files():
+            try:
+                with open(meta_path) as f:
+                    count += json.load(f)["user_id"] == user_id
+            except (FileNotFoundError, ValueError, KeyError):
+                pass
+        return count
+
+    async def create(self, user_id: int, size: int, limit: int | None = None) -> str:
+        """
+        Новая загрузка. Не больше `limit` открытых загрузок одного пользователя,
+        иначе UploadError 429: незавершенные загрузки занимают диск до `prune`.
+        """
+        upload_id = uuid.uuid4().hex
+        meta_path, part_path = self._paths(upload_id)
+
+        def write():
+            if limit is not None and self._count(user_id) >= limit:
+                raise UploadError(429, f"too many open uploads, at most {limit}")
+            os.makedirs(self.root, exist_ok=True)
+            open(part_path, "wb").close()
+            with open(meta_path, "w") as f:
+                json.dump({"user_id": user_id, "size": size}, f)
+
+        # Одновременные запросы одного пользователя не должны пройти подсчет все сразу
+        async with self._user_locks.setdefault(user_id, asyncio.Lock()):
+            await asyncio.to_thread(write)
+        return upload_id
+
+    def _status(self, upload_id: str, user_id: int) -> tuple[int, int]:
+        meta_path, part_path = self._paths(upload_id)
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            offset = os.path.getsize(part_path)
+        except (FileNotFoundError, ValueError):
+            raise UploadError(404, "upload not found")
+        if meta["user_id"] != user_id:
+            raise UploadError(404, "upload not found")
+        return offset, meta["size"]
+
+    async def status(self, upload_id: str, user_id: int) -> tuple[int, int]:
+        """(принято байт, объявленный размер). Raises: UploadError 404."""
+        return await asyncio.to_thread(self._status, upload_id, user_id)
+
+    async def append(self, upload_id: str, user_id: int, offset: int, data: bytes) -> tuple[int, int]:
+        """
+        Дописывает часть, начинающуюся с `offset`. Возвращает (новое смещение, размер).
+        Raises: UploadError — 404 (нет загрузки), 409 (смещение не совпало), 413 (больше объявленного).
+        """
+        # Две одновременные части одной загрузки не должны пройти проверку смещения обе
+        async with self._lock(upload_id):
+            return await asyncio.to_thread(self._append, upload_id, user_id, offset, data)
+
+    def _append(self, upload_id: str, user_id: int, offset: int, data: bytes) -> tuple[int, int]:
+        current, size = self._status(upload_id, user_id)
+        if offset != current:
+            raise UploadError(409, "offset mismatch", current)
+        if current + len(data) > size:
+            raise UploadError(413, "chunk exceeds declared size", current)
+        _, part_path = self._paths(upload_id)
+        with open(part_path, "ab") as f:
+            f.write(data)
+        return current + len(data), size
+
+    async def take(self, upload_id: str, user_id: int) -> bytes:
+        """Содержимое завершенной загрузки; загрузка удаляется. Raises: UploadError 404/409."""
+        def read():
+            offset, size = self._status(upload_id, user_id)
+            if offset != size:
+                raise UploadError(409, "upload is incomplete", offset)
+            meta_path, part_path = self._paths(upload_id)
+            with open(part_path, "rb") as f:
+                data = f.read()
+            for path in (meta_path, part_path):
+                os.remove(path)
+            return data
+        data = await asyncio.to_thread(read)
+        self._locks.pop(upload_id, None)
+        return data
+
+    async def cancel(self, upload_id: str, user_id: int):
+        """Удаляет незавершенную загрузку, освобождая место под новую. Raises: UploadError 404."""
+        def remove():
+            self._status(upload_id, user_id)
+            for path in self._paths(upload_id):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        async with self._lock(upload_id):
+            await asyncio.to_thread(remove)
+        self._locks.pop(upload_id, None)
+
+    async def prune(self) -> int:
+        """Удаляет загрузки без активности дольше `ttl` сек. Возвращает число удаленных."""
+        return await asyncio.to_thread(self._prune)
+
+    def _prune(self) -> int:
+        cutoff = self._clock() - self.ttl
+        removed = 0
+        for upload_id, _ in list(self._meta_files()):
+            meta_path, part_path = self._paths(upload_id)
+            try:
+                # Активность — последняя принятая часть
+                if os.stat(part_path).st_mtime >= cutoff:
+                    continue
+            except FileNotFoundError:
+                pass
+            for path in (meta_path, part_path):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            self._locks.pop(upload_id, None)
+            removed += 1
+        return removed
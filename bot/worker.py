@@ -0,0 +1,17 @@
+"""
+Точка входа процесса-воркера генераций (режим раздельных процессов).
+
+Бот запускается с RUN_MODE=bot и только ставит задания в очередь; этот процесс
+выполняет их и доставляет результаты через Bot API. В docker-compose — сервис
+worker (профиль split), число реплик — GEN_WORKER_REPLICAS.
+"""
+import asyncio
+import os
+
+# До импорта config: от режима зависит хранилище FSM в main
+os.environ["RUN_MODE"] = "worker"
+
+from main import main  # noqa: E402
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,294 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import time
+import unittest
+import sys
+import os
+import tempfile
+from io import BytesIO
+from types import SimpleNamespace
+from urllib.parse import urlencode
+
+import aiohttp
+from aiohttp.test_utils import TestServer
+from PIL import Image
+
+# Add bot directory to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../bot')))
+
+import pricing
+from api import ApiError, InitDataError, WebApi, verify_init_data
+from result_store import LocalResultStore, content_hash
+from uploads import ChunkedUploads
+
+BOT_TOKEN = "123456:TEST-token"
+
+
+def make_init_data(user_id: int, auth_date: int | None = None, token: str = BOT_TOKEN) -> str:
+    """initData, подписанный так же, как это делает Telegram."""
+    fields = {
+        "auth_date": str(auth_date or int(time.time())),
+        "query_id": "AAH",
+        "user": json.dumps({"id": user_id, "first_name": "Тест"}, ensure_ascii=False),
+    }
+    check_string = "\n".join(f"{k}={v}" for k, v in sorted(fields.items()))
+    secret = hmac.new(b"WebAppData", token.encode(), hashlib.sha256).digest()
+    fields["hash"] = hmac.new(secret, check_string.encode(), hashlib.sha256).hexdigest()
+    return urlencode(fields)
+
+
+class FakeStore:
+    def __init__(self):
+        self.users = {
+            1: SimpleNamespace(id=1, username="u1", full_name="User", access_level="basic", tariff="basic",
+                               tariff_expires_at=None, balance=2500),
+            2: SimpleNamespace(id=2, username=None, full_name="Banned", access_level="banned", tariff="demo",
+                               tariff_expires_at=None, balance=0),
+        }
+        self.calls = 0
+        self.jobs = {}  # id -> (user_id, статус)
+
+    async def get_user(self, user_id):
+        self.calls += 1
+        return self.users.get(user_id)
+
+    async def get_generation_job_status(self, gen_id, user_id):
+        owner, status = self.jobs.get(gen_id, (None, None))
+        if owner != user_id:
+            return None
+        return {"id": gen_id, "status": status}
+
+
+class TestVerifyInitData(unittest.TestCase):
+
+    def test_valid_init_data(self):
+        fields = verify_init_data(make_init_data(42), BOT_TOKEN, 3600)
+        self.assertEqual(fields["user"]["id"], 42)
+        self.assertEqual(fields["user"]["first_name"], "Тест")
+
+    def test_rejects_tampered_foreign_and_expired(self):
+        tampered = make_init_data(42).replace("42", "43")
+        with self.assertRaises(InitDataError):
+            verify_init_data(tampered, BOT_TOKEN, 3600)
+        with self.assertRaises(InitDataError):
+            verify_init_data(make_init_data(42, token="999:other"), BOT_TOKEN, 3600)
+        with self.assertRaises(InitDataError):
+            verify_init_data(make_init_data(42, auth_date=int(time.time()) - 7200), BOT_TOKEN, 3600)
+        with self.assertRaises(InitDataError):
+            verify_init_data("garbage", BOT_TOKEN, 3600)
+
+
+class TestWebApi(unittest.TestCase):
+
+    def run_scenario(self, scenario, store=None, api=None):
+        api = api or WebApi(store or FakeStore(), BOT_TOKEN, {"nano_banana": "gemini-2.5-flash-image"},
+                            origin="https://example.github.io", init_data_ttl=3600)
+
+        async def runner():
+            server = TestServer(api.app())
+            await server.start_server()
+            try:
+                async with aiohttp.ClientSession(base_url=server.make_url("")) as session:
+                    return await scenario(session)
+            finally:
+                await server.close()
+
+        return asyncio.run(runner())
+
+    def test_profile_requires_valid_init_data(self):
+        store = FakeStore()
+
+        async def scenario(session):
+            statuses = []
+            for headers in ({}, {"Authorization": "tma bad"}, {"Authorization": "tma " + make_init_data(2)},
+                            {"Authorization": "tma " + make_init_data(3)}):
+                async with session.get("/api/profile", headers=headers) as resp:
+                    statuses.append(resp.status)
+            async with session.get("/api/profile", headers={"Authorization": "tma " + make_init_data(1)}) as resp:
+                return statuses, resp.status, await resp.json(), resp.headers
+
+        statuses, status, profile, headers = self.run_scenario(scenario, store)
+        self.assertEqual(statuses, [401, 401, 403, 404])
+        self.assertEqual(status, 200)
+        self.assertEqual(profile["balance"], 2500)
+        self.assertEqual(profile["limits"]["max_refs"], 1)
+        self.assertEqual(headers["Cache-Control"], "private, no-cache")
+        # Без подписи до БД не доходим
+        self.assertEqual(store.calls, 3)
+
+    def test_catalog_etag_and_reload(self):
+        async def scenario(session):
+            async with session.get("/api/prices") as resp:
+                prices, etag, cache = await resp.json(), resp.headers["ETag"], resp.headers["Cache-Control"]
+            async with session.get("/api/prices", headers={"If-None-Match": etag}) as resp:
+                not_modified = resp.status, await resp.read()
+            # Перезагрузка цен — новый снимок таблиц и новый ETag
+            saved = pricing._tables
+            pricing._tables = pricing.compile_tables({**pricing.MODEL_PRICES, "gemini-2.5-flash-image": 80},
+                                                     pricing.RESOLUTION_SURCHARGES, pricing.SURCHARGE_MODELS,
+                                                     pricing.TARIFFS)
+            try:
+                async with session.get("/api/prices", headers={"If-None-Match": etag}) as resp:
+                    reloaded = resp.status, (await resp.json())["models"]["gemini-2.5-flash-image"][""]
+            finally:
+                pricing._tables = saved
+            async with session.get("/api/models") as resp:
+                models = await resp.json()
+            return prices, cache, not_modified, reloaded, models
+
+        prices, cache, not_modified, reloaded, models = self.run_scenario(scenario)
+        self.assertEqual(prices["models"]["gemini-2.5-flash-image"][""], 70)
+        self.assertNotIn("admin", prices["tariffs"])
+        self.assertTrue(cache.startswith("public"))
+        self.assertEqual(not_modified, (304, b""))
+        self.assertEqual(reloaded, (200, 80))
+        pro = next(m for m in models["models"] if m["id"] == "gemini-3-pro-image-preview")
+        self.assertTrue(pro["supports_resolution"])
+        self.assertEqual(pro["prices"]["4K"], 750)
+        self.assertEqual(models["aliases"]["nano_banana"], "gemini-2.5-flash-image")
+
+    def test_cors_preflight(self):
+        async def scenario(session):
+            async with session.options("/api/profile", headers={"Origin": "https://example.github.io"}) as resp:
+                allowed = resp.status, resp.headers.get("Access-Control-Allow-Origin"), resp.headers["Access-Control-Max-Age"]
+            async with session.get("/api/models", headers={"Origin": "https://evil.example"}) as resp:
+                return allowed, resp.headers.get("Access-Control-Allow-Origin")
+
+        allowed, foreign = self.run_scenario(scenario)
+        self.assertEqual(allowed, (204, "https://example.github.io", "86400"))
+        self.assertIsNone(foreign)
+
+    def test_submit_job_and_status(self):
+        store = FakeStore()
+        submitted = []
+
+        async def submit(user_id, params):
+            if params.get("prompt") == "":
+                raise ApiError(402, "not enough NC", "balance")
+            submitted.append((user_id, params))
+            store.jobs[10] = (user_id, "queued")
+            return 10
+
+        api = WebApi(store, BOT_TOKEN, {}, submit=submit)
+        auth = {"Authorization": "tma " + make_init_data(1)}
+
+        async def scenario(session):
+            async with session.post("/api/jobs", json={"prompt": "кот"}) as resp:
+                unauthorized = resp.status
+            async with session.post("/api/jobs", json={"prompt": ""}, headers=auth) as resp:
+                refused = resp.status, await resp.json()
+            async with session.post("/api/jobs", json={"prompt": "кот", "model": "imagen"}, headers=auth) as resp:
+                accepted = resp.status, await resp.json()
+            async with session.get("/api/jobs/10", headers=auth) as resp:
+                status = await resp.json()
+            async with session.get("/api/jobs/10", headers={"Authorization": "tma " + make_init_data(2)}) as resp:
+                foreign = resp.status
+            return unauthorized, refused, accepted, status, foreign
+
+        unauthorized, refused, accepted, status, foreign = self.run_scenario(scenario, api=api)
+        self.assertEqual(unauthorized, 401)
+        self.assertEqual(refused, (402, {"error": "not enough NC", "reason": "balance"}))
+        self.assertEqual(accepted[0], 202)
+        self.assertEqual(accepted[1]["events_url"], "/api/jobs/10/events")
+        self.assertEqual(submitted, [(1, {"prompt": "кот", "model": "imagen"})])
+        self.assertEqual(status, {"id": 10, "status": "queued"})
+        # Чужая генерация не видна
+        self.assertEqual(foreign, 404)
+
+    def test_job_events_stream_until_final_status(self):
+        store = FakeStore()
+        store.jobs[7] = (1, "queued")
+        # Опрос намеренно редкий: статус должен прийти по job_changed, а не по таймеру
+        api = WebApi(store, BOT_TOKEN, {}, status_poll_interval=30)
+
+        async def change_later():
+            await asyncio.sleep(0.05)
+            store.jobs[7] = (1, "running")
+            api.job_changed("7")
+            await asyncio.sleep(0.05)
+            store.jobs[7] = (1, "completed")
+            api.job_changed(None)
+
+        async def scenario(session):
+            changer = asyncio.create_task(change_later())
+            async with session.get("/api/jobs/7/events", headers={"Authorization": "tma " + make_init_data(1)}) as resp:
+                content_type = resp.headers["Content-Type"]
+                body = await asyncio.wait_for(resp.text(), 5)
+            await changer
+            return content_type, body
+
+        content_type, body = self.run_scenario(scenario, api=api)
+        self.assertEqual(content_type, "text/event-stream")
+        statuses = [json.loads(line[len("data: "):])["status"] for line in body.splitlines() if line.startswith("data: ")]
+        self.assertEqual(statuses, ["queued", "running", "completed"])
+        self.assertEqual(api._watchers, {})
+
+
+    def test_chunked_reference_upload(self):
+        buf = BytesIO()
+        Image.new("RGB", (64, 64), "yellow").save(buf, format="PNG")
+        png = buf.getvalue()
+        with tempfile.TemporaryDirectory() as root:
+            store = FakeStore()
+            store.users[3] = SimpleNamespace(id=3, username=None, full_name="Demo", access_level="demo", tariff="demo",
+                                             tariff_expires_at=None, balance=0)
+            ref_store = LocalResultStore(os.path.join(root, "results"))
+            api = WebApi(store, BOT_TOKEN, {}, uploads=ChunkedUploads(os.path.join(root, "uploads")),
+                         ref_store=ref_store, upload_chunk_size=100)
+            auth = {"Authorization": "tma " + make_init_data(1)}
+
+            async def upload(session, data):
+                async with session.post("/api/uploads", json={"size": len(data)}, headers=auth) as resp:
+                    created = await resp.json()
+                url = f"/api/uploads/{created['id']}"
+                offset, result = 0, None
+                while offset < len(data):
+                    chunk = data[offset:offset + created["chunk_size"]]
+                    async with session.patch(url, data=chunk, headers={**auth, "Upload-Offset": str(offset)}) as resp:
+                        result = resp.status, await resp.json()
+                    if resp.status != 200:
+                        break
+                    offset = result[1]["offset"]
+                return result
+
+            async def scenario(session):
+                async with session.post("/api/uploads", json={"size": 100},
+                                        headers={"Authorization": "tma " + make_init_data(3)}) as resp:
+                    demo = resp.status
+                # Лимит BASIC — 5 МБ на референс
+                async with session.post("/api/uploads", json={"size": 6 * 1024 * 1024}, headers=auth) as resp:
+                    too_large = resp.status
+                async with session.post("/api/uploads", json={"size": 300}, headers=auth) as resp:
+                    upload_id = (await resp.json())["id"]
+                async with session.patch(f"/api/uploads/{upload_id}", data=b"x" * 100,
+                                         headers={**auth, "Upload-Offset": "0"}) as resp:
+                    pass
+                # Обрыв: клиент не знает, дошла ли часть, и спрашивает смещение
+                async with session.get(f"/api/uploads/{upload_id}", headers=auth) as resp:
+                    resumed = await resp.json()
+                async with session.patch(f"/api/uploads/{upload_id}", data=b"x" * 100,
+                                         headers={**auth, "Upload-Offset": "0"}) as resp:
+                    conflict = resp.status, (await resp.json())["offset"]
+                # У BASIC один референс: вторая открытая загрузка не нужна, пока первую не удалили
+                async with session.post("/api/uploads", json={"size": 300}, headers=auth) as resp:
+                    over_limit = resp.status
+                async with session.delete(f"/api/uploads/{upload_id}", headers=auth) as resp:
+                    cancelled = resp.status
+                return (demo, too_large, resumed, conflict, over_limit, cancelled,
+                        await upload(session, png), await upload(session, b"\0" * 150))
+
+            demo, too_large, resumed, conflict, over_limit, cancelled, done, not_image = self.run_scenario(scenario, api=api)
+            self.assertEqual((demo, too_large), (403, 413))
+            self.assertEqual(resumed, {"offset": 100, "size": 300})
+            self.assertEqual(conflict, (409, 100))
+            self.assertEqual((over_limit, cancelled), (429, 204))
+            self.assertEqual(done[0], 200)
+            self.assertEqual(done[1]["ref"], content_hash(png))
+            self.assertEqual(bytes(asyncio.run(ref_store.get(content_hash(png)))), png)
+            self.assertEqual(not_image[0], 415)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+"""
+Микро-бенчмарки горячих функций, которые выполняются на каждый запрос.
+
+Время каждой функции нормируется на калибровочную нагрузку (чистый Python),
+поэтому базовые значения в `benchmarks_baseline.json` переносимы между машинами.
+Тест падает, если нормированное время выросло больше, чем в BENCH_THRESHOLD раз.
+
+Обновить базовые значения:
+    BENCH_UPDATE=1 python -m pytest tests/test_benchmarks.py
+"""
+import json
+import os
+import sys
+import timeit
+import unittest
+
+# Add bot directory to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../bot')))
+
+from pricing import calculate_cost, validate_request
+from prompt_options import parse_prompt_options
+
+try:
+    from keyboards import get_main_menu, build_config_menu
+    HAS_AIOGRAM = True
+except ImportError:
+    HAS_AIOGRAM = False
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), 'benchmarks_baseline.json')
+THRESHOLD = float(os.environ.get('BENCH_THRESHOLD', '2.0'))
+UPDATE = os.environ.get('BENCH_UPDATE') == '1'
+REPEAT = 5
+
+PROMPT = "Кот в скафандре на Луне, кинематографичный свет --ar 16:9 --2k --n 2 --model pro"
+
+
+def _calibration_workload():
+    # Фиксированная нагрузка: словари, строки и ветвления, как в тестируемом коде
+    d = {str(i): i for i in range(50)}
+    total = 0
+    for k in ("1", "25", "49", "x"):
+        total += d.get(k, 0)
+    return "-".join(k.upper() for k in ("a", "b", "c")), total
+
+
+def _per_call(fn, number: int) -> float:
+    """Минимальное время одного вызова из REPEAT серий по number вызовов."""
+    return min(timeit.repeat(fn, number=number, repeat=REPEAT)) / number
+
+
+class TestBenchmarks(unittest.TestCase):
+    results: dict = {}
+
+    @classmethod
+    def setUpClass(cls):
+        with open(BASELINE_PATH, encoding='utf-8') as f:
+            cls.baseline = json.load(f)
+        cls.calibration = _per_call(_calibration_workload, 20000)
+
+    @classmethod
+    def tearDownClass(cls):
+        if UPDATE and cls.results:
+            cls.baseline.update({k: round(v, 3) for k, v in cls.results.items()})
+            with open(BASELINE_PATH, 'w', encoding='utf-8') as f:
+                json.dump(dict(sorted(cls.baseline.items())), f, indent=2)
+                f.write("\n")
+
+    def check(self, name: str, fn, number: int = 20000):
+        ratio = _per_call(fn, number) / self.calibration
+        self.results[name] = ratio
+        if UPDATE:
+            return
+        baseline = self.baseline.get(name)
+        if baseline is None:
+            self.skipTest(f"Нет базового значения для {name}, запустите с BENCH_UPDATE=1")
+        self.assertLessEqual(
+            ratio, baseline * THRESHOLD,
+            f"{name}: {ratio:.3f} калибровочных единиц, базовое значение {baseline:.3f} (порог x{THRESHOLD})"
+        )
+
+    def test_calculate_cost(self):
+        self.check("calculate_cost", lambda: calculate_cost("gemini-3-pro-image-preview", "4k"))
+
+    def test_validate_request(self):
+        self.check("validate_request", lambda: validate_request("basic", "gemini-2.5-flash-image", "1024x1024", 1, "16:9"))
+
+    def test_parse_prompt_options(self):
+        self.check("parse_prompt_options", lambda: parse_prompt_options(PROMPT), number=5000)
+
+    @unittest.skipUnless(HAS_AIOGRAM, "aiogram не установлен")
+    def test_get_main_menu(self):
+        self.check("get_main_menu", lambda: get_main_menu("full", 1234), number=1000)
+
+    @unittest.skipUnless(HAS_AIOGRAM, "aiogram не установлен")
+    def test_build_config_menu(self):
+        self.check("build_config_menu", lambda: build_config_menu("gemini-3-pro-image-preview", "16:9", "2K", "basic"), number=500)
+
+if __name__ == '__main__':
+    unittest.main()
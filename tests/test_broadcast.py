@@ -0,0 +1,122 @@
+import asyncio
+import unittest
+import sys
+import os
+from types import SimpleNamespace
+
+# Add bot directory to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../bot')))
+
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+
+from broadcast import Broadcaster
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeStore:
+    """Пользователи и сохраненный прогресс рассылки в памяти."""
+
+    def __init__(self, user_ids):
+        self.user_ids = sorted(user_ids)
+        self.saves = []
+        self.cancelled = False
+
+    async def fetch_broadcast_recipients(self, after_user_id, limit):
+        return [u for u in self.user_ids if u > after_user_id][:limit]
+
+    async def save_broadcast_progress(self, broadcast_id, last_user_id, delivered, blocked, failed, status='running'):
+        if self.cancelled:
+            return False
+        self.saves.append((last_user_id, delivered, blocked, failed, status))
+        return True
+
+
+class FakeBot:
+    def __init__(self, clock, errors=None):
+        self.clock = clock
+        self.errors = errors or {}
+        self.sent = []
+
+    async def send_message(self, chat_id, text, **kwargs):
+        error = self.errors.get(chat_id)
+        if isinstance(error, list):
+            error = error.pop(0) if error else None
+        if error:
+            raise error
+        self.sent.append((chat_id, self.clock.now))
+
+
+def broadcast_row(last_user_id=0, delivered=0):
+    return SimpleNamespace(id=1, text="<b>Новости</b>", last_user_id=last_user_id,
+                           delivered=delivered, blocked=0, failed=0)
+
+
+class TestBroadcaster(unittest.TestCase):
+
+    def test_rate_limited_with_progress_per_batch(self):
+        clock = FakeClock()
+        store = FakeStore(range(1, 11))
+        bot = FakeBot(clock)
+        broadcaster = Broadcaster(bot, store, rate=5, batch_size=4, clock=clock, sleep=clock.sleep)
+
+        result = asyncio.run(broadcaster.run(broadcast_row()))
+
+        self.assertEqual((result.status, result.delivered), ("completed", 10))
+        # 10 сообщений при 5/с: первое сразу, остальные через 0.2с
+        self.assertAlmostEqual(clock.now, 1.8)
+        self.assertEqual([s[0] for s in store.saves], [4, 8, 10, 10])
+        self.assertEqual(store.saves[-1][-1], "completed")
+
+    def test_retry_after_blocked_and_failed(self):
+        clock = FakeClock()
+        method = SimpleNamespace()
+        bot = FakeBot(clock, errors={
+            2: [TelegramRetryAfter(method, "flood", retry_after=7)],
+            3: TelegramForbiddenError(method, "bot was blocked by the user"),
+            4: TelegramBadRequest(method, "chat not found"),
+        })
+        store = FakeStore([1, 2, 3, 4, 5])
+        broadcaster = Broadcaster(bot, store, rate=100, clock=clock, sleep=clock.sleep)
+
+        result = asyncio.run(broadcaster.run(broadcast_row()))
+
+        self.assertEqual((result.delivered, result.blocked, result.failed), (3, 1, 1))
+        self.assertEqual([chat_id for chat_id, _ in bot.sent], [1, 2, 5])
+        # Повтор получателю 2 — не раньше, чем через retry_after
+        self.assertGreaterEqual(bot.sent[1][1], 7)
+
+    def test_resumes_from_cursor(self):
+        clock = FakeClock()
+        bot = FakeBot(clock)
+        store = FakeStore(range(1, 7))
+        broadcaster = Broadcaster(bot, store, rate=100, clock=clock, sleep=clock.sleep)
+
+        result = asyncio.run(broadcaster.run(broadcast_row(last_user_id=4, delivered=4)))
+
+        self.assertEqual([chat_id for chat_id, _ in bot.sent], [5, 6])
+        self.assertEqual(result.delivered, 6)
+
+    def test_cancelled_between_batches(self):
+        clock = FakeClock()
+        bot = FakeBot(clock)
+        store = FakeStore(range(1, 11))
+        store.cancelled = True
+        broadcaster = Broadcaster(bot, store, rate=100, batch_size=3, clock=clock, sleep=clock.sleep)
+
+        result = asyncio.run(broadcaster.run(broadcast_row()))
+
+        self.assertEqual(result.status, "cancelled")
+        self.assertEqual(len(bot.sent), 3)
+
+if __name__ == '__main__':
+    unittest.main()
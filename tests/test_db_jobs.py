@@ -0,0 +1,418 @@
+"""
+Интеграционные тесты массовых SQL-операций на живом Postgres.
+
+По умолчанию пропускаются. Запуск против отдельной тестовой базы
+(таблицы users, generations и служебные таблицы фоновых задач в ней очищаются!):
+    DB_TESTS=1 POSTGRES_HOST=... POSTGRES_USER=... POSTGRES_PASSWORD=... POSTGRES_DB=... \
+        python -m pytest tests/test_db_jobs.py
+"""
+import asyncio
+import json
+import os
+import sys
+import unittest
+from datetime import datetime, timedelta
+
+# Add bot directory to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../bot')))
+
+DB_TESTS = os.environ.get("DB_TESTS") == "1"
+
+if DB_TESTS:
+    os.environ.setdefault("BOT_TOKEN", "123456:TEST")
+    os.environ.setdefault("GEMINI_API_KEY", "test")
+    from sqlalchemy import text
+    from aiogram.fsm.storage.base import StorageKey
+    from google.genai import types
+    import database as db
+    from fsm_storage import PgStorage
+    from nano_service import nano_service
+
+NOW = datetime(2026, 1, 15, 12, 0)
+
+
+def run(coro_fn):
+    """Каждый тест — отдельный event loop, поэтому пул соединений закрываем в конце."""
+    async def wrapper():
+        try:
+            await db.init_db()
+            async with db.engine.begin() as conn:
+                await conn.execute(text("TRUNCATE users, generations, generation_jobs, nc_grants, broadcasts, scheduled_actions, fsm_states, chat_histories"))
+            return await coro_fn()
+        finally:
+            await db.engine.dispose()
+    return asyncio.run(wrapper())
+
+
+async def add_users(rows: list[tuple[int, str, datetime | None]], started_at: datetime = NOW):
+    async with db.async_session() as session:
+        for user_id, tariff, expires_at in rows:
+            session.add(db.User(id=user_id, full_name=f"u{user_id}", access_level=tariff, tariff=tariff,
+                                tariff_expires_at=expires_at, tariff_started_at=started_at, balance=0))
+        await session.commit()
+
+
+async def balances() -> dict[int, int]:
+    async with db.engine.begin() as conn:
+        return dict((await conn.execute(text("SELECT id, balance FROM users"))).all())
+
+
+@unittest.skipUnless(DB_TESTS, "DB_TESTS=1 не задан")
+class TestDbJobs(unittest.TestCase):
+
+    def test_downgrade_expired_tariffs(self):
+        async def scenario():
+            await add_users([
+                (1, "full", NOW - timedelta(days=1)),
+                (2, "basic", NOW + timedelta(days=1)),
+                (3, "admin", NOW - timedelta(days=1)),
+                (4, "demo", None),
+            ])
+            first = await db.downgrade_expired_tariffs(NOW)
+            second = await db.downgrade_expired_tariffs(NOW)
+            user = await db.get_user(1)
+            return first, second, (user.tariff, user.access_level, user.tariff_expires_at)
+
+        first, second, state = run(scenario)
+        self.assertEqual(first, [1])
+        self.assertEqual(second, [])
+        self.assertEqual(state, ("demo", "demo", None))
+
+    def test_grant_monthly_nc_per_subscription_cycle(self):
+        amounts = {"demo": 0, "basic": 3000, "full": 8000}
+
+        async def scenario():
+            await add_users([(i, ("basic", "full", "demo")[i % 3], None) for i in range(1, 31)])
+            await add_users([(100, "full", NOW - timedelta(days=1))])  # истекшая подписка
+            await add_users([(200, "basic", None)], started_at=NOW - timedelta(days=25))
+            granted = await db.grant_monthly_nc(amounts, batch_size=7, now=NOW)
+            again = await db.grant_monthly_nc(amounts, batch_size=7, now=NOW)
+            # Через 10 дней новый цикл начался только у подписки 25-дневной давности
+            later = await db.grant_monthly_nc(amounts, batch_size=7, now=NOW + timedelta(days=10))
+            next_cycle = await db.grant_monthly_nc(amounts, batch_size=7, now=NOW + timedelta(days=30))
+            # Продление того же тарифа сохраняет начало подписки, смена тарифа — сбрасывает
+            await db.set_user_tariff(1, "full", days=60)
+            await db.set_user_tariff(3, "full")
+            anchors = [(await db.get_user(user_id)).tariff_started_at for user_id in (1, 3)]
+            return granted, again, later, next_cycle, await balances(), anchors
+
+        granted, again, later, next_cycle, result, (kept, reset) = run(scenario)
+        self.assertEqual((granted, again, later, next_cycle), (21, 0, 1, 20))
+        self.assertEqual(result[3], 6000)    # basic, два цикла
+        self.assertEqual(result[1], 16000)   # full
+        self.assertEqual(result[200], 6000)
+        self.assertEqual(result[2], 0)       # demo
+        self.assertEqual(result[100], 0)
+        self.assertEqual(kept, NOW)
+        self.assertGreater(reset, NOW)
+
+    def test_tariff_anchor_backfill_runs_once(self):
+        async def anchors():
+            async with db.engine.begin() as conn:
+                users = dict((await conn.execute(text("SELECT id, tariff_started_at FROM users"))).all())
+                periods = (await conn.execute(text("SELECT period FROM nc_grants"))).scalars().all()
+            return users, periods
+
+        async def scenario():
+            await add_users([(1, "basic", None)])
+            async with db.engine.begin() as conn:
+                await conn.execute(text("ALTER TABLE users DROP COLUMN tariff_started_at"))
+                await conn.execute(text("INSERT INTO nc_grants (user_id, period, amount, created_at) VALUES (1, '2026-01', 3000, now())"))
+            await db.init_db()  # колонки нет — миграция с заполнением
+            migrated = await anchors()
+            async with db.engine.begin() as conn:
+                await conn.execute(text("UPDATE users SET tariff_started_at = NULL"))
+            await db.init_db()  # колонка есть — таблицы не трогаем
+            return migrated, await anchors()
+
+        (users, periods), (users_after, _) = run(scenario)
+        self.assertIsNotNone(users[1])
+        self.assertEqual(periods, ["2026-01-01"])
+        self.assertIsNone(users_after[1])
+
+    def test_broadcast_cursor_and_cancel(self):
+        async def scenario():
+            await add_users([(i, "demo", None) for i in (5, 1, 9, 3)])
+            await db.update_user_access(9, "banned")
+            broadcast = await db.create_broadcast(42, "<b>hi</b>")
+            first = await db.fetch_broadcast_recipients(0, 2)
+            rest = await db.fetch_broadcast_recipients(first[-1], 10)
+            saved = await db.save_broadcast_progress(broadcast.id, 3, 2, 0, 0)
+            running = [b.id for b in await db.get_running_broadcasts()]
+            cancelled = await db.cancel_broadcast(broadcast.id)
+            after_cancel = await db.save_broadcast_progress(broadcast.id, 5, 3, 0, 0)
+            row = await db.get_broadcast(broadcast.id)
+            return first, rest, saved, running == [broadcast.id], cancelled, after_cancel, row
+
+        first, rest, saved, resumable, cancelled, after_cancel, row = run(scenario)
+        self.assertEqual((first, rest), ([1, 3], [5]))
+        self.assertTrue(saved and resumable and cancelled)
+        self.assertFalse(after_cancel)
+        self.assertEqual((row.status, row.last_user_id, row.delivered), ("cancelled", 3, 2))
+
+    def test_scheduled_actions_roundtrip(self):
+        async def scenario():
+            await db.save_scheduled_actions([("delete_message", 1, 10, NOW), ("delete_message", 1, 11, NOW)])
+            # Повторное планирование того же сообщения обновляет срок
+            await db.save_scheduled_actions([("delete_message", 1, 10, NOW + timedelta(seconds=5))])
+            await db.delete_scheduled_actions([("delete_message", 1, 11)])
+            return await db.load_scheduled_actions()
+
+        self.assertEqual(run(scenario), [("delete_message", 1, 10, NOW + timedelta(seconds=5))])
+
+    def test_generation_job_claim_protocol(self):
+        async def scenario():
+            await add_users([(1, "full", None)])
+            await db.update_balance(1, 1000)
+            gen_id, balance = await db.submit_generation_job(1, 300, "m", "cat", "1:1", "1K", {"chat_id": 1})
+            # Два воркера одновременно: задание получает только один
+            claims = await asyncio.gather(db.claim_generation_job("a", 60), db.claim_generation_job("b", 60))
+            job = next(c for c in claims if c)
+            owner = "a" if claims[0] else "b"
+            other = "b" if owner == "a" else "a"
+            extended_by_other = await db.extend_generation_job_lease(gen_id, other, 60)
+            # Воркер «упал»: аренда истекла, задание забирает другой
+            async with db.engine.begin() as conn:
+                await conn.execute(text("UPDATE generation_jobs SET lease_expires_at = now() - interval '1 second'"))
+            reclaimed = await db.claim_generation_job(other, 60)
+            await db.finish_generation_job(gen_id, owner)  # старый владелец уже ничего не удалит
+            left_after_stale_finish = await db.claim_generation_job(owner, 60)
+            await db.finish_generation_job(gen_id, other)
+            async with db.engine.begin() as conn:
+                jobs = (await conn.execute(text("SELECT count(*) FROM generation_jobs"))).scalar()
+                status = (await conn.execute(text("SELECT status FROM generations"))).scalar()
+            return gen_id, balance, claims, job, extended_by_other, reclaimed, left_after_stale_finish, jobs, status
+
+        gen_id, balance, claims, job, extended_by_other, reclaimed, stale, jobs, status = run(scenario)
+        self.assertEqual(balance, 700)
+        self.assertEqual(sum(1 for c in claims if c), 1)
+        self.assertEqual((job.id, job.attempts, job.payload), (gen_id, 1, {"chat_id": 1}))
+        self.assertFalse(extended_by_other)
+        self.assertEqual((reclaimed.id, reclaimed.attempts), (gen_id, 2))
+        self.assertIsNone(stale)
+        self.assertEqual((jobs, status), (0, "pending"))
+
+    def test_generation_job_claim_is_fair(self):
+        async def scenario():
+            await add_users([(1, "demo", None), (2, "demo", None), (3, "full", None)])
+            # Демо-пользователь завалил очередь, затем пришли остальные
+            flood = [await db.submit_generation_job(1, 0, "m", "p", "1:1", "1K", {"tariff": "demo"}) for _ in range(10)]
+            other = [await db.submit_generation_job(2, 0, "m", "p", "1:1", "1K", {"tariff": "demo"}) for _ in range(2)]
+            premium = [await db.submit_generation_job(3, 0, "m", "p", "1:1", "1K", {"tariff": "full"}) for _ in range(4)]
+            owners = {gen_id: user_id for user_id, jobs in ((1, flood), (2, other), (3, premium)) for gen_id, _ in jobs}
+            position = (await db.get_generation_job_status(premium[0][0], 3))["position"]
+            order = []
+            while (job := await db.claim_generation_job("w", 60)) is not None:
+                order.append(owners[job.id])
+            return position, order
+
+        position, order = run(scenario)
+        # Новые пользователи встают сразу за головой очереди, а не за ее хвостом
+        self.assertEqual(position, 1)
+        # FULL (вес 4) получает четыре места на одно демо; очередь второго демо-пользователя
+        # чередуется с первым, а не ждет все 10 его заданий
+        self.assertEqual(order, [1, 3, 3, 3, 1, 2, 3, 1, 2] + [1] * 7)
+
+    def test_reconcile_stale_generations(self):
+        prices = {"m": {"": 100, "4K": 250}}
+
+        async def add_generation(user_id, status, created_at, cost=None, resolution="1K"):
+            async with db.async_session() as session:
+                gen = db.Generation(user_id=user_id, model="m", prompt="p", aspect_ratio="1:1", resolution=resolution,
+                                    status=status, cost=cost, created_at=created_at)
+                session.add(gen)
+                await session.commit()
+                return gen.id
+
+        async def scenario():
+            await add_users([(1, "full", None), (2, "basic", None)])
+            old = NOW - timedelta(hours=1)
+            await add_generation(1, "pending", old, cost=300)
+            await add_generation(1, "pending", old, resolution="4K")  # старая запись без cost
+            await add_generation(2, "pending", old)
+            await add_generation(2, "pending", NOW)  # свежая — еще может завершиться
+            await add_generation(2, "completed", old, cost=100)
+            # Генерация в очереди заданий — ее ведут воркеры, сверка не трогает
+            queued, _ = await db.submit_generation_job(1, 50, "m", "p", "1:1", "1K", {})
+            async with db.engine.begin() as conn:
+                await conn.execute(text("UPDATE generations SET created_at = :old WHERE id = :id"), {"old": old, "id": queued})
+            refunds = await db.reconcile_stale_generations(NOW - timedelta(minutes=15), prices, 10, batch_size=2)
+            again = await db.reconcile_stale_generations(NOW - timedelta(minutes=15), prices, 10)
+            # Воркер пытается завершить уже сверенную генерацию — второго возврата нет
+            async with db.engine.begin() as conn:
+                stale_id = (await conn.execute(text("SELECT min(id) FROM generations"))).scalar()
+            late = await db.finish_generation(stale_id, "failed", refund=300)
+            async with db.engine.begin() as conn:
+                statuses = (await conn.execute(text("SELECT status, count(*) FROM generations GROUP BY status"))).all()
+            return refunds, again, late, dict(statuses), await balances()
+
+        refunds, again, late, statuses, result = run(scenario)
+        totals = {}
+        for user_id, amount, count, _ in refunds:
+            totals[user_id] = (totals.get(user_id, (0, 0))[0] + amount, totals.get(user_id, (0, 0))[1] + count)
+        # 300 по cost + 250 по текущей цене 4K; запись пользователя 2 — по базовой цене
+        self.assertEqual(totals, {1: (550, 2), 2: (100, 1)})
+        self.assertEqual(again, [])
+        self.assertIsNone(late)
+        self.assertEqual(statuses, {"failed": 3, "pending": 2, "completed": 1})
+        self.assertEqual(result, {1: 550 - 50, 2: 100})
+
+    def test_finish_generation_refunds_once(self):
+        async def scenario():
+            await add_users([(1, "full", None)])
+            await db.update_balance(1, 1000)
+            gen_id, _ = await db.submit_generation_job(1, 400, "m", "p", "1:1", "1K", {})
+            first = await db.finish_generation(gen_id, "completed", 10, refund=100)
+            second = await db.finish_generation(gen_id, "failed", refund=400)
+            async with db.async_session() as session:
+                gen = await session.get(db.Generation, gen_id)
+            return first, second, gen.cost, gen.tokens_used
+
+        self.assertEqual(run(scenario), (700, None, 300, 10))
+
+    def test_fail_completed_generation_refunds_once(self):
+        async def scenario():
+            await add_users([(1, "full", None)])
+            await db.update_balance(1, 1000)
+            delivered, _ = await db.submit_generation_job(1, 400, "m", "p", "1:1", "1K", {})
+            refunded, _ = await db.submit_generation_job(1, 400, "m", "p", "1:1", "1K", {})
+            await db.finish_generation(delivered, "completed", 10, refund=100)
+            # Не доставлено: completed -> failed с возвратом, повтор ничего не дает
+            first = await db.fail_completed_generation(delivered, 300)
+            second = await db.fail_completed_generation(delivered, 300)
+            # Уже возвращенная (сверкой или abandon) генерация не в completed — возврата нет
+            await db.finish_generation(refunded, "failed", refund=400)
+            late = await db.fail_completed_generation(refunded, 400)
+            async with db.async_session() as session:
+                gen = await session.get(db.Generation, delivered)
+            return first, second, late, gen.status, gen.cost, await db.get_user_balance(1)
+
+        self.assertEqual(run(scenario), (600, None, None, "failed", 0, 1000))
+
+    def test_generation_job_status_and_notify(self):
+        async def scenario():
+            await add_users([(1, "full", None), (2, "full", None)])
+            first, _ = await db.submit_generation_job(1, 0, "m", "p", "1:1", "1K", {})
+            second, _ = await db.submit_generation_job(1, 0, "m", "p", "1:1", "1K", {})
+            queued = await db.get_generation_job_status(second, 1)
+            foreign = await db.get_generation_job_status(second, 2)
+
+            notified = asyncio.Queue()
+            listener = asyncio.create_task(db.listen_notifications({db.STATUS_CHANNEL: notified.put_nowait}))
+            try:
+                # Первый вызов — при подключении слушателя
+                self.assertIsNone(await asyncio.wait_for(notified.get(), 5))
+                await db.claim_generation_job("w", 60)
+                running = await db.get_generation_job_status(first, 1)
+                await db.finish_generation(first, "completed", 10)
+                payload = await asyncio.wait_for(notified.get(), 5)
+            finally:
+                listener.cancel()
+            return queued, foreign, running, payload, await db.get_generation_job_status(first, 1)
+
+        queued, foreign, running, payload, completed = run(scenario)
+        self.assertEqual((queued["status"], queued["position"]), ("queued", 1))
+        self.assertIsNone(foreign)
+        self.assertEqual((running["status"], running["position"]), ("running", None))
+        self.assertEqual(payload, str(completed["id"]))
+        self.assertEqual(completed["status"], "completed")
+
+    def test_generation_queue_depth_and_ping(self):
+        async def scenario():
+            await db.ping()
+            await add_users([(1, "full", None)])
+            empty = await db.get_generation_queue_depth()
+            for _ in range(3):
+                await db.submit_generation_job(1, 0, "m", "p", "1:1", "1K", {})
+            await db.claim_generation_job("w", 60)
+            return empty, await db.get_generation_queue_depth()
+
+        empty, depth = run(scenario)
+        self.assertEqual(empty, {"queued": 0, "running": 0})
+        self.assertEqual(depth, {"queued": 2, "running": 1})
+
+    def test_generation_result_hashes(self):
+        async def scenario():
+            await add_users([(1, "full", None)])
+            gen_id, _ = await db.submit_generation_job(1, 0, "m", "p", "1:1", "1K", {})
+            await db.set_generation_results(gen_id, ["a" * 64, "b" * 64])
+            return (await db.get_generation(gen_id)).result_hashes
+
+        self.assertEqual(run(scenario), ["a" * 64, "b" * 64])
+
+    def test_generation_history_keyset(self):
+        async def scenario():
+            await add_users([(1, "full", None), (2, "full", None)])
+            async with db.async_session() as session:
+                for i in range(7):
+                    # Пары с одинаковым created_at: порядок внутри пары — по id
+                    session.add(db.Generation(user_id=1, model="m", prompt=f"p{i}", status="completed",
+                                              created_at=NOW + timedelta(minutes=i // 2)))
+                session.add(db.Generation(user_id=1, model="m", prompt="failed", status="failed", created_at=NOW))
+                session.add(db.Generation(user_id=2, model="m", prompt="other", status="completed", created_at=NOW))
+                await session.commit()
+
+            older, cursor = [], None
+            while page := await db.get_generation_history(1, cursor, older=True, limit=3):
+                older += [g.prompt for g in page]
+                cursor = (page[-1].created_at, page[-1].id)
+            newer = []
+            while page := await db.get_generation_history(1, cursor, older=False, limit=1):
+                newer += [g.prompt for g in page]
+                cursor = (page[-1].created_at, page[-1].id)
+            return older, newer
+
+        older, newer = run(scenario)
+        self.assertEqual(older, [f"p{i}" for i in range(6, -1, -1)])
+        self.assertEqual(newer, [f"p{i}" for i in range(1, 7)])
+
+    def test_pg_fsm_storage(self):
+        key = StorageKey(bot_id=1, chat_id=10, user_id=10)
+
+        async def scenario():
+            storage = PgStorage()
+            empty = (await storage.get_state(key), await storage.get_data(key))
+            await storage.set_state(key, "GenStates:dialogue_standby")
+            await storage.set_data(key, {"prompt": "cat", "refs": ["a"]})
+            # Бот и воркер дописывают разные поля одновременно — оба сохраняются
+            await asyncio.gather(storage.update_data(key, {"confirm_message_id": 5}),
+                                 storage.update_data(key, {"actions_msg_id": 7}))
+            merged = await storage.get_data(key)
+            other = await storage.get_state(StorageKey(bot_id=1, chat_id=11, user_id=11))
+            await storage.set_state(key, None)
+            await storage.set_data(key, {})
+            return empty, merged, other, await storage.get_state(key), await storage.get_data(key)
+
+        empty, merged, other, cleared_state, cleared_data = run(scenario)
+        self.assertEqual(empty, (None, {}))
+        self.assertEqual(merged, {"prompt": "cat", "refs": ["a"], "confirm_message_id": 5, "actions_msg_id": 7})
+        self.assertIsNone(other)
+        self.assertEqual((cleared_state, cleared_data), (None, {}))
+
+    def test_chat_history_roundtrip_and_ttl(self):
+        history = [
+            types.Content(role="user", parts=[types.Part.from_bytes(data=b"\x89PNG", mime_type="image/png"),
+                                              types.Part(text="cat")]),
+            types.Content(role="model", parts=[types.Part(text="ok", thought_signature=b"sig")]),
+        ]
+        chat = nano_service.client.chats.create(model="gemini-3-pro-image-preview", history=history)
+
+        async def scenario():
+            await db.save_chat_history(1, nano_service.dump_chat(chat, "gemini-3-pro-image-preview"))
+            await db.save_chat_history(2, "{}")
+            async with db.engine.begin() as conn:
+                await conn.execute(text("UPDATE chat_histories SET updated_at = now() - interval '2 hours' WHERE chat_id = 2"))
+            restored = await db.load_chat_history(1, 3600)
+            expired = await db.load_chat_history(2, 3600)
+            pruned = await db.delete_expired_chat_histories(3600)
+            await db.delete_chat_history(1)
+            return restored, expired, pruned, await db.load_chat_history(1, 3600)
+
+        restored, expired, pruned, dropped = run(scenario)
+        self.assertEqual(json.loads(restored)["model"], "gemini-3-pro-image-preview")
+        restored_chat = nano_service.load_chat(restored)
+        self.assertEqual(restored_chat.get_history(), history)
+        self.assertEqual((expired, pruned, dropped), (None, 1, None))
+
+if __name__ == '__main__':
+    unittest.main()
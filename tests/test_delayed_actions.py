@@ -0,0 +1,97 @@
+import asyncio
+import unittest
+import sys
+import os
+from datetime import datetime
+
+# Add bot directory to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../bot')))
+
+from delayed_actions import DelayedActions, DELETE_MESSAGE
+
+
+class FakeBot:
+    def __init__(self):
+        self.calls = []
+
+    async def delete_messages(self, chat_id, message_ids):
+        self.calls.append((chat_id, list(message_ids)))
+
+
+class FakeStore:
+    def __init__(self, rows=None):
+        self.rows = {(a, c, m): due for a, c, m, due in rows or []}
+
+    async def save_scheduled_actions(self, rows):
+        self.rows.update({(a, c, m): due for a, c, m, due in rows})
+
+    async def load_scheduled_actions(self):
+        return [(*key, due) for key, due in self.rows.items()]
+
+    async def delete_scheduled_actions(self, keys):
+        for key in keys:
+            self.rows.pop(key, None)
+
+
+class TestDelayedActions(unittest.TestCase):
+
+    def test_deletions_batched_per_chat_with_one_task(self):
+        async def scenario():
+            bot = FakeBot()
+            actions = DelayedActions(bot, coalesce=0.05)
+            actions.delete_message(1, 10, 0.05)
+            actions.delete_message(2, 20, 0.05)
+            actions.delete_message(1, 11, 0.06)
+            actions.delete_message(1, 12, 0.3)
+            self.assertEqual(actions.pending_count, 4)
+            tasks = len(asyncio.all_tasks())
+            await asyncio.sleep(0.15)
+            first = list(bot.calls)
+            await asyncio.sleep(0.3)
+            return first, bot.calls, tasks, actions.pending_count
+
+        first, calls, tasks, pending = asyncio.run(scenario())
+        self.assertEqual(sorted(first), [(1, [10, 11]), (2, [20])])
+        self.assertEqual(calls[-1], (1, [12]))
+        self.assertEqual(tasks, 2)  # тест + один планировщик
+        self.assertEqual(pending, 0)
+
+    def test_earlier_action_wakes_scheduler(self):
+        async def scenario():
+            bot = FakeBot()
+            actions = DelayedActions(bot, coalesce=0)
+            actions.delete_message(1, 1, 10)
+            await asyncio.sleep(0.01)
+            actions.delete_message(1, 2, 0.02)
+            await asyncio.sleep(0.1)
+            return bot.calls, actions.pending_count
+
+        calls, pending = asyncio.run(scenario())
+        self.assertEqual(calls, [(1, [2])])
+        self.assertEqual(pending, 1)
+
+    def test_persisted_and_restored(self):
+        async def scenario():
+            store = FakeStore()
+            first = DelayedActions(FakeBot(), store=store)
+            first.delete_message(5, 50, 60)
+            await asyncio.sleep(0.01)
+            saved = dict(store.rows)
+
+            # «Рестарт»: новый планировщик, одно действие уже просрочено
+            store.rows[(DELETE_MESSAGE, 6, 60)] = datetime(2020, 1, 1)
+            bot = FakeBot()
+            second = DelayedActions(bot, store=store)
+            restored = await second.restore()
+            await asyncio.sleep(0.05)
+            return saved, restored, bot.calls, store.rows, second.pending_count
+
+        saved, restored, calls, rows, pending = asyncio.run(scenario())
+        self.assertEqual(list(saved), [(DELETE_MESSAGE, 5, 50)])
+        self.assertEqual(restored, 2)
+        self.assertEqual(calls, [(6, [60])])
+        self.assertEqual(list(rows), [(DELETE_MESSAGE, 5, 50)])
+        self.assertEqual(pending, 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import asyncio
+import unittest
+import sys
+import os
+
+# Add bot directory to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../bot')))
+
+from fair_queue import FairQueue
+from pricing import TARIFF_WEIGHTS
+
+
+async def run_order(queue: FairQueue, requests: list[tuple[str, int]]) -> list[tuple[str, int]]:
+    """Занимает единственный слот, ставит запросы в очередь и возвращает порядок обслуживания."""
+    order = []
+    await queue.acquire("admin", 0)
+
+    async def job(tariff, user_id):
+        async with queue.slot(tariff, user_id):
+            order.append((tariff, user_id))
+
+    tasks = [asyncio.create_task(job(t, u)) for t, u in requests]
+    await asyncio.sleep(0)  # все запросы встали в очередь
+    queue.release()
+    await asyncio.gather(*tasks)
+    return order
+
+
+class TestFairQueue(unittest.TestCase):
+
+    def test_weights_share_slots(self):
+        queue = FairQueue({"full": 4, "demo": 1}, concurrency=1)
+        requests = [("demo", 100 + i) for i in range(20)] + [("full", 200 + i) for i in range(20)]
+        order = asyncio.run(run_order(queue, requests))
+        first = [tariff for tariff, _ in order[:10]]
+        # Из первых 10 слотов Full получает ~4/5
+        self.assertEqual(first.count("full"), 8)
+        self.assertEqual(first.count("demo"), 2)
+
+    def test_round_robin_within_class(self):
+        queue = FairQueue({"demo": 1}, concurrency=1)
+        # Тяжелый пользователь 1 прислал 5 запросов раньше остальных
+        requests = [("demo", 1)] * 5 + [("demo", 2), ("demo", 3)]
+        order = asyncio.run(run_order(queue, requests))
+        self.assertEqual([u for _, u in order[:4]], [1, 2, 3, 1])
+
+    def test_idle_class_does_not_bank_credit(self):
+        async def scenario():
+            queue = FairQueue({"full": 1, "demo": 1}, concurrency=1)
+            # Долго обслуживается только demo
+            await run_order(queue, [("demo", 1)] * 10)
+            return await run_order(queue, [("demo", 1)] * 4 + [("full", 2)] * 4)
+
+        order = asyncio.run(scenario())
+        # Full не должен получить все слоты подряд за время своего простоя
+        self.assertNotEqual([t for t, _ in order[:4]], ["full"] * 4)
+
+    def test_concurrency_limit_and_cancellation(self):
+        async def scenario():
+            queue = FairQueue(TARIFF_WEIGHTS, concurrency=2)
+            await queue.acquire("full", 1)
+            await queue.acquire("full", 2)
+            waiter = asyncio.create_task(queue.acquire("demo", 3))
+            await asyncio.sleep(0)
+            self.assertEqual(queue.waiting, 1)
+            waiter.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await waiter
+            self.assertEqual(queue.waiting, 0)
+            queue.release()
+            queue.release()
+            self.assertEqual(queue.running, 0)
+
+        asyncio.run(scenario())
+
+    def test_unknown_tariff_uses_default_class(self):
+        queue = FairQueue({"demo": 1, "full": 4}, concurrency=1)
+        order = asyncio.run(run_order(queue, [("banned", 1), ("full", 2)]))
+        self.assertEqual(len(order), 2)
+
+if __name__ == '__main__':
+    unittest.main()
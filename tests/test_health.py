@@ -0,0 +1,126 @@
+import asyncio
+import time
+import unittest
+import sys
+import os
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+# Add bot directory to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../bot')))
+
+from health import HealthChecks, LoopLagMonitor
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestHealthChecks(unittest.TestCase):
+
+    def test_readiness_critical_and_degraded(self):
+        async def ok():
+            return {"rtt": 1}
+
+        async def down():
+            raise ConnectionRefusedError("connection refused")
+
+        async def breaker_open():
+            return {"ok": False, "models": {"imagen": {"state": "open"}}}
+
+        async def scenario():
+            health = HealthChecks(LoopLagMonitor())
+            health.add("database", ok)
+            health.add("models", breaker_open, critical=False)
+            degraded = await health.readiness()
+            health.add("bot_api", down)
+            failed = await health.readiness()
+            return degraded, failed
+
+        (ready, degraded), (not_ready, failed) = asyncio.run(scenario())
+        self.assertTrue(ready)
+        self.assertEqual(degraded["status"], "degraded")
+        self.assertEqual(degraded["checks"]["database"]["rtt"], 1)
+        self.assertEqual(degraded["checks"]["models"]["models"]["imagen"]["state"], "open")
+        self.assertFalse(not_ready)
+        self.assertEqual(failed["status"], "fail")
+        self.assertEqual(failed["checks"]["bot_api"]["error"], "connection refused")
+
+    def test_timeout_and_cached_probe(self):
+        clock = FakeClock()
+        calls = []
+
+        async def slow():
+            await asyncio.sleep(1)
+
+        async def bot_api():
+            calls.append(clock.now)
+            return {"username": "bot"}
+
+        async def scenario():
+            health = HealthChecks(LoopLagMonitor(), timeout=0.05, clock=clock)
+            health.add("database", slow)
+            health.add("bot_api", bot_api, ttl=30)
+            first = await health.readiness()
+            clock.now = 10
+            await health.readiness()
+            clock.now = 31
+            await health.readiness()
+            return first
+
+        ready, data = asyncio.run(scenario())
+        self.assertFalse(ready)
+        self.assertIn("timeout", data["checks"]["database"]["error"])
+        # Внешний API опрашивается не чаще раза в ttl
+        self.assertEqual(calls, [0, 31])
+
+    def test_endpoints_report_loop_lag(self):
+        monitor = LoopLagMonitor()
+        health = HealthChecks(monitor, max_loop_lag=0.5)
+
+        async def runner():
+            app = web.Application()
+            health.add_routes(app)
+            server = TestServer(app)
+            await server.start_server()
+            try:
+                async with aiohttp.ClientSession(str(server.make_url(""))) as session:
+                    async with session.get("/healthz") as resp:
+                        alive = resp.status, await resp.json()
+                    # Синхронный код заблокировал loop на 2 сек
+                    monitor.record(2.0)
+                    async with session.get("/healthz") as resp:
+                        stalled = resp.status, (await resp.json())["event_loop"]
+                    async with session.get("/readyz") as resp:
+                        not_ready = resp.status, resp.headers["Cache-Control"]
+                return alive, stalled, not_ready
+            finally:
+                await server.close()
+
+        alive, stalled, not_ready = asyncio.run(runner())
+        self.assertEqual(alive[0], 200)
+        self.assertEqual(alive[1]["status"], "ok")
+        self.assertEqual(stalled, (503, {"ok": False, "lag_ms": 2000.0, "max_lag_ms": 2000.0}))
+        self.assertEqual(not_ready, (503, "no-store"))
+
+    def test_loop_lag_monitor_measures_blocking(self):
+        async def scenario():
+            monitor = LoopLagMonitor(interval=0.01)
+            task = asyncio.create_task(monitor.run())
+            await asyncio.sleep(0.05)
+            time.sleep(0.2)  # блокирующий вызов в event loop
+            await asyncio.sleep(0.05)
+            task.cancel()
+            return monitor.max_lag
+
+        self.assertGreater(asyncio.run(scenario()), 0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import asyncio
+import unittest
+import sys
+import os
+
+# Add bot directory to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../bot')))
+
+from hedging import LatencyTracker, HedgeBudget, hedged
+
+
+def make_calls(*latencies, errors=()):
+    """Фабрика запросов: i-й вызов длится latencies[i] и падает, если i в errors."""
+    calls = []
+
+    async def fn():
+        index = len(calls)
+        calls.append(index)
+        await asyncio.sleep(latencies[index])
+        if index in errors:
+            raise RuntimeError(f"call {index} failed")
+        return f"result {index}"
+
+    return fn, calls
+
+
+class TestHedging(unittest.TestCase):
+
+    def test_fast_primary_is_not_hedged(self):
+        fn, calls = make_calls(0.01, 0.01)
+        budget = HedgeBudget(ratio=1.0)
+        result = asyncio.run(hedged(fn, 0.2, budget))
+        self.assertEqual(result, "result 0")
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(budget.spent, 0)
+
+    def test_slow_primary_loses_to_backup(self):
+        fn, calls = make_calls(0.5, 0.01)
+        budget = HedgeBudget(ratio=1.0)
+        result = asyncio.run(hedged(fn, 0.05, budget))
+        self.assertEqual(result, "result 1")
+        self.assertEqual(budget.spent, 1)
+
+    def test_budget_limits_extra_requests(self):
+        budget = HedgeBudget(ratio=0.5, burst=1.0)
+        spent = []
+        for _ in range(4):
+            fn, calls = make_calls(0.1, 0.01)
+            asyncio.run(hedged(fn, 0.01, budget))
+            spent.append(len(calls))
+        # Хедж разрешен только на каждом втором запросе
+        self.assertEqual(spent, [1, 2, 1, 2])
+
+    def test_backup_failure_falls_back_to_primary(self):
+        fn, _ = make_calls(0.2, 0.01, errors={1})
+        result = asyncio.run(hedged(fn, 0.05, HedgeBudget(ratio=1.0)))
+        self.assertEqual(result, "result 0")
+
+    def test_both_fail_raises(self):
+        fn, _ = make_calls(0.1, 0.01, errors={0, 1})
+        with self.assertRaises(RuntimeError):
+            asyncio.run(hedged(fn, 0.05, HedgeBudget(ratio=1.0)))
+
+    def test_latency_percentile(self):
+        tracker = LatencyTracker(min_samples=10)
+        self.assertIsNone(tracker.percentile(0.9))
+        for i in range(1, 101):
+            tracker.record(float(i))
+        self.assertEqual(tracker.percentile(0.9), 91.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import asyncio
+import unittest
+import sys
+import os
+
+# Add bot directory to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../bot')))
+
+from job_queue import Job, JobWorkers
+
+
+class FakeStore:
+    """Очередь в памяти с той же семантикой аренды, что и generation_jobs."""
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.jobs: dict[int, dict] = {}
+
+    def add(self, job_id, attempts=0, lease_owner=None, lease_expires_at=None):
+        self.jobs[job_id] = dict(attempts=attempts, owner=lease_owner, expires=lease_expires_at,
+                                 status="running" if lease_owner else "queued")
+
+    async def claim_generation_job(self, owner, lease):
+        now = self.clock()
+        for job_id in sorted(self.jobs):
+            row = self.jobs[job_id]
+            if row["status"] == "queued" or row["expires"] < now:
+                row.update(status="running", owner=owner, expires=now + lease, attempts=row["attempts"] + 1)
+                return Job(id=job_id, attempts=row["attempts"], payload={"n": job_id})
+        return None
+
+    async def extend_generation_job_lease(self, job_id, owner, lease):
+        row = self.jobs.get(job_id)
+        if row is None or row["owner"] != owner:
+            return False
+        row["expires"] = self.clock() + lease
+        return True
+
+    async def finish_generation_job(self, job_id, owner):
+        if self.jobs.get(job_id, {}).get("owner") == owner:
+            del self.jobs[job_id]
+
+
+class TestJobWorkers(unittest.TestCase):
+
+    def run_workers(self, store_setup, handler_delay=0.0, max_attempts=3, lease=60.0, duration=0.1, after_start=None):
+        handled, gave_up = [], []
+
+        async def scenario():
+            loop = asyncio.get_running_loop()
+            store = FakeStore(loop.time)
+            store_setup(store, loop.time())
+
+            async def handler(job):
+                await asyncio.sleep(handler_delay)
+                handled.append(job.id)
+
+            async def give_up(job):
+                gave_up.append(job.id)
+
+            workers = JobWorkers(store, handler, give_up, workers=2, lease=lease, max_attempts=max_attempts,
+                                 poll_interval=0.02, owner="w1")
+            task = asyncio.create_task(workers.run())
+            if after_start:
+                await after_start(store, workers)
+            await asyncio.sleep(duration)
+            task.cancel()
+            return store.jobs
+
+        remaining = asyncio.run(scenario())
+        return handled, gave_up, remaining
+
+    def test_processes_queued_and_abandoned_jobs(self):
+        def setup(store, now):
+            store.add(1)
+            store.add(2, attempts=1, lease_owner="dead-worker", lease_expires_at=now - 1)  # упавший воркер
+            store.add(3, attempts=1, lease_owner="live-worker", lease_expires_at=now + 60)  # еще выполняется
+
+        handled, gave_up, remaining = self.run_workers(setup)
+        self.assertEqual(sorted(handled), [1, 2])
+        self.assertEqual(gave_up, [])
+        self.assertEqual(list(remaining), [3])
+
+    def test_gives_up_after_max_attempts(self):
+        def setup(store, now):
+            store.add(7, attempts=3, lease_owner="dead-worker", lease_expires_at=now - 1)
+
+        handled, gave_up, remaining = self.run_workers(setup)
+        self.assertEqual((handled, gave_up, remaining), ([], [7], {}))
+
+    def test_heartbeat_keeps_lease_for_long_jobs(self):
+        def setup(store, now):
+            store.add(1)
+
+        # Задание дольше аренды: без heartbeat его забрал бы второй воркер того же пула
+        handled, _, remaining = self.run_workers(setup, handler_delay=0.25, lease=0.09, duration=0.35)
+        self.assertEqual(handled, [1])
+        self.assertEqual(remaining, {})
+
+    def test_notify_wakes_idle_workers(self):
+        async def after_start(store, workers):
+            await asyncio.sleep(0.005)
+            store.add(5)
+            workers.notify()
+
+        handled, _, _ = self.run_workers(lambda store, now: None, duration=0.01, after_start=after_start)
+        self.assertEqual(handled, [5])
+
+if __name__ == '__main__':
+    unittest.main()
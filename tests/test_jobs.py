@@ -0,0 +1,64 @@
+import asyncio
+import unittest
+import sys
+import os
+
+# Add bot directory to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../bot')))
+
+from jobs import run_periodic, notify_users
+
+
+class FakeBot:
+    def __init__(self, blocked=()):
+        self.blocked = set(blocked)
+        self.sent = []
+
+    async def send_message(self, chat_id, text):
+        if chat_id in self.blocked:
+            raise RuntimeError("Forbidden: bot was blocked by the user")
+        self.sent.append((chat_id, text))
+
+
+class TestJobs(unittest.TestCase):
+
+    def test_run_periodic_survives_failures(self):
+        runs = []
+
+        async def job():
+            runs.append(len(runs))
+            if len(runs) == 1:
+                raise RuntimeError("db is down")
+
+        async def fake_sleep(delay):
+            self.assertEqual(delay, 60)
+            if len(runs) >= 3:
+                raise asyncio.CancelledError
+
+        with self.assertRaises(asyncio.CancelledError):
+            asyncio.run(run_periodic("test", job, 60, sleep=fake_sleep))
+        self.assertEqual(len(runs), 3)
+
+    def test_notify_users_skips_blocked_and_paces(self):
+        delays = []
+
+        async def fake_sleep(delay):
+            delays.append(delay)
+
+        bot = FakeBot(blocked={2})
+        delivered = asyncio.run(notify_users(bot, [1, 2, 3], "hi", rate=10, sleep=fake_sleep))
+        self.assertEqual(delivered, 2)
+        self.assertEqual([chat_id for chat_id, _ in bot.sent], [1, 3])
+        self.assertEqual(delays, [0.1] * 3)
+
+    def test_notify_users_personal_text(self):
+        async def fake_sleep(delay):
+            pass
+
+        bot = FakeBot()
+        texts = {1: "вернули 100", 2: "вернули 250"}
+        asyncio.run(notify_users(bot, [1, 2], texts.get, sleep=fake_sleep))
+        self.assertEqual(bot.sent, [(1, "вернули 100"), (2, "вернули 250")])
+
+if __name__ == '__main__':
+    unittest.main()
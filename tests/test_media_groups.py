@@ -0,0 +1,112 @@
+import asyncio
+import unittest
+import sys
+import os
+
+# Add bot directory to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../bot')))
+
+from media_groups import MediaGroupCollector, MAX_ALBUM_SIZE
+
+
+class FakeClock:
+    """Время двигает только тест через `advance`; спящие просыпаются по порядку."""
+
+    def __init__(self):
+        self.now = 0.0
+        self._sleepers = []
+
+    def __call__(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        waiter = asyncio.get_running_loop().create_future()
+        self._sleepers.append((self.now + seconds, waiter))
+        await waiter
+
+    async def advance(self, until):
+        while True:
+            await asyncio.sleep(0)
+            due = [s for s in self._sleepers if s[0] <= until]
+            if not due:
+                break
+            wake_at, waiter = min(due, key=lambda s: s[0])
+            self._sleepers.remove((wake_at, waiter))
+            self.now = wake_at
+            if not waiter.done():  # ожидание могли отменить
+                waiter.set_result(None)
+        self.now = until
+
+
+class TestMediaGroupCollector(unittest.TestCase):
+
+    def run_albums(self, arrivals, min_wait=0.3, max_wait=1.5):
+        """arrivals — [(время прихода, group_id, элемент)]. Возвращает [(время выдачи, group_id, элементы)]."""
+        clock = FakeClock()
+        collector = MediaGroupCollector(min_wait=min_wait, max_wait=max_wait, clock=clock, sleep=clock.sleep)
+        done = []
+
+        async def scenario():
+            for at, group_id, item in arrivals:
+                await clock.advance(at)
+
+                async def on_complete(messages, group_id=group_id):
+                    done.append((clock.now, group_id, list(messages)))
+
+                collector.add(group_id, item, on_complete)
+            await clock.advance(clock.now + 10)
+            self.assertEqual(len(collector), 0)
+
+        asyncio.run(scenario())
+        return done
+
+    def test_album_collected_once_after_quiet_period(self):
+        done = self.run_albums([(0.0, "a", 1), (0.02, "a", 2), (0.05, "a", 3)])
+        self.assertEqual(len(done), 1)
+        at, group_id, items = done[0]
+        self.assertEqual((group_id, items), ("a", [1, 2, 3]))
+        # Интервалы маленькие — ждем минимальную паузу после последнего элемента
+        self.assertAlmostEqual(at, 0.35)
+
+    def test_wait_adapts_to_slow_arrivals(self):
+        done = self.run_albums([(0.0, "a", 1), (0.2, "a", 2), (0.45, "a", 3)])
+        # После интервала 0.2 пауза выросла до 0.6, поэтому третий элемент успел;
+        # итоговая пауза 3 × 0.25 = 0.75 после последнего
+        self.assertAlmostEqual(done[0][0], 1.2)
+        self.assertEqual(done[0][2], [1, 2, 3])
+
+    def test_full_album_fires_immediately(self):
+        arrivals = [(0.0, "a", i) for i in range(MAX_ALBUM_SIZE)]
+        done = self.run_albums(arrivals)
+        self.assertEqual(done[0][0], 0.0)
+        self.assertEqual(len(done[0][2]), MAX_ALBUM_SIZE)
+
+    def test_albums_are_independent(self):
+        done = self.run_albums([(0.0, "a", 1), (0.0, "b", 10), (0.01, "a", 2)])
+        self.assertEqual({group_id: items for _, group_id, items in done}, {"a": [1, 2], "b": [10]})
+
+    def test_flush_and_discard(self):
+        clock = FakeClock()
+        collector = MediaGroupCollector(min_wait=1.5, max_wait=1.5, clock=clock, sleep=clock.sleep)
+        done = []
+
+        async def on_complete(messages):
+            done.append((clock.now, list(messages)))
+
+        async def scenario():
+            collector.add("chat:1", "text", on_complete)
+            collector.add("chat:1", "photo", on_complete)
+            self.assertEqual(collector.get("chat:1"), ["text", "photo"])
+            # Фото набралось до лимита — отдаем без ожидания паузы
+            collector.flush("chat:1")
+            collector.add("chat:2", "photo", on_complete)
+            # Отмена: группа пропадает без обработчика
+            collector.discard("chat:2")
+            await clock.advance(10)
+            return collector.get("chat:2"), len(collector)
+
+        self.assertEqual(asyncio.run(scenario()), (None, 0))
+        self.assertEqual(done, [(0.0, ["text", "photo"])])
+
+if __name__ == '__main__':
+    unittest.main()
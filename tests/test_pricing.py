@@ -1,3 +1,6 @@
+import asyncio
+import json
+import tempfile
 import unittest
 import sys
 import os
@@ -5,7 +8,8 @@ import os
 # Add bot directory to path
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../bot')))
 
-from pricing import calculate_cost, validate_request, MODEL_PRICES, RESOLUTION_SURCHARGES
+import pricing
+from pricing import calculate_cost, validate_request, load_pricing, watch_pricing_file, MODEL_PRICES, RESOLUTION_SURCHARGES, TARIFFS
 
 class TestPricing(unittest.TestCase):
 
@@ -79,5 +83,65 @@ class TestPricing(unittest.TestCase):
         valid, msg = validate_request(tariff, "gemini-3-pro-image-preview", "1024x1024", 6, "16:9")
         self.assertFalse(valid)
 
+class TestPricingReload(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, "pricing.json")
+        # Снимок встроенных таблиц, чтобы вернуть их после теста
+        self.original = os.path.join(self.dir.name, "original.json")
+        self.write(self.original, {name: json.loads(json.dumps(table)) for name, table in pricing.PRICING_SECTIONS.items()})
+
+    def tearDown(self):
+        load_pricing(self.original)
+        self.dir.cleanup()
+
+    def write(self, path, data):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f)
+
+    def test_reload_updates_compiled_tables_and_legacy_dicts(self):
+        self.write(self.path, {"model_prices": {"gemini-2.5-flash-image": 80, "gemini-3-pro-image-preview": 450}})
+        load_pricing(self.path)
+        self.assertEqual(calculate_cost("gemini-2.5-flash-image", "1024x1024"), 80)
+        # Надбавка считается от новой базовой цены
+        self.assertEqual(calculate_cost("gemini-3-pro-image-preview", "4k"), 800)
+        # Старые импорты словаря видят новые значения
+        self.assertEqual(MODEL_PRICES["gemini-2.5-flash-image"], 80)
+        # Секции, которых нет в файле, не меняются
+        self.assertEqual(RESOLUTION_SURCHARGES["4K"], 350)
+
+    def test_tariff_rules_from_file(self):
+        tariffs = json.loads(json.dumps(TARIFFS))
+        tariffs["demo"]["allowed_ar"] = ["1:1", "9:16"]
+        self.write(self.path, {"tariffs": tariffs})
+        load_pricing(self.path)
+        valid, _ = validate_request("demo", "gemini-2.5-flash-image", "1024x1024", 0, "9:16")
+        self.assertTrue(valid)
+        valid, msg = validate_request("demo", "gemini-2.5-flash-image", "1024x1024", 0, "16:9")
+        self.assertFalse(valid)
+        self.assertIn("9:16", msg)
+
+    def test_invalid_file_keeps_current_tables(self):
+        self.write(self.path, {"model_prices": {"gemini-2.5-flash-image": 1}, "tariffs": {"full": {}}})
+        with self.assertRaises(KeyError):
+            load_pricing(self.path)
+        self.assertEqual(calculate_cost("gemini-2.5-flash-image", "1024x1024"), 70)
+        self.assertEqual(MODEL_PRICES["gemini-2.5-flash-image"], 70)
+
+    def test_watcher_picks_up_changes(self):
+        async def scenario():
+            self.write(self.path, {"model_prices": {"gemini-2.5-flash-image": 90}})
+            watcher = asyncio.create_task(watch_pricing_file(self.path, interval=0.01))
+            await asyncio.sleep(0.05)
+            first = calculate_cost("gemini-2.5-flash-image", None)
+            self.write(self.path, {"model_prices": {"gemini-2.5-flash-image": 95}})
+            os.utime(self.path, ns=(0, 10**18))  # гарантированно новый mtime
+            await asyncio.sleep(0.05)
+            watcher.cancel()
+            return first, calculate_cost("gemini-2.5-flash-image", None)
+
+        self.assertEqual(asyncio.run(scenario()), (90, 95))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,85 @@
+import asyncio
+import unittest
+import sys
+import os
+
+# Add bot directory to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../bot')))
+
+from progress import StatusUpdater, progress_line
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestProgressLine(unittest.TestCase):
+
+    def test_thought_title_without_markdown(self):
+        line = progress_line("thought", "**Planning the `scene`**\n\nI will draw a cat...")
+        self.assertEqual(line, "💭 Planning the scene")
+
+    def test_text_first_line_truncated(self):
+        line = progress_line("text", "a" * 500 + "\nsecond")
+        self.assertTrue(line.startswith("✍️ "))
+        self.assertTrue(line.endswith("..."))
+        self.assertLess(len(line), 140)
+
+    def test_empty_text_and_image(self):
+        self.assertEqual(progress_line("text", "  \n"), "")
+        self.assertIn("Изображение", progress_line("image", ""))
+
+
+class TestStatusUpdater(unittest.TestCase):
+
+    def test_throttles_and_sends_latest(self):
+        async def scenario():
+            clock = FakeClock()
+            sent = []
+            wake = asyncio.Event()
+
+            async def fake_sleep(delay):
+                await wake.wait()
+                clock.now += delay
+
+            async def edit(text):
+                sent.append(text)
+
+            updater = StatusUpdater(edit, interval=2.0, clock=clock, sleep=fake_sleep)
+            await updater.update("1")
+            await updater.update("2")
+            await updater.update("3")
+            self.assertEqual(sent, ["1"])  # внутри интервала правки копятся
+            wake.set()
+            await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            self.assertEqual(sent, ["1", "3"])  # промежуточное "2" схлопнуто
+            updater.close()
+
+        asyncio.run(scenario())
+
+    def test_close_cancels_pending_edit_and_ignores_errors(self):
+        async def scenario():
+            clock = FakeClock()
+            calls = []
+
+            async def failing_edit(text):
+                calls.append(text)
+                raise RuntimeError("message is not modified")
+
+            updater = StatusUpdater(failing_edit, interval=60.0, clock=clock)
+            await updater.update("1")
+            await updater.update("2")
+            updater.close()
+            await updater.update("3")
+            await asyncio.sleep(0)
+            self.assertEqual(calls, ["1"])
+
+        asyncio.run(scenario())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import unittest
+import sys
+import os
+
+# Add bot directory to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../bot')))
+
+from prompt_options import parse_prompt_options, PromptOptionError
+
+
+class TestPromptOptions(unittest.TestCase):
+
+    def test_ar_and_resolution_flags(self):
+        options = parse_prompt_options("кот в космосе --ar 16:9 —2k")
+        self.assertEqual(options.prompt, "кот в космосе")
+        self.assertEqual(options.aspect_ratio, "16:9")
+        self.assertEqual(options.resolution, "2K")
+
+    def test_defaults_without_flags(self):
+        options = parse_prompt_options("кот")
+        self.assertEqual(options.prompt, "кот")
+        self.assertIsNone(options.aspect_ratio)
+        self.assertIsNone(options.resolution)
+        self.assertEqual(options.variants, 1)
+        self.assertFalse(options.no_dialogue)
+
+    def test_all_flags_in_one_pass(self):
+        options = parse_prompt_options("кот --n 3 на луне --model pro –seed 42 --no-dialogue")
+        self.assertEqual(options.prompt, "кот на луне")
+        self.assertEqual(options.variants, 3)
+        self.assertEqual(options.model, "gemini-3-pro-image-preview")
+        self.assertEqual(options.seed, 42)
+        self.assertTrue(options.no_dialogue)
+
+    def test_words_with_dashes_are_not_flags(self):
+        options = parse_prompt_options("anti-4k ultra-wide --foo bar")
+        self.assertEqual(options.prompt, "anti-4k ultra-wide --foo bar")
+        self.assertIsNone(options.resolution)
+
+    def test_structured_errors(self):
+        for text, option in [("кот --n 9", "n"), ("кот --ar wide", "ar"), ("кот --model dalle", "model"),
+                             ("кот --seed", "seed")]:
+            with self.assertRaises(PromptOptionError) as ctx:
+                parse_prompt_options(text)
+            self.assertEqual(ctx.exception.option, option)
+
+    def test_single_dash_without_valid_value_is_text(self):
+        for text in ["rock -n roll band poster", "a cat -model of a car"]:
+            options = parse_prompt_options(text)
+            self.assertEqual(options.prompt, text)
+            self.assertEqual(options.variants, 1)
+            self.assertIsNone(options.model)
+
+        options = parse_prompt_options("кот -n 2")
+        self.assertEqual((options.prompt, options.variants), ("кот", 2))
+        with self.assertRaises(PromptOptionError):
+            parse_prompt_options("rock —n roll")
+
+if __name__ == '__main__':
+    unittest.main()
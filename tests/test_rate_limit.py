@@ -0,0 +1,122 @@
+import asyncio
+import unittest
+import sys
+import os
+
+# Add bot directory to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../bot')))
+
+from rate_limit import TokenBucket, RateLimiter
+from pricing import TARIFFS, MODEL_QUOTAS
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_refill_and_wait_time(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=1.0, capacity=2, clock=clock)
+        bucket.consume()
+        bucket.consume()
+        self.assertAlmostEqual(bucket.wait_time(), 1.0)
+        clock.now = 0.5
+        self.assertAlmostEqual(bucket.wait_time(), 0.5)
+        clock.now = 10
+        self.assertEqual(bucket.wait_time(), 0.0)
+        self.assertTrue(bucket.is_full())
+
+    def test_adjust_allows_debt(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=100.0, capacity=1000, clock=clock)
+        bucket.consume(500)
+        bucket.adjust(-1000)  # фактический расход оказался больше оценки
+        self.assertAlmostEqual(bucket.wait_time(1), 5.01)
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def make(self, quotas=None, tariffs=None):
+        clock = FakeClock()
+        limiter = RateLimiter(quotas if quotas is not None else MODEL_QUOTAS, tariffs or TARIFFS, clock=clock)
+        return limiter, clock
+
+    def test_per_user_limit_by_tariff(self):
+        limiter, clock = self.make(quotas={})
+        rpm = TARIFFS["demo"]["requests_per_minute"]
+        for _ in range(rpm):
+            self.assertEqual(limiter.try_acquire(1, "demo", "gemini-2.5-flash-image"), 0)
+        eta = limiter.try_acquire(1, "demo", "gemini-2.5-flash-image")
+        self.assertAlmostEqual(eta, 60 / rpm)
+        # Другой пользователь не страдает от чужого спама
+        self.assertEqual(limiter.try_acquire(2, "demo", "gemini-2.5-flash-image"), 0)
+
+    def test_global_model_quota(self):
+        limiter, _ = self.make(quotas={"m": {"rpm": 2}}, tariffs={"full": {"requests_per_minute": 100}})
+        self.assertEqual(limiter.try_acquire(1, "full", "m"), 0)
+        self.assertEqual(limiter.try_acquire(2, "full", "m"), 0)
+        self.assertGreater(limiter.try_acquire(3, "full", "m"), 0)
+        # Отказ по общей квоте не съедает персональный слот
+        self.assertEqual(limiter.users[3].tokens, 100)
+
+    def test_tokens_per_minute_settle(self):
+        limiter, _ = self.make(quotas={"m": {"rpm": 1000, "tpm": 6000, "est_tokens": 1000}},
+                               tariffs={"full": {"requests_per_minute": 1000}})
+        for _ in range(6):
+            self.assertEqual(limiter.try_acquire(1, "full", "m"), 0)
+        self.assertGreater(limiter.try_acquire(1, "full", "m"), 0)
+        # Реальный расход оказался вдвое меньше оценки — освобождаем квоту
+        for _ in range(6):
+            limiter.settle("m", 500)
+        self.assertEqual(limiter.try_acquire(1, "full", "m"), 0)
+
+    def test_variants_use_model_quota_per_image(self):
+        limiter, _ = self.make(quotas={"m": {"rpm": 4}}, tariffs={"full": {"requests_per_minute": 100}})
+        self.assertEqual(limiter.try_acquire(1, "full", "m", requests=3), 0)
+        self.assertGreater(limiter.try_acquire(2, "full", "m", requests=2), 0)
+        # Персональный лимит расходуется один раз на запрос
+        self.assertEqual(limiter.users[1].tokens, 99)
+        limiter.release(1, "m", requests=3)
+        self.assertEqual(limiter.try_acquire(2, "full", "m", requests=2), 0)
+
+    def test_split_scopes(self):
+        # Раздельные процессы: бот берет только персональный слот, воркер — только квоту модели
+        limiter, _ = self.make(quotas={"m": {"rpm": 2, "tpm": 6000, "est_tokens": 1000}},
+                               tariffs={"full": {"requests_per_minute": 100}})
+        self.assertEqual(limiter.try_acquire(1, "full", "m", per_model=False), 0)
+        self.assertEqual((limiter.users[1].tokens, limiter.model_rpm["m"].tokens), (99, 2))
+        self.assertEqual(limiter.try_acquire(1, "full", "m", requests=2, per_user=False), 0)
+        self.assertEqual((limiter.users[1].tokens, limiter.model_rpm["m"].tokens), (99, 0))
+        limiter.release(1, "m", per_model=False)
+        self.assertEqual((limiter.users[1].tokens, limiter.model_rpm["m"].tokens), (100, 0))
+
+    def test_acquire_waits_or_rejects_with_eta(self):
+        clock = FakeClock()
+
+        async def fake_sleep(delay):
+            clock.now += delay
+
+        limiter = RateLimiter({}, {"demo": {"requests_per_minute": 1}}, clock=clock, sleep=fake_sleep)
+        self.assertEqual(asyncio.run(limiter.acquire(1, "demo", "m", max_wait=5)), 0)
+        # Следующий слот через 60 сек — ждать дольше max_wait нельзя
+        self.assertAlmostEqual(asyncio.run(limiter.acquire(1, "demo", "m", max_wait=5)), 60)
+        self.assertEqual(asyncio.run(limiter.acquire(1, "demo", "m", max_wait=120)), 0)
+        self.assertAlmostEqual(clock.now, 60)
+
+    def test_prune_drops_idle_buckets(self):
+        limiter, clock = self.make(quotas={})
+        limiter.try_acquire(1, "demo", "m")
+        limiter.try_acquire(2, "demo", "m")
+        clock.now = 3600
+        limiter.try_acquire(3, "demo", "m")
+        limiter.prune()
+        self.assertEqual(list(limiter.users), [3])
+
+if __name__ == '__main__':
+    unittest.main()
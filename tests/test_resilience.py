@@ -0,0 +1,187 @@
+import asyncio
+import unittest
+import sys
+import os
+
+# Add bot directory to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../bot')))
+
+from resilience import RetryPolicy, CircuitBreaker, CircuitOpenError, call_with_retry, is_retryable
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class ApiError(Exception):
+    def __init__(self, code):
+        super().__init__(f"HTTP {code}")
+        self.code = code
+
+
+class TestRetry(unittest.TestCase):
+
+    def run_call(self, fn, policy, breaker=None, clock=None):
+        clock = clock or FakeClock()
+        delays = []
+
+        async def fake_sleep(delay):
+            delays.append(delay)
+            clock.now += delay
+
+        result = asyncio.run(call_with_retry(fn, policy, breaker, sleep=fake_sleep, clock=clock))
+        return result, delays
+
+    def test_is_retryable(self):
+        self.assertTrue(is_retryable(ApiError(429)))
+        self.assertTrue(is_retryable(ApiError(503)))
+        self.assertFalse(is_retryable(ApiError(400)))
+        self.assertTrue(is_retryable(TimeoutError()))
+        self.assertFalse(is_retryable(Exception("No image in response")))
+
+    def test_retries_transient_then_succeeds(self):
+        attempts = []
+
+        async def fn():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise ApiError(503)
+            return "ok"
+
+        result, delays = self.run_call(fn, RetryPolicy(max_attempts=3, base_delay=1.0))
+        self.assertEqual(result, "ok")
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(len(delays), 2)
+        # Полный джиттер: задержка не превышает экспоненциальный потолок
+        self.assertLessEqual(delays[0], 1.0)
+        self.assertLessEqual(delays[1], 2.0)
+
+    def test_non_retryable_raises_immediately(self):
+        attempts = []
+
+        async def fn():
+            attempts.append(1)
+            raise ApiError(400)
+
+        with self.assertRaises(ApiError):
+            self.run_call(fn, RetryPolicy(max_attempts=5))
+        self.assertEqual(len(attempts), 1)
+
+    def test_deadline_stops_retries(self):
+        attempts = []
+
+        async def fn():
+            attempts.append(1)
+            raise ApiError(429)
+
+        policy = RetryPolicy(max_attempts=10, base_delay=10.0, max_delay=10.0, deadline=0.0)
+        with self.assertRaises(ApiError):
+            self.run_call(fn, policy)
+        # Любая ненулевая задержка выходит за дедлайн
+        self.assertLessEqual(len(attempts), 2)
+
+
+class TestCircuitBreaker(unittest.TestCase):
+
+    def test_trips_on_error_rate_and_recovers(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker("m", error_rate=0.5, min_calls=4, window=60, cooldown=30, clock=clock)
+
+        breaker.record_success()
+        breaker.record_failure()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)  # мало вызовов
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        with self.assertRaises(CircuitOpenError) as ctx:
+            breaker.before_call()
+        self.assertIn("перегружена", str(ctx.exception))
+
+        clock.now = 31
+        breaker.before_call()  # пробный запрос
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.allow())  # второй параллельно не пускаем
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_failure_reopens(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker("m", error_rate=0.5, min_calls=1, cooldown=10, clock=clock)
+        breaker.record_failure()
+        clock.now = 11
+        breaker.before_call()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertAlmostEqual(breaker.retry_after(), 10)
+
+    def test_window_forgets_old_failures(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker("m", error_rate=0.5, min_calls=3, window=10, clock=clock)
+        breaker.record_failure()
+        breaker.record_failure()
+        clock.now = 20
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_only_retryable_errors_count(self):
+        breaker = CircuitBreaker("m", error_rate=0.5, min_calls=2)
+
+        async def bad_prompt():
+            raise ApiError(400)
+
+        for _ in range(5):
+            with self.assertRaises(ApiError):
+                asyncio.run(call_with_retry(bad_prompt, RetryPolicy(max_attempts=1), breaker))
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(breaker.snapshot()["calls"], 0)  # в окно не попали
+
+        async def overloaded():
+            raise ApiError(503)
+
+        # 400-е не разбавляют окно: двух перегрузок подряд достаточно
+        for _ in range(2):
+            with self.assertRaises(ApiError):
+                asyncio.run(call_with_retry(overloaded, RetryPolicy(max_attempts=1), breaker))
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+    def test_half_open_neutral_outcome_keeps_probing(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker("m", error_rate=0.5, min_calls=1, cooldown=10, clock=clock)
+        breaker.record_failure()
+        clock.now = 11
+
+        async def bad_prompt():
+            raise ApiError(400)
+
+        async def hangs():
+            await asyncio.sleep(10)
+
+        async def cancelled_probe():
+            task = asyncio.create_task(call_with_retry(hangs, RetryPolicy(max_attempts=1), breaker))
+            await asyncio.sleep(0)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        # Отказ модерации на пробе не закрывает автомат, но освобождает место для следующей пробы
+        with self.assertRaises(ApiError):
+            asyncio.run(call_with_retry(bad_prompt, RetryPolicy(max_attempts=1), breaker))
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(breaker.allow())
+        # Как и отмененная проба
+        asyncio.run(cancelled_probe())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertTrue(breaker.allow())
+
+        breaker.before_call()
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+if __name__ == '__main__':
+    unittest.main()
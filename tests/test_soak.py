@@ -0,0 +1,485 @@
+"""
+Длительный soak-тест: прогоняет случайные пользовательские сессии через
+обработчики `bot/main.py` на локальных фейках (без Telegram, Gemini и Postgres)
+и следит за ростом памяти, количеством задач и размерами модульных словарей.
+
+По умолчанию пропускается. Запуск на час:
+    SOAK_DURATION=1h python -m pytest tests/test_soak.py -s
+
+Параметры (переменные окружения):
+    SOAK_DURATION               длительность (`90s`, `30m`, `3h`)
+    SOAK_USERS                  количество пользователей в пуле (200)
+    SOAK_CONCURRENCY            одновременных сессий (20)
+    SOAK_SAMPLE_INTERVAL        период замеров, сек (30)
+    SOAK_SESSION_TTL            TTL чат-сессий во время теста, сек (60)
+    SOAK_MAX_RSS_GROWTH_MB      допустимый рост RSS после прогрева (64)
+    SOAK_MAX_TRACED_GROWTH_MB   допустимый рост памяти по tracemalloc (32)
+"""
+import asyncio
+import gc
+import os
+import random
+import resource
+import sys
+import time
+import tracemalloc
+import unittest
+from io import BytesIO
+from types import SimpleNamespace
+
+# Add bot directory to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../bot')))
+
+
+def _parse_duration(value: str) -> float:
+    units = {"s": 1, "m": 60, "h": 3600}
+    value = value.strip().lower()
+    if value and value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+
+SOAK_DURATION = os.environ.get("SOAK_DURATION")
+USERS = int(os.environ.get("SOAK_USERS", "200"))
+CONCURRENCY = int(os.environ.get("SOAK_CONCURRENCY", "20"))
+SAMPLE_INTERVAL = float(os.environ.get("SOAK_SAMPLE_INTERVAL", "30"))
+SESSION_TTL = float(os.environ.get("SOAK_SESSION_TTL", "60"))
+MAX_RSS_GROWTH_MB = float(os.environ.get("SOAK_MAX_RSS_GROWTH_MB", "64"))
+MAX_TRACED_GROWTH_MB = float(os.environ.get("SOAK_MAX_TRACED_GROWTH_MB", "32"))
+
+ADMIN_ID = 1
+
+
+def rss_mb() -> float:
+    """Текущий RSS процесса в МБ (Linux), иначе пиковый RSS."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# --- Локальные фейки Telegram ---
+
+class FakeBot:
+    def __init__(self):
+        self.next_message_id = 1
+        self.sent = 0
+
+    def new_message_id(self) -> int:
+        self.next_message_id += 1
+        return self.next_message_id
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent += 1
+        return FakeMessage(self, chat_id, chat_id, text=text)
+
+    async def delete_message(self, chat_id=None, message_id=None, **kwargs):
+        return True
+
+    async def delete_messages(self, chat_id=None, message_ids=None, **kwargs):
+        return True
+
+    async def send_photo(self, chat_id, photo, **kwargs):
+        self.sent += 1
+        return FakeMessage(self, chat_id, chat_id, photo_ids=["result"])
+
+    async def send_media_group(self, chat_id, media, **kwargs):
+        self.sent += 1
+        return [FakeMessage(self, chat_id, chat_id, photo_ids=["result"]) for _ in media]
+
+    async def edit_message_text(self, *args, **kwargs):
+        return True
+
+    async def edit_message_reply_markup(self, *args, **kwargs):
+        return True
+
+    async def get_file(self, file_id):
+        return SimpleNamespace(file_id=file_id, file_path=f"photos/{file_id}.jpg")
+
+    async def download_file(self, file_path, *args, **kwargs):
+        return BytesIO(b"\x89PNG" + os.urandom(256))
+
+
+class FakeMessage:
+    def __init__(self, bot: FakeBot, chat_id: int, user_id: int, text: str | None = None,
+                 photo_ids: list[str] | None = None, media_group_id: str | None = None):
+        self.bot = bot
+        self.message_id = bot.new_message_id()
+        self.chat = SimpleNamespace(id=chat_id)
+        self.from_user = SimpleNamespace(id=user_id, username=f"user{user_id}", full_name=f"User {user_id}")
+        self.text = text if not photo_ids else None
+        self.caption = text if photo_ids else None
+        self.photo = [SimpleNamespace(file_id=pid) for pid in photo_ids] if photo_ids else None
+        self.media_group_id = media_group_id
+        self.content_type = "photo" if photo_ids else "text"
+        self.web_app_data = None
+
+    async def answer(self, text, **kwargs):
+        self.bot.sent += 1
+        return FakeMessage(self.bot, self.chat.id, self.from_user.id, text=text)
+
+    async def answer_photo(self, photo, **kwargs):
+        self.bot.sent += 1
+        return FakeMessage(self.bot, self.chat.id, self.from_user.id, photo_ids=["result"])
+
+    async def answer_media_group(self, media, **kwargs):
+        self.bot.sent += 1
+        return [FakeMessage(self.bot, self.chat.id, self.from_user.id, photo_ids=["result"]) for _ in media]
+
+    async def edit_text(self, text, **kwargs):
+        return self
+
+    async def delete(self, **kwargs):
+        return True
+
+
+class FakeCallback:
+    def __init__(self, message: FakeMessage, user_id: int, data: str):
+        self.bot = message.bot
+        self.message = message
+        self.from_user = SimpleNamespace(id=user_id, username=f"user{user_id}", full_name=f"User {user_id}")
+        self.data = data
+
+    async def answer(self, *args, **kwargs):
+        return True
+
+
+class FakeChatSession:
+    """Имитирует историю диалога Gemini, удерживающую байты изображений."""
+
+    def __init__(self):
+        self.history = [os.urandom(4096)]
+
+
+class Soak:
+    def __init__(self, main_module, duration: float):
+        from aiogram.fsm.context import FSMContext
+        from aiogram.fsm.storage.base import StorageKey
+        from aiogram.fsm.storage.memory import MemoryStorage
+        from database import User
+
+        self.main = main_module
+        self.duration = duration
+        self.bot = FakeBot()
+        self.storage = MemoryStorage()
+        self._FSMContext = FSMContext
+        self._StorageKey = StorageKey
+        self.users = {
+            uid: User(id=uid, username=f"user{uid}", full_name=f"User {uid}", access_level=tariff,
+                      tariff=tariff, balance=10**9, tariff_expires_at=None)
+            for uid in range(ADMIN_ID, USERS + 1)
+            for tariff in [("admin" if uid == ADMIN_ID else random.choice(["demo", "basic", "full"]))]
+        }
+        self.next_gen_id = 0
+        self.sessions_done = 0
+        self.errors = 0
+        self.samples: list[dict] = []
+        self._patch()
+
+    # --- Фейки БД и сервиса генерации, подменяемые в пространстве имен main ---
+
+    def _patch(self):
+        m = self.main
+
+        async def get_user(user_id):
+            return self.users.get(user_id)
+
+        async def add_or_update_user(user_id, username, full_name):
+            return self.users[user_id], False
+
+        async def update_balance(user_id, delta):
+            user = self.users[user_id]
+            user.balance += delta
+            return user.balance
+
+        async def get_user_balance(user_id):
+            return self.users[user_id].balance
+
+        async def finish_generation(gen_id, status, tokens=0, refund=0):
+            return None  # как будто генерацию уже завершили: баланс берется через get_user_balance
+
+        async def submit_generation_job(user_id, cost, model, prompt, ar, res, payload):
+            # Вместо очереди в БД задание сразу выполняется в этом процессе
+            balance = await update_balance(user_id, -cost)
+            self.next_gen_id += 1
+            m.spawn(m.run_generation_job(m.Job(id=self.next_gen_id, attempts=1, payload=payload)))
+            return self.next_gen_id, balance
+
+        async def noop(*args, **kwargs):
+            return None
+
+        async def generate_image(prompt, aspect_ratio="1:1", resolution="1K", model_type="nano_banana_pro",
+                                 reference_images=None, chat_session=None, **kwargs):
+            await asyncio.sleep(random.uniform(0.05, 0.3))
+            session = chat_session
+            if "imagen" not in model_type:
+                session = chat_session or FakeChatSession()
+            return os.urandom(2048), 100, session
+
+        m.get_user = get_user
+        m.add_or_update_user = add_or_update_user
+        m.update_balance = update_balance
+        m.get_user_balance = get_user_balance
+        m.submit_generation_job = submit_generation_job
+        m.finish_generation = finish_generation
+        m.fail_completed_generation = noop
+        m.job_state = lambda chat_id, user_id: self.state_for(user_id)
+        m.bot = self.bot
+        m.update_generation_status = noop
+        m.set_user_tariff = noop
+        m.update_user_access = noop
+        m.nano_service.generate_image = generate_image
+        m.ADMIN_IDS = [ADMIN_ID]
+        m.chat_sessions.ttl = SESSION_TTL
+        m.delayed_actions.bot = self.bot
+        m.delayed_actions.store = None
+        m.result_store = None
+        m.set_generation_results = noop
+
+    def state_for(self, user_id: int):
+        key = self._StorageKey(bot_id=0, chat_id=user_id, user_id=user_id)
+        return self._FSMContext(storage=self.storage, key=key)
+
+    # --- Сценарии ---
+
+    async def scenario_quick(self, uid: int):
+        m = self.main
+        state = self.state_for(uid)
+        start = random.choice([m.cmd_flash, m.cmd_pro, m.cmd_imagen])
+        await start(FakeMessage(self.bot, uid, uid, text="/go"), state)
+        if random.random() < 0.3:
+            photos = [f"ref{uid}_{i}" for i in range(random.randint(1, 3))]
+            group = f"album{uid}{time.monotonic_ns()}" if len(photos) > 1 else None
+            for pid in photos:
+                await m.process_prompt_input(FakeMessage(self.bot, uid, uid, text="кот", photo_ids=[pid], media_group_id=group), state)
+        else:
+            await m.process_prompt_input(FakeMessage(self.bot, uid, uid, text="кот в шляпе --ar 16:9"), state)
+        await asyncio.sleep(random.uniform(2.5, 4.0))
+
+    async def scenario_dialogue(self, uid: int):
+        m = self.main
+        state = self.state_for(uid)
+        await m.cmd_pro(FakeMessage(self.bot, uid, uid, text="/pro"), state)
+        await m.process_prompt_input(FakeMessage(self.bot, uid, uid, text="замок на холме"), state)
+        await asyncio.sleep(3.0)
+        if await state.get_state() != m.GenStates.dialogue_standby.state:
+            return
+        await m.process_dialogue_standby(FakeMessage(self.bot, uid, uid, text="добавь дракона"), state)
+        if await state.get_state() == m.GenStates.dialogue_confirm.state:
+            await m.process_dialogue_confirm_callback(FakeCallback(FakeMessage(self.bot, uid, uid), uid, "dialogue:confirm"), state)
+        # Часть пользователей бросает диалог, не завершая его: сессия должна уйти по TTL
+        if random.random() < 0.5:
+            await m.process_dialogue_confirm_callback(FakeCallback(FakeMessage(self.bot, uid, uid), uid, "dialogue:finish"), state)
+
+    async def scenario_workshop(self, uid: int):
+        m = self.main
+        state = self.state_for(uid)
+        await m.cmd_creation_entry(FakeMessage(self.bot, uid, uid, text="🎨 К созданию"), state)
+        menu = FakeMessage(self.bot, uid, uid, text="menu")
+        for data in ["create:mode:image", "create:family:banana", "create:model:gemini-2.5-flash-image", "create:config:ar:16:9"]:
+            await m.process_create_callback(FakeCallback(menu, uid, data), state)
+        await m.process_creation_prompt(FakeMessage(self.bot, uid, uid, text="маяк в шторм"), state)
+
+    async def scenario_cancel(self, uid: int):
+        m = self.main
+        state = self.state_for(uid)
+        await m.cmd_flash(FakeMessage(self.bot, uid, uid, text="/flash"), state)
+        await m.cmd_cancel(FakeMessage(self.bot, uid, uid, text="отмена"), state)
+
+    async def scenario_admin_notice(self, uid: int):
+        # Неверный ввод баланса админом порождает отложенное удаление сообщения
+        m = self.main
+        state = self.state_for(ADMIN_ID)
+        await state.set_state(m.AdminStates.waiting_for_balance)
+        await state.update_data(target_user_id=uid)
+        await m.process_balance_input(FakeMessage(self.bot, ADMIN_ID, ADMIN_ID, text="не число"), state)
+
+    async def worker(self, deadline: float):
+        scenarios = [self.scenario_quick, self.scenario_dialogue, self.scenario_workshop,
+                     self.scenario_cancel, self.scenario_admin_notice]
+        weights = [5, 3, 3, 2, 1]
+        while time.monotonic() < deadline:
+            uid = random.randint(ADMIN_ID + 1, USERS)
+            scenario = random.choices(scenarios, weights)[0]
+            try:
+                await scenario(uid)
+            except Exception:
+                self.errors += 1
+            self.sessions_done += 1
+
+    # --- Замеры ---
+
+    def sample(self) -> dict:
+        m = self.main
+        gc.collect()
+        current, _ = tracemalloc.get_traced_memory()
+        background = getattr(m, "background_tasks", ())
+        sample = {
+            "t": time.monotonic(),
+            "rss_mb": rss_mb(),
+            "traced_mb": current / 2**20,
+            "tasks": len(asyncio.all_tasks()),
+            "chat_sessions": len(m.chat_sessions),
+            "pending_albums": len(m.album_collector) + len(m.prompt_collector),
+            "delayed_actions": m.delayed_actions.pending_count,
+            "background_tasks": len(background),
+            "sessions_done": self.sessions_done,
+        }
+        self.samples.append(sample)
+        print(" ".join(f"{k}={v:.1f}" if isinstance(v, float) else f"{k}={v}" for k, v in sample.items()), flush=True)
+        return sample
+
+    async def sampler(self, deadline: float):
+        while time.monotonic() < deadline:
+            await asyncio.sleep(min(SAMPLE_INTERVAL, max(0.0, deadline - time.monotonic())))
+            self.sample()
+
+    async def run(self) -> tuple[dict, dict, tracemalloc.Snapshot, tracemalloc.Snapshot]:
+        tracemalloc.start(10)
+        start = time.monotonic()
+        deadline = start + self.duration
+        workers = [asyncio.create_task(self.worker(deadline)) for _ in range(CONCURRENCY)]
+
+        # Прогрев: кэши, пул строк и т.п. не считаются утечкой
+        await asyncio.sleep(min(self.duration * 0.1, 300))
+        warm = self.sample()
+        warm_snapshot = tracemalloc.take_snapshot()
+
+        await self.sampler(deadline)
+        await asyncio.gather(*workers)
+        # Даем догореть отложенным задачам (сбор альбомов, удаление сообщений) и истечь TTL сессий
+        await asyncio.sleep(max(5.0, SESSION_TTL + 1))
+        self.main.chat_sessions.prune()
+        final = self.sample()
+        final_snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        return warm, final, warm_snapshot, final_snapshot
+
+
+def import_main():
+    """bot/main.py с фиктивными настройками: подключения к Telegram, Gemini и Postgres при импорте нет."""
+    for key, value in {
+        "BOT_TOKEN": "123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA",
+        "GEMINI_API_KEY": "soak",
+        "POSTGRES_USER": "soak",
+        "POSTGRES_PASSWORD": "soak",
+        "POSTGRES_DB": "soak",
+        "POSTGRES_HOST": "localhost",
+    }.items():
+        os.environ.setdefault(key, value)
+    import main
+    return main
+
+
+class TestPromptCollect(unittest.TestCase):
+    """Сборка сообщений промпта на тех же фейках, без длительного прогона."""
+
+    def setUp(self):
+        self.main = import_main()
+        self.soak = Soak(self.main, 0)
+        self.submitted = []
+        submit = self.main.submit_generation_job
+
+        async def submit_generation_job(user_id, cost, model, prompt, ar, res, payload):
+            self.submitted.append((prompt, len(payload["refs"])))
+            return await submit(user_id, cost, model, prompt, ar, res, payload)
+
+        self.main.submit_generation_job = submit_generation_job
+        self.uid = 2
+        user = self.soak.users[self.uid]
+        user.tariff = user.access_level = "full"
+
+    async def start(self):
+        state = self.soak.state_for(self.uid)
+        await self.main.cmd_flash(FakeMessage(self.soak.bot, self.uid, self.uid, text="/flash"), state)
+        return state
+
+    def test_text_without_photos_runs_immediately(self):
+        async def scenario():
+            state = await self.start()
+            await self.main.process_prompt_input(FakeMessage(self.soak.bot, self.uid, self.uid, text="кот"), state)
+            submitted = list(self.submitted)  # сразу, без паузы сборки
+            await asyncio.sleep(0.5)  # дать задаче генерации завершиться
+            return submitted, len(self.main.prompt_collector)
+
+        self.assertEqual(asyncio.run(scenario()), ([("кот", 0)], 0))
+
+    def test_photo_then_text_is_one_generation(self):
+        collector = self.main.prompt_collector
+        collector.min_wait, collector.max_wait = 0.05, 0.05
+
+        async def scenario():
+            state = await self.start()
+            await self.main.process_prompt_input(FakeMessage(self.soak.bot, self.uid, self.uid, photo_ids=["ref"]), state)
+            await self.main.process_prompt_input(FakeMessage(self.soak.bot, self.uid, self.uid, text="кот"), state)
+            pending = list(self.submitted)
+            await asyncio.sleep(0.5)
+            return pending, self.submitted
+
+        try:
+            self.assertEqual(asyncio.run(scenario()), ([], [("кот", 1)]))
+        finally:
+            collector.min_wait = collector.max_wait = self.main.config.PROMPT_COLLECT_WAIT
+
+
+class TestAbandonJob(unittest.TestCase):
+    """Брошенное задание на тех же фейках: какая генерация получает возврат."""
+
+    def setUp(self):
+        self.main = import_main()
+        self.soak = Soak(self.main, 0)
+        self.refunds = []
+
+        async def fail_completed_generation(gen_id, refund):
+            self.refunds.append((gen_id, refund))
+            return 500
+
+        self.main.fail_completed_generation = fail_completed_generation
+
+    def abandon(self, gen):
+        async def get_generation(gen_id):
+            return gen
+
+        self.main.get_generation = get_generation
+        payload = {"chat_id": 2, "unit_cost": 10, "variants": 3, "tariff": "full"}
+        asyncio.run(self.main.abandon_generation_job(self.main.Job(id=7, attempts=3, payload=payload)))
+        return self.refunds, self.soak.bot.sent
+
+    def test_completed_but_undelivered_is_refunded(self):
+        gen = SimpleNamespace(status="completed", cost=20, tg_file_id=None, result_hashes=None)
+        self.assertEqual(self.abandon(gen), ([(7, 20)], 1))
+
+    def test_delivered_or_refunded_is_left_alone(self):
+        for gen in (SimpleNamespace(status="completed", cost=20, tg_file_id="file", result_hashes=None),
+                    SimpleNamespace(status="failed", cost=0, tg_file_id=None, result_hashes=None),
+                    None):
+            self.assertEqual(self.abandon(gen), ([], 0))
+
+
+@unittest.skipUnless(SOAK_DURATION, "soak-тест запускается только с SOAK_DURATION")
+class TestSoak(unittest.TestCase):
+
+    def test_memory_growth(self):
+        main = import_main()
+
+        soak = Soak(main, _parse_duration(SOAK_DURATION))
+        warm, final, warm_snapshot, final_snapshot = asyncio.run(soak.run())
+
+        top = final_snapshot.compare_to(warm_snapshot, "lineno")[:10]
+        report = "\n".join(str(stat) for stat in top)
+        print(f"\nСессий: {soak.sessions_done}, ошибок: {soak.errors}\nТоп роста памяти:\n{report}")
+
+        self.assertGreater(soak.sessions_done, 0)
+        self.assertLessEqual(final["rss_mb"] - warm["rss_mb"], MAX_RSS_GROWTH_MB, report)
+        self.assertLessEqual(final["traced_mb"] - warm["traced_mb"], MAX_TRACED_GROWTH_MB, report)
+        # После затухания нагрузки не должно оставаться «висящих» задач и записей
+        self.assertLessEqual(final["tasks"], 1)  # только сама корутина теста
+        self.assertEqual(final["pending_albums"], 0)
+        self.assertEqual(final["delayed_actions"], 0)
+        self.assertEqual(final["background_tasks"], 0)
+        self.assertEqual(final["chat_sessions"], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import asyncio
+import unittest
+import sys
+import os
+
+# Add bot directory to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../bot')))
+
+from resilience import RetryPolicy
+from startup import StartupPhases, wait_ready
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    async def sleep(self, delay):
+        self.now += delay
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_wait_ready_backs_off_until_probe_passes(self):
+        clock = FakeClock()
+        calls = []
+
+        async def probe():
+            calls.append(clock.now)
+            if len(calls) < 4:
+                raise ConnectionRefusedError("connection refused")
+
+        policy = RetryPolicy(base_delay=0.1, max_delay=1.0)
+        ready = asyncio.run(wait_ready("db", probe, timeout=10, policy=policy,
+                                       clock=clock, sleep=clock.sleep))
+        self.assertTrue(ready)
+        # Полный джиттер: паузы случайны, но не больше 0.1, 0.2, 0.4
+        delays = [b - a for a, b in zip(calls, calls[1:])]
+        self.assertEqual(len(delays), 3)
+        for delay, cap in zip(delays, (0.1, 0.2, 0.4)):
+            self.assertLessEqual(delay, cap + 1e-9)
+
+    def test_wait_ready_first_attempt_and_timeout(self):
+        clock = FakeClock()
+
+        async def up():
+            pass
+
+        async def down():
+            raise OSError("no route to host")
+
+        policy = RetryPolicy(base_delay=1.0, max_delay=1.0)
+        self.assertTrue(asyncio.run(wait_ready("db", up, clock=clock, sleep=clock.sleep)))
+        self.assertEqual(clock.now, 0.0)
+        self.assertFalse(asyncio.run(wait_ready("db", down, timeout=5, policy=policy,
+                                                clock=clock, sleep=clock.sleep)))
+        self.assertLessEqual(clock.now, 5.0)
+
+    def test_startup_phases_summary(self):
+        ticks = iter([10.5, 10.52, 11.0])
+        phases = StartupPhases(started=9.0, clock=lambda: next(ticks))
+        phases.mark("imports")
+        phases.mark("db_wait")
+        phases.mark("init_db")
+        self.assertEqual([name for name, _ in phases.phases], ["imports", "db_wait", "init_db"])
+        self.assertAlmostEqual(phases.total, 2.0)
+        self.assertEqual(phases.summary(), "2.00s (imports 1500 ms, db_wait 20 ms, init_db 480 ms)")
+
+
+if __name__ == '__main__':
+    unittest.main()
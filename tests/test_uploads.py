@@ -0,0 +1,114 @@
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+# Add bot directory to path
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '../bot')))
+
+from uploads import ChunkedUploads, UploadError
+
+
+class TestChunkedUploads(unittest.TestCase):
+
+    def test_resume_after_lost_chunk(self):
+        with tempfile.TemporaryDirectory() as root:
+            uploads = ChunkedUploads(root)
+
+            async def scenario():
+                upload_id = await uploads.create(1, 10)
+                await uploads.append(upload_id, 1, 0, b"abcd")
+                # Ответ на вторую часть потерялся, клиент повторяет ее с прежним смещением
+                await uploads.append(upload_id, 1, 4, b"efg")
+                with self.assertRaises(UploadError) as conflict:
+                    await uploads.append(upload_id, 1, 4, b"efg")
+                offset, size = await uploads.status(upload_id, 1)
+                await uploads.append(upload_id, 1, offset, b"hij")
+                data = await uploads.take(upload_id, 1)
+                return conflict.exception, (offset, size), data, os.listdir(root)
+
+            conflict, status, data, left = asyncio.run(scenario())
+            self.assertEqual((conflict.status, conflict.offset), (409, 7))
+            self.assertEqual(status, (7, 10))
+            self.assertEqual(data, b"abcdefghij")
+            self.assertEqual(left, [])
+
+    def test_limits_and_ownership(self):
+        with tempfile.TemporaryDirectory() as root:
+            uploads = ChunkedUploads(root)
+
+            async def scenario():
+                upload_id = await uploads.create(1, 4)
+                errors = []
+                for call in (
+                    uploads.append(upload_id, 1, 0, b"too long"),
+                    uploads.append(upload_id, 2, 0, b"ab"),  # чужая загрузка
+                    uploads.status("../../etc/passwd", 1),
+                    uploads.take(upload_id, 1),  # еще не завершена
+                ):
+                    try:
+                        await call
+                    except UploadError as e:
+                        errors.append(e.status)
+                return errors
+
+            self.assertEqual(asyncio.run(scenario()), [413, 404, 404, 409])
+
+    def test_prune_abandoned(self):
+        now = time.time()
+        with tempfile.TemporaryDirectory() as root:
+            uploads = ChunkedUploads(root, ttl=600, clock=lambda: now)
+
+            async def scenario():
+                old = await uploads.create(1, 4)
+                fresh = await uploads.create(1, 4)
+                os.utime(os.path.join(root, f"{old}.part"), (now - 1200, now - 1200))
+                removed = await uploads.prune()
+                with self.assertRaises(UploadError):
+                    await uploads.status(old, 1)
+                return removed, await uploads.status(fresh, 1)
+
+            self.assertEqual(asyncio.run(scenario()), (1, (0, 4)))
+
+    def test_open_uploads_limit_and_cancel(self):
+        with tempfile.TemporaryDirectory() as root:
+            uploads = ChunkedUploads(root)
+
+            async def scenario():
+                # Одновременные запросы не проходят подсчет все сразу
+                results = await asyncio.gather(*(uploads.create(1, 4, limit=2) for _ in range(3)),
+                                               return_exceptions=True)
+                opened = [r for r in results if isinstance(r, str)]
+                refused = [r.status for r in results if isinstance(r, UploadError)]
+                other_user = await uploads.create(2, 4, limit=2)
+                await uploads.cancel(opened[0], 1)
+                again = await uploads.create(1, 4, limit=2)
+                with self.assertRaises(UploadError) as missing:
+                    await uploads.cancel(other_user, 1)
+                return len(opened), refused, bool(again), missing.exception.status
+
+            self.assertEqual(asyncio.run(scenario()), (2, [429], True, 404))
+
+    def test_unknown_ids_leave_no_locks(self):
+        with tempfile.TemporaryDirectory() as root:
+            uploads = ChunkedUploads(root)
+
+            async def scenario():
+                upload_id = await uploads.create(1, 4)
+                for bad_id in ("../../etc/passwd", "x" * 1000, "0" * 32):
+                    for call in (uploads.append(bad_id, 1, 0, b"ab"), uploads.cancel(bad_id, 1)):
+                        with self.assertRaises(UploadError):
+                            await call
+                # Чужой запрос к существующей загрузке не сбрасывает ее блокировку
+                with self.assertRaises(UploadError):
+                    await uploads.append(upload_id, 2, 0, b"ab")
+                return list(uploads._locks)
+
+            locks = asyncio.run(scenario())
+            self.assertEqual(len(locks), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
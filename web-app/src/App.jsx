@@ -1,7 +1,15 @@
 import React, { useState, useEffect } from 'react';
 import ModelSelector from './components/ModelSelector';
 import Settings from './components/Settings';
-import PromptInput from './components/PromptInput';
+import PromptInput, { downscaleImage } from './components/PromptInput';
+import { useApi, apiEnabled, submitJob, watchJob, uploadReference } from './api';
+
+const JOB_STATUS_TEXT = {
+    queued: '⏳ В очереди',
+    running: '🍌 Генерирую...',
+    completed: '✨ Готово! Результат — в чате с ботом',
+    failed: '❌ Ошибка генерации, NC возвращены',
+};
 
 function App() {
     const [model, setModel] = useState('nano_banana');
@@ -9,21 +17,51 @@ function App() {
     const [aspectRatio, setAspectRatio] = useState('1:1');
     const [resolution, setResolution] = useState('1K');
     const [useReference, setUseReference] = useState(false);
-    const [userLevel, setUserLevel] = useState('demo');
+    const [urlLevel, setUrlLevel] = useState('demo');
+    const [job, setJob] = useState(null); // статус генерации, поставленной через API
+    const [jobError, setJobError] = useState(null);
+    const [references, setReferences] = useState([]); // { key, name, progress, hash, error }
+
+    // Профиль и цены из API бота (сначала сохраненная копия, затем свежие данные)
+    const profile = useApi('/api/profile');
+    const catalog = useApi('/api/models');
 
     // Parse URL params on mount
     useEffect(() => {
         const params = new URLSearchParams(window.location.search);
         const lvl = params.get('level') || 'demo';
-        setUserLevel(lvl);
+        setUrlLevel(lvl);
     }, []);
 
+    // Уровень из профиля API; параметр level в URL — запасной вариант без API
+    const userLevel = profile?.tariff || urlLevel;
+    // Фото загружаются прямо из приложения, если API доступен и тариф их разрешает
+    const uploadLimits = apiEnabled && profile?.limits?.max_ref_bytes ? profile.limits : null;
+    const readyRefs = references.filter((ref) => ref.hash).map((ref) => ref.hash);
+    const sendRefsViaApi = useReference && uploadLimits && readyRefs.length > 0;
+
+    const updateReference = (key, patch) =>
+        setReferences((refs) => refs.map((ref) => (ref.key === key ? { ...ref, ...patch } : ref)));
+
+    const addReferences = (files) => {
+        for (const file of files) {
+            const key = `${file.name}-${file.lastModified}-${Math.random()}`;
+            setReferences((refs) => [...refs, { key, name: file.name, progress: 0 }]);
+            downscaleImage(file, uploadLimits.max_ref_bytes)
+                .then((blob) => uploadReference(blob, (progress) => updateReference(key, { progress })))
+                .then((hash) => updateReference(key, { hash }))
+                .catch((e) => updateReference(key, { error: e.message }));
+        }
+    };
+
+    const removeReference = (key) => setReferences((refs) => refs.filter((ref) => ref.key !== key));
+
     // Initialize Telegram WebApp
     useEffect(() => {
         const tg = window.Telegram?.WebApp;
         if (tg) {
             tg.ready();
-            tg.MainButton.text = useReference ? "ДАЛЕЕ (ОТПРАВИТЬ ФОТО)" : "СГЕНЕРИРОВАТЬ";
+            tg.MainButton.text = useReference && !sendRefsViaApi ? "ДАЛЕЕ (ОТПРАВИТЬ ФОТО)" : "СГЕНЕРИРОВАТЬ";
             tg.MainButton.color = "#F4D03F";
             tg.MainButton.textColor = "#000000";
 
@@ -35,7 +73,7 @@ function App() {
             }
 
             // Handle MainButton click
-            const handleMainBtn = () => {
+            const handleMainBtn = async () => {
                 const data = {
                     action: 'generate',
                     model,
@@ -44,7 +82,24 @@ function App() {
                     resolution: resolution,
                     use_reference: useReference
                 };
-                tg.sendData(JSON.stringify(data));
+                // Без загруженных фото референсы отправляются в чат, такой запрос идет через бота
+                if (!apiEnabled || (useReference && !sendRefsViaApi)) {
+                    tg.sendData(JSON.stringify(data));
+                    return;
+                }
+                if (sendRefsViaApi) data.refs = readyRefs;
+                // Через API приложение не закрывается и показывает статус генерации
+                setJobError(null);
+                tg.MainButton.showProgress();
+                try {
+                    const { id, status } = await submitJob(data);
+                    setJob({ id, status });
+                    watchJob(id, setJob);
+                } catch (e) {
+                    setJobError(e.message);
+                } finally {
+                    tg.MainButton.hideProgress();
+                }
             };
 
             tg.onEvent('mainButtonClicked', handleMainBtn);
@@ -52,7 +107,7 @@ function App() {
                 tg.offEvent('mainButtonClicked', handleMainBtn);
             };
         }
-    }, [model, prompt, aspectRatio, resolution, useReference]);
+    }, [model, prompt, aspectRatio, resolution, useReference, sendRefsViaApi, readyRefs.join()]);
 
     const allowHighRes = userLevel === 'full' || userLevel === 'admin';
     const canUploadPhoto = userLevel !== 'demo';
@@ -60,8 +115,21 @@ function App() {
     return (
         <div className="app-container">
             <h1 style={{ textAlign: 'center', color: '#F4D03F' }}>🍌 Nano Banana</h1>
+            {profile && (
+                <div style={{ textAlign: 'center', color: '#aaa', marginBottom: '10px' }}>
+                    {profile.tariff.toUpperCase()} • {profile.balance} NC
+                </div>
+            )}
+
+            {job && (
+                <div style={{ textAlign: 'center', marginBottom: '10px' }}>
+                    {JOB_STATUS_TEXT[job.status] || job.status}
+                    {job.status === 'queued' && job.position ? ` (перед вами: ${job.position})` : ''}
+                </div>
+            )}
+            {jobError && <div style={{ textAlign: 'center', color: '#e74c3c', marginBottom: '10px' }}>{jobError}</div>}
 
-            <ModelSelector value={model} onChange={setModel} />
+            <ModelSelector value={model} onChange={setModel} catalog={catalog} />
 
             <PromptInput
                 prompt={prompt}
@@ -69,6 +137,10 @@ function App() {
                 showReferenceUpload={model !== 'imagen' && canUploadPhoto} // Flash and Pro support it if level allows
                 useReference={useReference}
                 onToggleReference={setUseReference}
+                uploadLimits={uploadLimits}
+                references={references}
+                onAddReferences={addReferences}
+                onRemoveReference={removeReference}
             />
 
             <Settings
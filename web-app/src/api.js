@@ -0,0 +1,178 @@
+import { useEffect, useState } from 'react';
+
+// Адрес HTTP API бота: параметр ?api= в ссылке на мини-приложение или VITE_API_URL при сборке
+const API_URL = (new URLSearchParams(window.location.search).get('api')
+    || import.meta.env.VITE_API_URL || '').replace(/\/$/, '');
+
+const CACHE_PREFIX = 'api-cache:';
+
+function readCache(path) {
+    try {
+        return JSON.parse(localStorage.getItem(CACHE_PREFIX + path));
+    } catch {
+        return null;
+    }
+}
+
+function writeCache(path, etag, data) {
+    try {
+        localStorage.setItem(CACHE_PREFIX + path, JSON.stringify({ etag, data }));
+    } catch {
+        // Переполненный localStorage — просто работаем без кеша
+    }
+}
+
+export const apiEnabled = Boolean(API_URL);
+
+function authHeaders() {
+    const initData = window.Telegram?.WebApp?.initData;
+    return initData ? { Authorization: `tma ${initData}` } : {};
+}
+
+// GET к API с подписью initData. Сохраненная копия перепроверяется по ETag:
+// на 304 сервер не присылает тело, и берется копия из localStorage.
+export async function apiGet(path) {
+    if (!API_URL) return null;
+    const cached = readCache(path);
+    const headers = authHeaders();
+    if (cached?.etag) headers['If-None-Match'] = cached.etag;
+
+    const resp = await fetch(API_URL + path, { headers });
+    if (resp.status === 304 && cached) return cached.data;
+    if (!resp.ok) throw new Error(`${path}: HTTP ${resp.status}`);
+    const data = await resp.json();
+    writeCache(path, resp.headers.get('ETag'), data);
+    return data;
+}
+
+// Данные API для компонента: сразу — сохраненная копия (интерфейс рисуется без ожидания сети),
+// затем — свежий ответ. null, пока нет ни копии, ни ответа (или API не настроен).
+export function useApi(path) {
+    const [data, setData] = useState(() => readCache(path)?.data ?? null);
+
+    useEffect(() => {
+        let active = true;
+        apiGet(path)
+            .then((fresh) => { if (active && fresh) setData(fresh); })
+            .catch((e) => console.warn(e));
+        return () => { active = false; };
+    }, [path]);
+
+    return data;
+}
+
+// Поставить генерацию в очередь. Отказ (нет NC, лимиты, тариф) — Error с текстом сервера
+export async function submitJob(params) {
+    const resp = await fetch(`${API_URL}/api/jobs`, {
+        method: 'POST',
+        headers: { ...authHeaders(), 'Content-Type': 'application/json' },
+        body: JSON.stringify(params),
+    });
+    const data = await resp.json().catch(() => ({}));
+    if (!resp.ok) throw new Error(data.error || `HTTP ${resp.status}`);
+    return data;
+}
+
+const FINAL_STATUSES = ['completed', 'failed'];
+
+// Следить за статусом генерации: поток SSE (через fetch — EventSource не умеет заголовок
+// Authorization), при обрыве — опрос раз в 2 сек. Возвращает функцию отписки.
+export function watchJob(id, onStatus) {
+    const controller = new AbortController();
+    let done = false;
+    const emit = (status) => {
+        onStatus(status);
+        if (FINAL_STATUSES.includes(status.status)) done = true;
+    };
+
+    const poll = async () => {
+        while (!done && !controller.signal.aborted) {
+            try {
+                const resp = await fetch(`${API_URL}/api/jobs/${id}`, { headers: authHeaders(), signal: controller.signal });
+                if (resp.ok) emit(await resp.json());
+            } catch {
+                // сеть мигнула — пробуем снова
+            }
+            if (!done) await new Promise((r) => setTimeout(r, 2000));
+        }
+    };
+
+    (async () => {
+        try {
+            const resp = await fetch(`${API_URL}/api/jobs/${id}/events`, { headers: authHeaders(), signal: controller.signal });
+            const reader = resp.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            for (;;) {
+                const { value, done: eof } = await reader.read();
+                if (eof) break;
+                buffer += decoder.decode(value, { stream: true });
+                let sep;
+                while ((sep = buffer.indexOf('\n\n')) >= 0) {
+                    const chunk = buffer.slice(0, sep);
+                    buffer = buffer.slice(sep + 2);
+                    const data = chunk.split('\n').find((line) => line.startsWith('data: '));
+                    if (data) emit(JSON.parse(data.slice(6)));
+                }
+            }
+        } catch {
+            // поток недоступен — ниже перейдем на опрос
+        }
+        if (!done) poll();
+    })();
+
+    return () => controller.abort();
+}
+
+// Загрузить референс частями. После обрыва спрашиваем у сервера принятое смещение и продолжаем
+// с него, а не с начала. Возвращает ref (SHA-256) для поля refs в submitJob.
+export async function uploadReference(blob, onProgress = () => {}) {
+    const create = await fetch(`${API_URL}/api/uploads`, {
+        method: 'POST',
+        headers: { ...authHeaders(), 'Content-Type': 'application/json' },
+        body: JSON.stringify({ size: blob.size }),
+    });
+    const upload = await create.json().catch(() => ({}));
+    if (!create.ok) throw new Error(upload.error || `HTTP ${create.status}`);
+
+    const url = `${API_URL}/api/uploads/${upload.id}`;
+    try {
+        return await sendChunks(url, blob, upload.chunk_size, onProgress);
+    } catch (e) {
+        // Брошенная загрузка занимает лимит открытых загрузок — освобождаем его
+        fetch(url, { method: 'DELETE', headers: authHeaders() }).catch(() => {});
+        throw e;
+    }
+}
+
+async function sendChunks(url, blob, chunkSize, onProgress) {
+    let offset = 0;
+    let failures = 0;
+    for (;;) {
+        let resp;
+        try {
+            resp = await fetch(url, {
+                method: 'PATCH',
+                headers: { ...authHeaders(), 'Upload-Offset': String(offset) },
+                body: blob.slice(offset, offset + chunkSize),
+            });
+        } catch (e) {
+            if (++failures > 5) throw e;
+            await new Promise((r) => setTimeout(r, 1000 * failures));
+            // Часть могла дойти, а ответ потеряться — продолжаем с того, что принял сервер
+            const status = await fetch(url, { headers: authHeaders() }).then((r) => r.json()).catch(() => null);
+            if (status) offset = status.offset;
+            continue;
+        }
+        const data = await resp.json().catch(() => ({}));
+        if (resp.status === 409 && data.offset !== undefined) {
+            offset = data.offset;
+            continue;
+        }
+        if (!resp.ok) throw new Error(data.error || `HTTP ${resp.status}`);
+        failures = 0;
+        offset = data.offset;
+        onProgress(offset / blob.size);
+        if (data.ref) return data.ref;
+    }
+}
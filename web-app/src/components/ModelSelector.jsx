@@ -6,7 +6,14 @@ const models = [
     { id: 'imagen', name: 'Imagen', desc: 'Фотореализм' },
 ];
 
-function ModelSelector({ value, onChange }) {
+// Базовая цена модели (NC) из /api/models по короткому имени
+function basePrice(catalog, id) {
+    const fullId = catalog?.aliases?.[id];
+    const info = catalog?.models?.find((m) => m.id === fullId);
+    return info ? info.prices[''] : null;
+}
+
+function ModelSelector({ value, onChange, catalog }) {
     return (
         <div className="model-selector">
             <h3>Выберите модель</h3>
@@ -18,7 +25,10 @@ function ModelSelector({ value, onChange }) {
                         onClick={() => onChange(model.id)}
                     >
                         <div className="card-name">{model.name}</div>
-                        <div className="card-desc">{model.desc}</div>
+                        <div className="card-desc">
+                            {model.desc}
+                            {basePrice(catalog, model.id) !== null && ` • ${basePrice(catalog, model.id)} NC`}
+                        </div>
                     </div>
                 ))}
             </div>
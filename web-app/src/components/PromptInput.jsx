@@ -1,6 +1,41 @@
 import React from 'react';
 
-function PromptInput({ prompt, onPromptChange, showReferenceUpload, useReference, onToggleReference }) {
+// Больше этого по длинной стороне модели все равно не используют, а загрузка — в разы дольше
+const MAX_SIDE = 2048;
+
+// Уменьшить фото в браузере до MAX_SIDE и перекодировать в JPEG так, чтобы оно уложилось
+// в лимит тарифа. Маленькие JPEG уходят как есть.
+export async function downscaleImage(file, maxBytes) {
+    const bitmap = await createImageBitmap(file);
+    const scale = Math.min(1, MAX_SIDE / Math.max(bitmap.width, bitmap.height));
+    if (scale === 1 && file.type === 'image/jpeg' && file.size <= maxBytes) {
+        bitmap.close();
+        return file;
+    }
+    const canvas = document.createElement('canvas');
+    canvas.width = Math.round(bitmap.width * scale);
+    canvas.height = Math.round(bitmap.height * scale);
+    canvas.getContext('2d').drawImage(bitmap, 0, 0, canvas.width, canvas.height);
+    bitmap.close();
+
+    for (const quality of [0.9, 0.8, 0.65, 0.5]) {
+        const blob = await new Promise((resolve) => canvas.toBlob(resolve, 'image/jpeg', quality));
+        if (blob.size <= maxBytes) return blob;
+    }
+    throw new Error('Фото слишком большое для вашего тарифа');
+}
+
+function PromptInput({ prompt, onPromptChange, showReferenceUpload, useReference, onToggleReference,
+    uploadLimits = null, references = [], onAddReferences, onRemoveReference }) {
+    // Загрузка прямо из приложения, если доступен API; иначе бот попросит фото в чате
+    const canUpload = Boolean(uploadLimits && onAddReferences);
+
+    const handleFiles = (e) => {
+        const files = Array.from(e.target.files || []).slice(0, uploadLimits.max_refs - references.length);
+        e.target.value = '';
+        if (files.length) onAddReferences(files);
+    };
+
     return (
         <div className="prompt-input">
             <h3>Ваша идея</h3>
@@ -23,7 +58,20 @@ function PromptInput({ prompt, onPromptChange, showReferenceUpload, useReference
                     >
                         {useReference ? "✅ Референсы включены" : "📷 Добавить референс"}
                     </button>
-                    {useReference && <div style={{ fontSize: '0.8em', color: '#aaa', marginTop: '5px' }}>Бот попросит отправить фото в чате</div>}
+                    {useReference && !canUpload && <div style={{ fontSize: '0.8em', color: '#aaa', marginTop: '5px' }}>Бот попросит отправить фото в чате</div>}
+                    {useReference && canUpload && (
+                        <div style={{ marginTop: '8px' }}>
+                            {references.map((ref) => (
+                                <div key={ref.key} style={{ fontSize: '0.85em', color: ref.error ? '#e74c3c' : '#aaa' }}>
+                                    {ref.name}: {ref.error || (ref.hash ? '✅' : `${Math.round(ref.progress * 100)}%`)}
+                                    {' '}<span style={{ cursor: 'pointer' }} onClick={() => onRemoveReference(ref.key)}>✖</span>
+                                </div>
+                            ))}
+                            {references.length < uploadLimits.max_refs && (
+                                <input type="file" accept="image/*" multiple onChange={handleFiles} />
+                            )}
+                        </div>
+                    )}
                 </div>
             )}
         </div>